@@ -0,0 +1,162 @@
+"""
+Covariance matrices of electrode data kept in factored form.
+
+The covariance of the model, L C L^T + sigma_e I, is that of a few generators
+seen through the lead field plus electrode noise, so it is a low rank matrix
+plus a diagonal one. Keeping the two parts separate makes products, solves,
+determinants and sampling cost O(n_el n_gen^2) instead of O(n_el^3).
+"""
+
+from __future__ import division
+
+from numpy import asarray, ones, dot, diag, diagonal, log, sqrt, newaxis,\
+                  identity, maximum, sum
+from numpy.linalg import solve, slogdet, eigh, cholesky, LinAlgError
+from numpy.random import standard_normal
+
+from lead_field import rereference, rereference_covariance
+
+
+class Low_Rank_Covariance():
+    """The covariance F K F^T + P D P^T of n electrodes, with factor F of
+    shape (n, r), core K of shape (r, r), D the diagonal matrix of diagonal,
+    a single variance or one variance per electrode, and P the projection of
+    the reference given by reference_weights, see
+    lead_field.calculate_reference_weights(), or the identity if they are
+    None. The factor, e.g. a lead field, is expected to be re-referenced
+    already. core_root, a matrix R with R R^T = K such as the Cholesky factor
+    of K, can be given if it is known, see calculate_sampling_factor().
+
+    The dense matrix is only calculated by dense(), all other operations use
+    the factors. solve() and log_determinant() need a nonsingular covariance,
+    i.e. no reference and positive variances on the diagonal.
+    """
+    def __init__(self, factor, core, diagonal, reference_weights=None,
+                 core_root=None):
+        self.factor = asarray(factor, dtype=float)
+        self.core = asarray(core, dtype=float)
+        self.n = self.factor.shape[0]
+        self.diagonal = asarray(diagonal, dtype=float) * ones(self.n)
+        self.reference_weights = reference_weights
+        self.core_root = core_root
+        self.matrix = None
+        self.capacitance = None
+        self.sampling_factor = None
+
+    def dense(self):
+        """The covariance as a dense matrix, calculated on first use."""
+        if self.matrix is None:
+            self.matrix = dot(dot(self.factor, self.core), self.factor.T) +\
+                          rereference_covariance(diag(self.diagonal),
+                                                 self.reference_weights)
+        return self.matrix
+
+    def noise_dot(self, x):
+        """P D P^T x"""
+        scale = self.diagonal if x.ndim == 1 else self.diagonal[:,newaxis]
+        if self.reference_weights is None:
+            return scale * x
+        # P^T x = x - w (1^T x)
+        w = self.reference_weights if x.ndim == 1 else \
+            self.reference_weights[:,newaxis]
+        x = x - w * sum(x, 0)
+        return rereference(scale * x, self.reference_weights)
+
+    def dot(self, x):
+        """Product of the covariance with a vector or matrix x of n rows."""
+        x = asarray(x, dtype=float)
+        return dot(self.factor, dot(self.core, dot(self.factor.T, x))) +\
+               self.noise_dot(x)
+
+    def check_nonsingular(self):
+        if self.reference_weights is not None:
+            raise ValueError('The covariance of re-referenced data is singular')
+        if (self.diagonal <= 0).any():
+            raise ValueError('The diagonal must be positive')
+
+    def calculate_capacitance(self):
+        """I + K F^T D^-1 F, the r x r matrix through which solve() and
+        log_determinant() work."""
+        if self.capacitance is None:
+            self.check_nonsingular()
+            scaled_factor = self.factor / self.diagonal[:,newaxis]
+            self.capacitance = identity(self.core.shape[0]) +\
+                               dot(self.core, dot(self.factor.T,
+                                                  scaled_factor))
+        return self.capacitance
+
+    def solve(self, b):
+        """Solves the covariance times x = b, with the Woodbury identity
+        (D + F K F^T)^-1 = D^-1 - D^-1 F (I + K F^T D^-1 F)^-1 K F^T D^-1.
+        """
+        b = asarray(b, dtype=float)
+        capacitance = self.calculate_capacitance()
+        scale = self.diagonal if b.ndim == 1 else self.diagonal[:,newaxis]
+        scaled_b = b / scale
+        correction = solve(capacitance, dot(self.core,
+                                            dot(self.factor.T, scaled_b)))
+        return scaled_b - dot(self.factor, correction) / scale
+
+    def log_determinant(self):
+        """Logarithm of the determinant, with the matrix determinant lemma
+        det(D + F K F^T) = det(D) det(I + K F^T D^-1 F).
+        """
+        sign, log_determinant = slogdet(self.calculate_capacitance())
+        if sign <= 0:
+            raise ValueError('The covariance is not positive definite')
+        return sum(log(self.diagonal)) + log_determinant
+
+    def inverse_diagonal(self):
+        """Diagonal of the inverse of the covariance, from the same Woodbury
+        identity as solve()."""
+        capacitance = self.calculate_capacitance()
+        inner = solve(capacitance, self.core)
+        return 1 / self.diagonal - sum(self.factor * dot(self.factor,
+                                                         inner.T), 1) /\
+                                   self.diagonal**2
+
+    def trace_dot(self, other):
+        """trace(covariance other) for a dense n x n matrix other."""
+        other = asarray(other, dtype=float)
+        low_rank = sum(self.core * dot(self.factor.T,
+                                       dot(other, self.factor)).T)
+        if self.reference_weights is None:
+            return low_rank + sum(self.diagonal * diagonal(other))
+        noise = rereference_covariance(diag(self.diagonal),
+                                       self.reference_weights)
+        return low_rank + sum(noise * other.T)
+
+    def trace_solve(self, other):
+        """trace(covariance^-1 other) for a dense n x n matrix other."""
+        return sum(diagonal(self.solve(other)))
+
+    def calculate_sampling_factor(self):
+        """F R for a root R R^T = K of the core, calculated on first use. R is
+        the Cholesky factor of K, or for cores that are only positive
+        semi-definite, e.g. without generator variability, the root of K with
+        negative eigenvalues clipped to zero. A core_root given on
+        initialization is used as it is."""
+        if self.sampling_factor is None:
+            root = self.core_root
+            if root is None:
+                try:
+                    root = cholesky(self.core)
+                except LinAlgError:
+                    values, vectors = eigh(self.core)
+                    root = vectors * sqrt(maximum(values, 0))
+            self.sampling_factor = dot(self.factor, root)
+        return self.sampling_factor
+
+    def sample(self, n_samples, mean=None):
+        """n_samples samples, of shape (n_samples, n), from the normal
+        distribution with this covariance, drawn as F R z + P D^(1/2) e (see
+        calculate_sampling_factor()) in O(n_samples n r) without forming the
+        dense matrix."""
+        sampling_factor = self.calculate_sampling_factor()
+        samples = dot(standard_normal((n_samples, sampling_factor.shape[1])),
+                      sampling_factor.T)
+        noise = sqrt(self.diagonal) * standard_normal((n_samples, self.n))
+        samples += rereference(noise, self.reference_weights, 1)
+        if mean is not None:
+            samples += mean
+        return samples
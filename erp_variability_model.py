@@ -1,15 +1,82 @@
+import os
 import sys
-sys.path.insert(0, 'old/scalingproject')
-sys.path.insert(0, 'util')
 
-from numpy import pi, dot, zeros, ndarray, transpose, identity, sqrt, newaxis
-from numpy.random import multivariate_normal, uniform
-from matplotlib import pyplot
+from numpy import pi, dot, zeros, ndarray, transpose, sqrt, newaxis,\
+                  nonzero, mean, matmul, concatenate, diag, identity, tril
+from numpy.linalg import norm
+from numpy.random import uniform
 
 from lead_field import Lead_Field
-from generator_configuration import random_generator_placement
-from topographicmap import plot_topographic_map, plot_topographic_map_array
-from variability_visualization import plot_covariance_matrix
+from covariance import Low_Rank_Covariance
+from generator_configuration import random_generator_placement, \
+                                    gen_conf_to_array
+
+
+def import_plotting():
+    """Imports the plotting functions on first use, so that computing with and
+    fitting the model doesn't import matplotlib. Returns pyplot,
+    plot_topographic_map and plot_covariance_matrix.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for subdirectory in ['old/scalingproject', 'util']:
+        path = os.path.join(directory, subdirectory)
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    from matplotlib import pyplot
+    from topographicmap import plot_topographic_map
+    from variability_visualization import plot_covariance_matrix
+    return pyplot, plot_topographic_map, plot_covariance_matrix
+
+
+# What each result of the model is calculated from, either other results or
+# groups of parameters (named as in ERP_Variability_Model_Fit.set_parameters())
+MODEL_DEPENDENCIES = {
+    'lead field': ('locations and orientations',),
+    'mean': ('lead field', 'amplitudes'),
+    'covariance generators': ('generator variance', 'generator covariance'),
+    'covariance': ('lead field', 'covariance generators',
+                   'electrode variance')}
+
+
+class Dependency_Graph():
+    """Keeps track of which results are up to date, given what each result is
+    calculated from. Changing a parameter group, see invalidate(), makes only
+    the results depending on it, directly or through other results, out of
+    date. graph[result] tells whether a result is up to date and
+    recalculations counts how many times each result was calculated.
+    """
+    def __init__(self, dependencies):
+        self.dependencies = dependencies
+        self.dependents = {}
+        for result, sources in dependencies.items():
+            for source in sources:
+                self.dependents.setdefault(source, []).append(result)
+        self.up_to_date = dict((result, False) for result in dependencies)
+        self.recalculations = dict((result, 0) for result in dependencies)
+
+    def __getitem__(self, result):
+        return self.up_to_date[result]
+
+    def invalidate(self, source):
+        """Marks everything depending on source, a parameter group or a
+        result, and source itself if it is a result, as out of date."""
+        if source in self.up_to_date:
+            self.up_to_date[source] = False
+        for result in self.dependents.get(source, []):
+            self.invalidate(result)
+
+    def invalidate_all(self):
+        """Marks all results as out of date."""
+        for result in self.up_to_date:
+            self.up_to_date[result] = False
+
+    def validate(self, result):
+        """Marks a result as just calculated, which makes the results
+        calculated from its previous value out of date."""
+        for dependent in self.dependents.get(result, []):
+            self.invalidate(dependent)
+        self.up_to_date[result] = True
+        self.recalculations[result] += 1
 
 
 #TODO sigma should be sigma_sq_ throghout, or var, because it's variance, so
@@ -17,17 +84,33 @@ from variability_visualization import plot_covariance_matrix
 
 
 class ERP_Variability_Model():
+    # What the results are calculated from, see Dependency_Graph
+    dependencies = MODEL_DEPENDENCIES
+
     def __init__(self, n_sub, n_gen, variability_electrodes='none',
                  variability_generators='none', 
-                 variability_connections='none'):
+                 variability_connections='none', lf=None, montage=None,
+                 channels=None, generator_parameterization='variance'):
         self.n_gen = n_gen # generators
         self.n_sub = n_sub # subjects
-        self.n_el = 60 # Hard-coded to use a specific electrode set
         
-        self.up_to_date = {}
+        self.up_to_date = Dependency_Graph(self.dependencies)
         self.set_parameter_limits()
         self.gen_conf = None
-        self.lf = Lead_Field()
+        # A Lead_Field object can be shared between models, e.g. in order to
+        # share its cache of lead field columns, otherwise one is created for
+        # the channels of the montage, see montage.get_montage()
+        if lf is None:
+            lf = Lead_Field(montage=montage, channels=channels)
+        self.lf = lf
+        # The electrodes are those of the lead field, whose Channel_Index
+        # selects the same channels from data
+        self.n_el = lf.xyz_el.shape[0]
+        self.channels = lf.channels
+        self.field_vector = None
+        # Generator parameters of the last lead field calculation, used to
+        # find the generators that changed since
+        self.lead_field_gen_array = None
 
         self.set_variability_type(variability_electrodes,
                                   variability_generators,
@@ -36,6 +119,21 @@ class ERP_Variability_Model():
         self.sigma_g = zeros(self.n_gen)
         self.sigma_c = zeros((self.n_gen, self.n_gen))
 
+        # With 'log-cholesky', the covariance of the generators is set through
+        # its lower triangular Cholesky factor self.gen_cholesky, see
+        # set_gen_cholesky(), so that it is positive definite whatever the
+        # parameters. sigma_g and sigma_c then follow from the factor.
+        if generator_parameterization not in ['variance', 'log-cholesky']:
+            raise ValueError
+        if generator_parameterization == 'log-cholesky' and\
+           variability_generators != 'individual':
+            raise ValueError('The log-Cholesky parameterization needs ' +
+                             'individual generator variances')
+        self.generator_parameterization = generator_parameterization
+        self.gen_cholesky = None
+        if generator_parameterization == 'log-cholesky':
+            self.set_gen_cholesky(identity(self.n_gen))
+
 
     def print_model(self, topographies=False):
         print('ERP Model Parameters')
@@ -59,6 +157,7 @@ class ERP_Variability_Model():
             print('ORIENTATION, Phi: ' + str(self.gen_conf[gen]['orientation_phi']))
             print('MAGNITUDE: ' + str(self.gen_conf[gen]['magnitude']))
             if topographies:
+                pyplot, plot_topographic_map = import_plotting()[:2]
                 pyplot.figure()
                 plot_topographic_map((self.gen_conf[gen]['magnitude'] *
                                       self.lf.calculate(
@@ -66,6 +165,8 @@ class ERP_Variability_Model():
     
 
     def plot_model(self, to_plot):
+        pyplot, plot_topographic_map, plot_covariance_matrix = \
+                import_plotting()
         for one_plot in to_plot:
             if one_plot == 'mean':
                 plot_topographic_map(self.mean)
@@ -146,6 +247,8 @@ class ERP_Variability_Model():
     def set_gen_conf(self, gen_conf):
         self.gen_conf = gen_conf
         self.n_gen = len(gen_conf)
+        self.up_to_date.invalidate('locations and orientations')
+        self.up_to_date.invalidate('amplitudes')
 
 
     def set_random(self):
@@ -154,19 +257,27 @@ class ERP_Variability_Model():
         self.set_random_variability()
 
 
-    def set_random_locations_orientations(self):
-        self.gen_conf = random_generator_placement(self.limits)
-        self.up_to_date['lead field'] = False
-        self.up_to_date['mean'] = False
-        self.up_to_date['covariance generators'] = False
-        self.up_to_date['covariance'] = False
+    def set_random_locations_orientations(self, generators=None):
+        """Randomizes the locations and orientations of all generators, or only
+        of those whose indices are in generators, keeping their magnitudes.
+        """
+        if generators is None:
+            self.gen_conf = random_generator_placement(self.limits)
+        else:
+            limits = dict(self.limits)
+            limits['n_gen'] = (len(generators), len(generators))
+            for gen, new_gen in zip(generators,
+                                    random_generator_placement(limits)):
+                new_gen['magnitude'] = self.gen_conf[gen]['magnitude']
+                self.gen_conf[gen] = new_gen
+        self.up_to_date.invalidate('locations and orientations')
 
 
     def set_random_magnitudes(self):
         limits = self.limits['magnitude']
         for i in range(self.n_gen):
             self.gen_conf[i]['magnitude'] = limits[0] + uniform(limits[1] - limits[0])
-        self.up_to_date['mean'] = False
+        self.up_to_date.invalidate('amplitudes')
 
 
     def set_random_variability(self):
@@ -184,6 +295,7 @@ class ERP_Variability_Model():
             self.sigma_e = []
             for i in range(self.n_el):
                 self.sigma_e.append(limits[0] + uniform(limits[1] - limits[0]))
+        self.up_to_date.invalidate('electrode variance')
         
     def set_random_variability_generators(self):
         limits = self.limits['generator_variance']
@@ -195,9 +307,25 @@ class ERP_Variability_Model():
             self.sigma_g = []
             for i in range(self.n_gen):
                 self.sigma_g.append(limits[0] + uniform(limits[1] - limits[0]))
+        if self.generator_parameterization == 'log-cholesky':
+            # Scaling the rows of the factor to the new variances keeps the
+            # correlations of the generators
+            old_variances = (self.gen_cholesky**2).sum(1)
+            self.set_gen_cholesky(self.gen_cholesky *
+                                  sqrt(self.sigma_g / old_variances)[:,newaxis])
+        self.up_to_date.invalidate('generator variance')
         
     def set_random_variability_connections(self):
-        if self.variability_connections == 'none':
+        if self.generator_parameterization == 'log-cholesky':
+            # The rows of a lower triangular matrix with unit length are the
+            # Cholesky factor of a random correlation matrix, scaled to the
+            # variances of the generators
+            factor = identity(self.n_gen)
+            if self.variability_connections == 'individual':
+                factor += tril(uniform(-1, 1, (self.n_gen, self.n_gen)), -1)
+            factor /= norm(factor, axis=1)[:,newaxis]
+            self.set_gen_cholesky(sqrt(self.sigma_g)[:,newaxis] * factor)
+        elif self.variability_connections == 'none':
             self.sigma_c = zeros((self.n_gen, self.n_gen))
         elif self.variability_connections == 'individual':
             self.sigma_c = zeros((self.n_gen, self.n_gen))
@@ -208,14 +336,77 @@ class ERP_Variability_Model():
                                                self.sigma_g[column]))
                         self.sigma_c[row, column] = sigma_c
                         self.sigma_c[column, row] = sigma_c
+        self.up_to_date.invalidate('generator covariance')
+
+
+    def set_gen_cholesky(self, gen_cholesky):
+        """Sets the covariance of the generators to L L^T, for a lower
+        triangular L with a positive diagonal, with the log-Cholesky
+        parameterization. The variances sigma_g and covariances sigma_c are
+        those of L L^T. Without connections between the generators L is
+        replaced by the diagonal matrix of the lengths of its rows, which has
+        the same variances."""
+        if self.generator_parameterization != 'log-cholesky':
+            raise ValueError('The generator covariance is parameterized by ' +
+                             'the variances')
+        if not (diag(gen_cholesky) > 0).all():
+            raise ValueError('The diagonal of the Cholesky factor of the ' +
+                             'generator covariance must be positive')
+        self.gen_cholesky = tril(gen_cholesky)
+        if self.variability_connections == 'none':
+            self.gen_cholesky = diag(norm(self.gen_cholesky, axis=1))
+        cov_gen = dot(self.gen_cholesky, self.gen_cholesky.T)
+        self.sigma_g = list(cov_gen.diagonal())
+        self.sigma_c = cov_gen - diag(cov_gen.diagonal())
+        self.up_to_date.invalidate('generator variance')
+        self.up_to_date.invalidate('generator covariance')
         
 
+    def changed_generators(self):
+        """Indices of the generators whose location or orientation changed
+        since the last calculation of the lead field, or None if the lead field
+        has to be calculated from scratch.
+        """
+        gen_array = gen_conf_to_array(self.gen_conf)
+        if self.lead_field_gen_array is None or\
+           self.lead_field_gen_array.shape != gen_array.shape:
+            return None
+        return list(nonzero((gen_array != self.lead_field_gen_array).any(1))[0])
+
+
     def calculate_lead_field(self):
-        self.lead_field = self.lf.calculate(self.gen_conf)
-        self.up_to_date['lead field'] = True
-        self.up_to_date['mean'] = False
-        self.up_to_date['covariance generators'] = False
-        self.up_to_date['covariance'] = False
+        # Only the columns of the generators that changed since the last
+        # calculation are recalculated, in place. The field vectors depend only
+        # on the locations of the generators, so they are kept across changes
+        # of orientations, and the lead field is then obtained by the cheap
+        # projection on the orientations. A Lead_Field with a cache of columns
+        # uses that cache instead.
+        changed = self.changed_generators()
+        gen_array = gen_conf_to_array(self.gen_conf)
+        if changed:
+            # The previous lead field may still be in use, e.g. as the factor
+            # of the covariance, so the columns are updated in a copy
+            self.lead_field = self.lead_field.copy()
+        if self.lf.cache_size > 0:
+            if changed is None:
+                self.lead_field = self.lf.calculate(self.gen_conf)
+            else:
+                self.lf.update_columns(self.lead_field, self.gen_conf, changed)
+        elif changed is None:
+            self.field_vector = self.lf.calculate_vector(self.gen_conf)
+            self.lead_field = self.lf.project(self.field_vector, self.gen_conf)
+        elif len(changed) > 0:
+            # The first three parameters are the location of the generator
+            moved = (gen_array[:,:3] != self.lead_field_gen_array[:,:3]).any(1)
+            moved = list(nonzero(moved)[0])
+            if len(moved) > 0:
+                self.field_vector[:,moved] = self.lf.calculate_vector(
+                                        [self.gen_conf[gen] for gen in moved])
+            self.lead_field[:,changed] = self.lf.project(
+                                        self.field_vector[:,changed],
+                                        [self.gen_conf[gen] for gen in changed])
+        self.lead_field_gen_array = gen_array
+        self.up_to_date.validate('lead field')
         return self.lead_field
 
 
@@ -227,29 +418,33 @@ class ERP_Variability_Model():
             gen_amplitudes.append(self.gen_conf[i]['magnitude'])
         self.mean = dot(self.lead_field, gen_amplitudes)
         
-        self.up_to_date['mean'] = True
+        self.up_to_date.validate('mean')
         
         return self.mean
 
 
-    def calculate_cov_gen(self):
-        if not self.up_to_date['lead field']: self.calculate_lead_field()
-        
-        self.cov_gen = zeros((self.n_gen, self.n_gen))
+    def generator_covariance(self, sigma_g, sigma_c):
+        """Covariance matrix of the generators given their variances sigma_g
+        and covariances sigma_c, according to the variability type."""
+        cov_gen = zeros((self.n_gen, self.n_gen))
         for row in range(self.n_gen):
             for column in range(self.n_gen):
                 if row == column:
                     if self.variability_generators == 'individual':
-                        self.cov_gen[row,column] = self.sigma_g[row]
+                        cov_gen[row,column] = sigma_g[row]
                     elif self.variability_generators == 'constant':
-                        self.cov_gen[row,column] = self.sigma_g
+                        cov_gen[row,column] = sigma_g
                 elif column > row:
                     if self.variability_connections == 'individual':
-                        self.cov_gen[row,column] = self.sigma_c[row,column]
-                        self.cov_gen[column,row] = self.sigma_c[row,column]
+                        cov_gen[row,column] = sigma_c[row,column]
+                        cov_gen[column,row] = sigma_c[row,column]
+        return cov_gen
+
+
+    def calculate_cov_gen(self):
+        self.cov_gen = self.generator_covariance(self.sigma_g, self.sigma_c)
         
-        self.up_to_date['covariance generators'] = True
-        self.up_to_date['covariance'] = False
+        self.up_to_date.validate('covariance generators')
 
         return self.cov_gen
 
@@ -259,26 +454,110 @@ class ERP_Variability_Model():
         if not self.up_to_date['covariance generators']:
             self.calculate_cov_gen()
         
-        # TODO: Make it work for individual electrode variance as well
-        self.cov = dot(dot(self.lead_field, self.cov_gen),
-                  transpose(self.lead_field)) + self.sigma_e *\
-                  identity(self.n_el)
+        # The covariance is kept factored, the dense matrix self.cov is only
+        # calculated when it is used, see __getattr__(). The lead field is
+        # already re-referenced, the electrode noise is re-referenced by the
+        # covariance.
+        # The Cholesky factor of the generator covariance, if that is the
+        # parameter, is reused for sampling
+        self.covariance = Low_Rank_Covariance(self.lead_field, self.cov_gen,
+                                              self.sigma_e,
+                                              self.lf.reference_weights,
+                                              core_root=self.gen_cholesky)
+        self.__dict__.pop('cov', None)
         
-        self.up_to_date['covariance'] = True
+        self.up_to_date.validate('covariance')
         
-        return self.cov
+        return self.covariance
+
+
+    def __getattr__(self, name):
+        # Materializing the dense covariance matrix on first use
+        if name == 'cov' and 'covariance' in self.__dict__:
+            self.cov = self.covariance.dense()
+            return self.cov
+        raise AttributeError(name)
 
 
     def simulate(self):
-        self.data = multivariate_normal(self.mean,self.cov,self.n_sub)
+        # Sampling generator activity through the lead field and adding
+        # electrode noise, see Low_Rank_Covariance.sample(), whose factors are
+        # kept until the covariance is recalculated
+        if not self.up_to_date['mean']: self.calculate_mean()
+        if not self.up_to_date['covariance']: self.calculate_cov()
+        self.data = self.covariance.sample(self.n_sub, self.mean)
         return self.data
 
 
+    def simulate_chunks(self, n_datasets, chunk=100, summary=False):
+        """Generates n_datasets simulated datasets of n_sub subjects each, in
+        chunks of up to chunk datasets drawn in one vectorized call. Each
+        chunk is an array of shape (chunk, n_sub, n_el), or if summary is True
+        only the sample mean and covariance of each dataset, arrays of shape
+        (chunk, n_el) and (chunk, n_el, n_el). The sample covariance needs at
+        least two subjects, so summary needs n_sub > 1. Only one chunk is in
+        memory at a time. self.data is left unchanged.
+        """
+        if summary and self.n_sub < 2:
+            raise ValueError('The sample covariance of a dataset needs at ' +
+                             'least two subjects')
+        return self.generate_chunks(n_datasets, chunk, summary)
+
+
+    def generate_chunks(self, n_datasets, chunk, summary):
+        if not self.up_to_date['mean']: self.calculate_mean()
+        if not self.up_to_date['covariance']: self.calculate_cov()
+        for start in range(0, n_datasets, chunk):
+            n_chunk = min(chunk, n_datasets - start)
+            data = self.covariance.sample(n_chunk * self.n_sub, self.mean)
+            data = data.reshape((n_chunk, self.n_sub, self.n_el))
+            if not summary:
+                yield data
+                continue
+            means = mean(data, 1)
+            data -= means[:,newaxis]
+            yield means, matmul(data.transpose((0,2,1)), data) /\
+                         (self.n_sub - 1)
+
+
+    def simulate_many(self, n_datasets, chunk=100, summary=False,
+                      reducers=None):
+        """Simulates n_datasets datasets, see simulate_chunks(). Without
+        reducers all chunks are returned together, as one array of datasets or
+        as the sample means and covariances of the datasets if summary is
+        True. reducers is a dictionary of functions reducer(value, chunk),
+        called for each chunk in turn with the value returned for the previous
+        chunk (None for the first one), which keeps the memory used
+        independent of n_datasets. The final value of each reducer is returned
+        under its key.
+
+        Example, the average sample covariance of 10000 datasets:
+
+            add_covariances = lambda value, chunk: chunk[1].sum(0) + \
+                                          (0 if value is None else value)
+            results = erp_model.simulate_many(10000, summary=True,
+                                    reducers={'covariance': add_covariances})
+            results['covariance'] / 10000
+        """
+        chunks = self.simulate_chunks(n_datasets, chunk, summary)
+        if reducers is None:
+            chunks = list(chunks)
+            if summary:
+                return (concatenate([means for means, covs in chunks]),
+                        concatenate([covs for means, covs in chunks]))
+            return concatenate(chunks)
+        results = dict((name, None) for name in reducers)
+        for data in chunks:
+            for name, reducer in reducers.items():
+                results[name] = reducer(results[name], data)
+        return results
+
+
     def recalculate_model(self):
-        self.up_to_date['lead field'] = False
-        self.up_to_date['mean'] = False
-        self.up_to_date['covariance generators'] = False
-        self.up_to_date['covariance'] = False
+        # Everything is calculated from scratch, including all columns of the
+        # lead field
+        self.up_to_date.invalidate_all()
+        self.lead_field_gen_array = None
         
         self.calculate_lead_field()
         self.calculate_mean()
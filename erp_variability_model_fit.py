@@ -1,8 +1,19 @@
-from numpy import zeros, pi
+from numpy import zeros, pi, inf, log, exp, dot, sum, diagonal, outer,\
+                  newaxis, concatenate
 from numpy.linalg import norm
 from scipy import optimize
 
 from erp_variability_model import ERP_Variability_Model
+from generator_configuration import GEN_CONF_PARAMETERS
+
+
+# Order of the parameters of each generator in set_parameters() and
+# get_parameters(), and where each of them is in GEN_CONF_PARAMETERS, the order
+# of the jacobian of the lead field
+FIT_GEN_PARAMETERS = ('depth', 'orientation', 'orientation_phi', 'phi',
+                      'theta')
+FIT_GEN_PARAMETER_INDICES = [GEN_CONF_PARAMETERS.index(parameter)
+                             for parameter in FIT_GEN_PARAMETERS]
 
 class ERP_Variability_Model_Fit(ERP_Variability_Model):
     """This class inherits all the functionality of ERP_Variability_Model and
@@ -13,11 +24,13 @@ class ERP_Variability_Model_Fit(ERP_Variability_Model):
     """
     def __init__(self, n_sub, n_gen, variability_electrodes='none',
                  variability_generators='none', 
-                 variability_connections='none'):
+                 variability_connections='none', lf=None,
+                 generator_parameterization='variance'):
         ERP_Variability_Model.__init__(self, n_sub, n_gen, 
                                        variability_electrodes,
                                        variability_generators,
-                                       variability_connections)
+                                       variability_connections, lf,
+                       generator_parameterization=generator_parameterization)
         
         # Parameter bounds for fitting
         self.magnitude_bounds = (0, None) # unnecessary?
@@ -29,6 +42,11 @@ class ERP_Variability_Model_Fit(ERP_Variability_Model):
         self.gen_variance_bounds = (None, None)
         self.gen_covariance_bounds = (None, None)
         self.el_variance_bounds = (None, None)
+        # With the log-Cholesky parameterization any values are valid
+        self.gen_cholesky_bounds = (None, None)
+        # Smallest electrode variance when fitting the likelihood, which needs
+        # a positive definite covariance
+        self.min_el_variance = 1e-6
 
 
     def set_random_parameters(self, parameter_list):
@@ -53,6 +71,11 @@ class ERP_Variability_Model_Fit(ERP_Variability_Model):
         * 'generator variance'
         * 'generator covariance'
         * 'electrode variance'
+
+        With generator_parameterization='log-cholesky', the generator
+        variance parameters are the logarithms of the diagonal of the Cholesky
+        factor of the generator covariance, and the generator covariance
+        parameters are the factor below the diagonal, see set_gen_cholesky().
         
         Example usage:
             
@@ -89,7 +112,13 @@ class ERP_Variability_Model_Fit(ERP_Variability_Model):
                     par += 1
             
             elif parameter_list[i] == 'generator variance':
-                if self.variability_generators == 'constant':
+                if self.generator_parameterization == 'log-cholesky':
+                    gen_cholesky = self.gen_cholesky.copy()
+                    for gen in range(self.n_gen):
+                        gen_cholesky[gen,gen] = exp(parameters[par])
+                        par += 1
+                    self.set_gen_cholesky(gen_cholesky)
+                elif self.variability_generators == 'constant':
                     self.sigma_g = parameters[par]
                     par += 1
                 elif self.variability_generators == 'individual':
@@ -97,7 +126,16 @@ class ERP_Variability_Model_Fit(ERP_Variability_Model):
                     par += self.n_gen
 
             elif parameter_list[i] == 'generator covariance':
-                if self.variability_connections == 'individual':
+                if self.variability_connections == 'individual' and\
+                   self.generator_parameterization == 'log-cholesky':
+                    gen_cholesky = self.gen_cholesky.copy()
+                    for row in range(self.n_gen):
+                        for col in range(self.n_gen):
+                            if row < col:
+                                gen_cholesky[col,row] = parameters[par]
+                                par += 1
+                    self.set_gen_cholesky(gen_cholesky)
+                elif self.variability_connections == 'individual':
                     self.sigma_c = zeros((self.n_gen, self.n_gen))
                     for row in range(self.n_gen):
                         for col in range(self.n_gen):
@@ -110,14 +148,14 @@ class ERP_Variability_Model_Fit(ERP_Variability_Model):
                 if self.variability_electrodes == 'constant':
                     self.sigma_e = parameters[par]
                     par += 1
-                elif self.variabiliy_electrodes == 'individual':
+                elif self.variability_electrodes == 'individual':
                     self.sigma_e = list(parameters[par : par + self.n_el])
                     par += self.n_el
-        
-        self.up_to_date['lead field'] = False
-        self.up_to_date['mean'] = False
-        self.up_to_date['covariance generators'] = False
-        self.up_to_date['covariance'] = False
+
+        # Only the results depending on the parameters that were set are out
+        # of date
+        for parameter_group in parameter_list:
+            self.up_to_date.invalidate(parameter_group)
 
 
     def get_parameters(self, parameter_list):
@@ -136,14 +174,23 @@ class ERP_Variability_Model_Fit(ERP_Variability_Model):
                     parameters.append(self.gen_conf[gen]['magnitude'])
             
             elif parameter_list[i] == 'generator variance':
-                if self.variability_generators == 'constant':
+                if self.generator_parameterization == 'log-cholesky':
+                    for gen in range(self.n_gen):
+                        parameters.append(log(self.gen_cholesky[gen,gen]))
+                elif self.variability_generators == 'constant':
                     parameters.append(self.sigma_g)
                 elif self.variability_generators == 'individual':
                     for j in range(len(self.sigma_g)):
                         parameters.append(self.sigma_g[j])
 
             elif parameter_list[i] == 'generator covariance':
-                if self.variability_connections == 'individual':
+                if self.variability_connections == 'individual' and\
+                   self.generator_parameterization == 'log-cholesky':
+                    for row in range(self.n_gen):
+                        for col in range(self.n_gen):
+                            if row < col:
+                                parameters.append(self.gen_cholesky[col,row])
+                elif self.variability_connections == 'individual':
                     for row in range(self.n_gen):
                         for col in range(self.n_gen):
                             if row < col:
@@ -158,7 +205,27 @@ class ERP_Variability_Model_Fit(ERP_Variability_Model):
 
         return parameters
 
-    def get_bounds(self, parameter_list):
+    def get_bounds(self, parameter_list, positive_definite=False):
+        """Bounds of the parameters in parameter_list. If positive_definite is
+        True, the lower bounds of the variances are raised so that the
+        covariance is positive definite, at least for zero generator
+        covariances. The log-Cholesky parameterization of the generator
+        covariance is positive definite for any parameters."""
+        gen_variance_bounds = self.gen_variance_bounds
+        gen_covariance_bounds = self.gen_covariance_bounds
+        el_variance_bounds = self.el_variance_bounds
+        if self.generator_parameterization == 'log-cholesky':
+            gen_variance_bounds = self.gen_cholesky_bounds
+            gen_covariance_bounds = self.gen_cholesky_bounds
+        elif positive_definite:
+            if gen_variance_bounds[0] is None or gen_variance_bounds[0] < 0:
+                gen_variance_bounds = (0, gen_variance_bounds[1])
+        if positive_definite:
+            if el_variance_bounds[0] is None or\
+               el_variance_bounds[0] < self.min_el_variance:
+                el_variance_bounds = (self.min_el_variance,
+                                      el_variance_bounds[1])
+
         bounds = []
         for i in range(len(parameter_list)):
             if parameter_list[i] == 'locations and orientations':
@@ -175,29 +242,29 @@ class ERP_Variability_Model_Fit(ERP_Variability_Model):
         
             if parameter_list[i] == 'generator variance':
                 if self.variability_generators == 'constant':
-                    bounds.append(self.gen_variance_bounds)
+                    bounds.append(gen_variance_bounds)
                 elif self.variability_generators == 'individual':
                     for j in range(self.n_gen):
-                        bounds.append(self.gen_variance_bounds)
+                        bounds.append(gen_variance_bounds)
 
             if parameter_list[i] == 'generator covariance':
                 if self.variability_connections == 'individual':
                     for j in range(self.n_gen*(self.n_gen-1)/2):
-                        bounds.append(self.gen_covariance_bounds)
+                        bounds.append(gen_covariance_bounds)
 
             if parameter_list[i] == 'electrode variance':
                 if self.variability_electrodes == 'constant':
-                    bounds.append(self.el_variance_bounds)
+                    bounds.append(el_variance_bounds)
                 if self.variability_electrodes == 'individual':
                     for j in range(len(self.sigma_e)):
-                        bounds.append(self.el_variance_bounds)
+                        bounds.append(el_variance_bounds)
 
         return bounds
 
 
 def error_mean(mean_data, erp_model, parameter_list, parameters):
     erp_model.set_parameters(parameter_list, parameters)
-    erp_model.calculate_mean()
+    if not erp_model.up_to_date['mean']: erp_model.calculate_mean()
     error = mean_data - erp_model.mean
     error = norm(error, 2)
     return error
@@ -205,7 +272,7 @@ def error_mean(mean_data, erp_model, parameter_list, parameters):
 
 def error_cov(cov_data, erp_model, parameter_list, parameters):
     erp_model.set_parameters(parameter_list, parameters)
-    erp_model.calculate_cov()
+    if not erp_model.up_to_date['covariance']: erp_model.calculate_cov()
     error = cov_data - erp_model.cov
     error = norm(error.reshape((erp_model.n_el**2,1)), 2)
     return error
@@ -220,8 +287,8 @@ def error_mean_and_cov(mean_data, cov_data, erp_model, parameter_list,
     errors.
     """
     erp_model.set_parameters(parameter_list, parameters)
-    erp_model.calculate_mean()
-    erp_model.calculate_cov()
+    if not erp_model.up_to_date['mean']: erp_model.calculate_mean()
+    if not erp_model.up_to_date['covariance']: erp_model.calculate_cov()
     
     error_mean = mean_data - erp_model.mean
     error_mean = norm(error_mean, 2)
@@ -234,6 +301,135 @@ def error_mean_and_cov(mean_data, cov_data, erp_model, parameter_list,
     return error
 
 
+def check_likelihood_gradient(erp_model, parameter_list):
+    """The gradient of the likelihood with respect to locations and
+    orientations uses the jacobian of the directly calculated lead field, see
+    Lead_Field.calculate_with_jacobian(). Raises a ValueError if the lead field
+    of erp_model is calculated otherwise, so that the gradient would not be
+    that of the likelihood.
+    """
+    if 'locations and orientations' not in parameter_list:
+        return
+    lf = erp_model.lf
+    if lf.method != 'direct':
+        raise ValueError('The gradient of the likelihood with respect to ' +
+                         'locations and orientations needs a lead field ' +
+                         "with method='direct', not '" + lf.method + "'")
+    if lf.cache_quantization is not None:
+        raise ValueError('The gradient of the likelihood with respect to ' +
+                         'locations and orientations needs a lead field ' +
+                         'without cache_quantization')
+    if lf.model == 'frank_1952':
+        raise ValueError('The gradient of the likelihood with respect to ' +
+                         'locations and orientations is not available for ' +
+                         'the frank_1952 model')
+
+
+def error_likelihood(data, erp_model, parameter_list, parameters,
+                     gradient=False):
+    """
+    Negative log-likelihood of data, of shape (n_sub, n_el), under the
+    multivariate normal distribution of the model. With the covariance
+    S = L C L^T + D kept factored (see covariance.Low_Rank_Covariance), the
+    log-determinant and all solves cost O(n_el n_gen^2) through the matrix
+    determinant lemma and the Woodbury identity, so no n_el x n_el matrix is
+    formed. This needs a model without a reference and with positive electrode
+    variances. Parameters for which the covariance is not positive definite
+    have an infinite error, see get_bounds() for keeping the variances away
+    from those.
+
+    If gradient is True, the exact gradient with respect to parameters is
+    returned as well. With residuals R = data - mean, A = S^-1 R^T and
+    W = n_sub S^-1 - A A^T, the derivative for a change dS of the covariance is
+    tr(W dS) / 2 and for a change dmean of the mean -1^T A^T dmean. The
+    gradient with respect to locations and orientations needs a lead field
+    calculated directly, see check_likelihood_gradient().
+    """
+    if erp_model.lf.reference_weights is not None:
+        raise ValueError('The likelihood of re-referenced data is not defined')
+    if gradient:
+        check_likelihood_gradient(erp_model, parameter_list)
+    erp_model.set_parameters(parameter_list, parameters)
+    if not erp_model.up_to_date['mean']: erp_model.calculate_mean()
+    if not erp_model.up_to_date['covariance']: erp_model.calculate_cov()
+    covariance = erp_model.covariance
+    n_sub, n_el = data.shape
+
+    try:
+        log_determinant = covariance.log_determinant()
+    except ValueError:
+        if gradient:
+            return inf, zeros(len(parameters))
+        return inf
+    residuals = data - erp_model.mean
+    solved = covariance.solve(residuals.T)
+    error = (n_sub * log_determinant + sum(residuals.T * solved) +
+             n_sub * n_el * log(2 * pi)) / 2
+    if not gradient:
+        return error
+
+    lead_field = erp_model.lead_field
+    # S^-1 L, L^T A and L^T W L, the parts of the gradient for everything
+    # acting through the lead field
+    solved_lead_field = covariance.solve(lead_field)
+    projected = dot(lead_field.T, solved)
+    lead_field_w = n_sub * solved_lead_field.T - dot(projected, solved.T)
+    w_gen = dot(lead_field_w, lead_field)
+    residual_sum = sum(solved, 1)
+    if erp_model.generator_parameterization == 'log-cholesky':
+        # With C = G G^T, tr(W dC) / 2 = tr(W G dG^T), so the gradient with
+        # respect to the factor G is W G, times G_ii for its log-diagonal
+        w_cholesky = dot(w_gen, erp_model.gen_cholesky)
+
+    gradients = []
+    for parameter_group in parameter_list:
+        if parameter_group == 'locations and orientations':
+            # Each parameter moves one column of the lead field, dL = j e_k^T,
+            # changing the mean by j a_k and the covariance by
+            # j e_k^T C L^T + L C e_k j^T
+            jacobian = erp_model.lf.calculate_with_jacobian(
+                                                    erp_model.gen_conf)[1]
+            amplitudes = [gen['magnitude'] for gen in erp_model.gen_conf]
+            weights = dot(erp_model.cov_gen, lead_field_w).T -\
+                      outer(residual_sum, amplitudes)
+            gen_gradient = sum(jacobian * weights[:,:,newaxis], 0)
+            gradients.append(gen_gradient[:,FIT_GEN_PARAMETER_INDICES].ravel())
+
+        elif parameter_group == 'amplitudes':
+            gradients.append(-dot(lead_field.T, residual_sum))
+
+        elif parameter_group == 'generator variance':
+            if erp_model.generator_parameterization == 'log-cholesky':
+                gradients.append(diagonal(w_cholesky) *
+                                 diagonal(erp_model.gen_cholesky))
+            elif erp_model.variability_generators == 'constant':
+                gradients.append([sum(diagonal(w_gen)) / 2])
+            elif erp_model.variability_generators == 'individual':
+                gradients.append(diagonal(w_gen) / 2)
+
+        elif parameter_group == 'generator covariance':
+            if erp_model.variability_connections == 'individual' and\
+               erp_model.generator_parameterization == 'log-cholesky':
+                gradients.append([w_cholesky[col,row]
+                                  for row in range(erp_model.n_gen)
+                                  for col in range(erp_model.n_gen)
+                                  if row < col])
+            elif erp_model.variability_connections == 'individual':
+                gradients.append([w_gen[row,col]
+                                  for row in range(erp_model.n_gen)
+                                  for col in range(erp_model.n_gen)
+                                  if row < col])
+
+        elif parameter_group == 'electrode variance':
+            w_el = n_sub * covariance.inverse_diagonal() - sum(solved**2, 1)
+            if erp_model.variability_electrodes == 'constant':
+                gradients.append([sum(w_el) / 2])
+            elif erp_model.variability_electrodes == 'individual':
+                gradients.append(w_el / 2)
+
+    return error, concatenate(gradients)
+
+
 def fit_variability_model(erp_model, parameter_list, fit_to, fit_data,
                           method='tnc', bounds=True, max_fun_eval=100, 
                           disp=True):
@@ -248,28 +444,42 @@ def fit_variability_model(erp_model, parameter_list, fit_to, fit_data,
         fn = lambda parameters: error_mean_and_cov(fit_data[0], fit_data[1], 
                                                    erp_model, parameter_list,
                                                    parameters)
+
+    # Fitting to the subject data itself, of shape (n_sub, n_el), with the
+    # exact gradient of the likelihood
+    if fit_to == 'likelihood':
+        check_likelihood_gradient(erp_model, parameter_list)
+        fn = lambda parameters: error_likelihood(fit_data, erp_model,
+                                                 parameter_list, parameters,
+                                                 gradient=True)
+        error = lambda parameters: error_likelihood(fit_data, erp_model,
+                                                    parameter_list, parameters)
+    else:
+        error = fn
     
     if bounds:
-        parameter_bounds = erp_model.get_bounds(parameter_list)
+        parameter_bounds = erp_model.get_bounds(parameter_list,
+                                                positive_definite=(fit_to ==
+                                                               'likelihood'))
     else:
         parameter_bounds = None
     
     initial_parameters = erp_model.get_parameters(parameter_list)
-    start_error = fn(initial_parameters)
+    start_error = error(initial_parameters)
     if disp: print('* Starting error: ' + str(start_error))
 
     if method == 'tnc':
         output = optimize.fmin_tnc(fn, initial_parameters,
                                    bounds=parameter_bounds,
                                    maxfun=max_fun_eval, disp=5,
-                                   approx_grad=True)
+                                   approx_grad=(fit_to != 'likelihood'))
         if disp: print('* After ' + str(output[1]) + ' iterations, the TNC ' +\
                        'algorithm returned: ' +\
                        optimize.tnc.RCSTRINGS[output[2]])
     
     erp_model.recalculate_model()
     
-    end_error = fn(erp_model.get_parameters(parameter_list))
+    end_error = error(erp_model.get_parameters(parameter_list))
     if disp: print('* Final error: ' + str(end_error))
     
     return [output, start_error, end_error]
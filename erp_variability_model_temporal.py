@@ -0,0 +1,222 @@
+from numpy import asarray, array, zeros, empty, dot, exp, arange
+from numpy.linalg import lstsq, solve
+from numpy.random import uniform
+
+from erp_variability_model import ERP_Variability_Model, MODEL_DEPENDENCIES
+from covariance import Low_Rank_Covariance
+
+
+# The mean is calculated from the source waveforms instead of the amplitudes
+TEMPORAL_MODEL_DEPENDENCIES = dict(MODEL_DEPENDENCIES,
+                                   mean=('lead field', 'waveforms'))
+
+
+class ERP_Variability_Model_Temporal(ERP_Variability_Model):
+    """Time-resolved version of ERP_Variability_Model for epochs of n_times
+    samples, e.g. those of read_danieles_data(time_window=False). Each
+    generator has a source waveform, a row of self.waveforms of shape
+    (n_gen, n_times), and the mean epoch self.mean = L S, of shape
+    (n_el, n_times), is calculated for all samples with one matrix product.
+
+    The epoch is divided into windows, (start, stop) ranges of samples that
+    cover it in order, by default a single window. The generator variances and
+    covariances are set per window: self.sigma_g and self.sigma_c are lists
+    with the values for each window, each in the same form as in
+    ERP_Variability_Model. The electrode variance is the same in all windows.
+    Deviations from the mean are independent between samples, those of the
+    samples in window w have the covariance L C_w L^T + sigma_e, kept factored
+    in self.covariances[w]. All windows share the one lead field.
+    """
+    dependencies = TEMPORAL_MODEL_DEPENDENCIES
+
+    def __init__(self, n_sub, n_gen, n_times, windows=None,
+                 variability_electrodes='none', variability_generators='none',
+                 variability_connections='none', lf=None, montage=None,
+                 channels=None):
+        if windows is None:
+            windows = [(0, n_times)]
+        windows = [tuple(window) for window in windows]
+        starts = [start for start, stop in windows]
+        stops = [stop for start, stop in windows]
+        if starts[0] != 0 or stops[-1] != n_times or starts[1:] != stops[:-1]\
+           or any(start >= stop for start, stop in windows):
+            raise ValueError('The windows must cover all samples in order')
+        self.n_times = n_times
+        self.windows = windows
+        self.n_windows = len(windows)
+
+        ERP_Variability_Model.__init__(self, n_sub, n_gen,
+                                       variability_electrodes,
+                                       variability_generators,
+                                       variability_connections, lf, montage,
+                                       channels)
+        self.waveforms = zeros((self.n_gen, n_times))
+        self.sigma_g = [zeros(self.n_gen) for window in windows]
+        self.sigma_c = [zeros((self.n_gen, self.n_gen)) for window in windows]
+
+
+    def set_parameter_limits(self):
+        ERP_Variability_Model.set_parameter_limits(self)
+        # Width of the peak of random waveforms, in samples
+        self.limits['waveform_width'] = (2, 20)
+
+
+    def set_random(self):
+        self.set_random_locations_orientations()
+        self.set_random_waveforms()
+        self.set_random_variability()
+
+
+    def set_waveforms(self, waveforms):
+        waveforms = asarray(waveforms, dtype=float)
+        if waveforms.shape != (self.n_gen, self.n_times):
+            raise ValueError('The waveforms must be of shape (n_gen, n_times)')
+        self.waveforms = waveforms
+        self.up_to_date.invalidate('waveforms')
+
+
+    def set_random_waveforms(self):
+        """A single Gaussian peak for each generator, with amplitude, latency
+        and width drawn uniformly from the limits."""
+        amplitudes = uniform(*self.limits['magnitude'], size=(self.n_gen, 1))
+        latencies = uniform(0, self.n_times, (self.n_gen, 1))
+        widths = uniform(*self.limits['waveform_width'], size=(self.n_gen, 1))
+        self.set_waveforms(amplitudes * exp(-(arange(self.n_times) -
+                                              latencies)**2 / (2 * widths**2)))
+
+
+    def set_random_variability_generators(self):
+        sigma_g = []
+        for window in self.windows:
+            ERP_Variability_Model.set_random_variability_generators(self)
+            sigma_g.append(self.sigma_g)
+        self.sigma_g = sigma_g
+
+
+    def set_random_variability_connections(self):
+        # The covariances of each window are limited by its variances
+        sigma_g = self.sigma_g
+        sigma_c = []
+        for window_sigma_g in sigma_g:
+            self.sigma_g = window_sigma_g
+            ERP_Variability_Model.set_random_variability_connections(self)
+            sigma_c.append(self.sigma_c)
+        self.sigma_g = sigma_g
+        self.sigma_c = sigma_c
+
+
+    def calculate_mean(self):
+        if not self.up_to_date['lead field']: self.calculate_lead_field()
+
+        self.mean = dot(self.lead_field, self.waveforms)
+
+        self.up_to_date.validate('mean')
+
+        return self.mean
+
+
+    def calculate_cov_gen(self):
+        self.cov_gen = array([self.generator_covariance(sigma_g, sigma_c)
+                              for sigma_g, sigma_c in zip(self.sigma_g,
+                                                          self.sigma_c)])
+
+        self.up_to_date.validate('covariance generators')
+
+        return self.cov_gen
+
+
+    def calculate_cov(self):
+        if not self.up_to_date['lead field']: self.calculate_lead_field()
+        if not self.up_to_date['covariance generators']:
+            self.calculate_cov_gen()
+
+        self.covariances = [Low_Rank_Covariance(self.lead_field, cov_gen,
+                                                self.sigma_e,
+                                                self.lf.reference_weights)
+                            for cov_gen in self.cov_gen]
+        self.__dict__.pop('cov', None)
+
+        self.up_to_date.validate('covariance')
+
+        return self.covariances
+
+
+    def __getattr__(self, name):
+        # The dense covariance matrices of all windows, of shape
+        # (n_windows, n_el, n_el), on first use
+        if name == 'cov' and 'covariances' in self.__dict__:
+            self.cov = array([covariance.dense()
+                              for covariance in self.covariances])
+            return self.cov
+        raise AttributeError(name)
+
+
+    def sample_epochs(self, n_epochs):
+        """n_epochs epochs drawn from the model, of shape
+        (n_epochs, n_el, n_times). The samples of each window are drawn
+        together in one call."""
+        epochs = empty((n_epochs, self.n_el, self.n_times))
+        for (start, stop), covariance in zip(self.windows, self.covariances):
+            samples = covariance.sample(n_epochs * (stop - start))
+            epochs[:,:,start:stop] = samples.reshape((n_epochs, stop - start,
+                                                      self.n_el)).\
+                                             transpose((0,2,1))
+        epochs += self.mean
+        return epochs
+
+
+    def simulate(self):
+        """Epochs of all subjects, of shape (n_sub, n_el, n_times)."""
+        if not self.up_to_date['mean']: self.calculate_mean()
+        if not self.up_to_date['covariance']: self.calculate_cov()
+        self.data = self.sample_epochs(self.n_sub)
+        return self.data
+
+
+    def simulate_chunks(self, n_datasets, chunk=100, summary=False):
+        """Generates n_datasets simulated datasets of n_sub subjects each, in
+        chunks of up to chunk datasets, arrays of shape
+        (chunk, n_sub, n_el, n_times), see
+        ERP_Variability_Model.simulate_chunks(). The summary of each dataset
+        by a single sample covariance is not defined for epochs, whose
+        covariance differs between windows, so summary must be False.
+        """
+        if summary:
+            raise ValueError('Summaries of simulated datasets are not ' +
+                             'defined for the temporal model')
+        return self.generate_chunks(n_datasets, chunk, summary)
+
+
+    def generate_chunks(self, n_datasets, chunk, summary):
+        if not self.up_to_date['mean']: self.calculate_mean()
+        if not self.up_to_date['covariance']: self.calculate_cov()
+        for start in range(0, n_datasets, chunk):
+            n_chunk = min(chunk, n_datasets - start)
+            yield self.sample_epochs(n_chunk * self.n_sub).\
+                    reshape((n_chunk, self.n_sub, self.n_el, self.n_times))
+
+
+    def solve_waveforms(self, mean_data, weighted=False):
+        """Least squares waveforms for the current locations and orientations
+        given a mean epoch mean_data, of shape (n_el, n_times), solved for all
+        samples at once. If weighted is True, the samples of each window are
+        weighted by the inverse of its covariance (generalized least squares),
+        which needs a model without a reference. The waveforms are set and
+        returned.
+        """
+        if not self.up_to_date['lead field']: self.calculate_lead_field()
+        mean_data = asarray(mean_data, dtype=float)
+        if not weighted:
+            waveforms = lstsq(self.lead_field, mean_data, rcond=None)[0]
+        else:
+            if not self.up_to_date['covariance']: self.calculate_cov()
+            waveforms = empty((self.n_gen, self.n_times))
+            for (start, stop), covariance in zip(self.windows,
+                                                 self.covariances):
+                solved_lead_field = covariance.solve(self.lead_field)
+                waveforms[:,start:stop] = solve(
+                                    dot(self.lead_field.T, solved_lead_field),
+                                    dot(solved_lead_field.T,
+                                        mean_data[:,start:stop]))
+        self.set_waveforms(waveforms)
+        return self.waveforms
@@ -10,6 +10,12 @@ from numpy import pi, array, max, min, mean, power, sqrt
 from numpy.random import randint, uniform
 
 
+# Order in which the parameters of each generator are stored when a generator
+# configuration is represented as an array rather than a list of dictionaries.
+GEN_CONF_PARAMETERS = ('depth', 'theta', 'phi', 'orientation',
+                       'orientation_phi')
+
+
 def random_generator_placement(limits={'n_gen':(1,5),'depth':(4.49,7.05),
                                        'theta':(0,pi/2),'phi':(0,2*pi),
                                        'orientation':(0,pi/2),
@@ -36,3 +42,21 @@ def random_generator_placement(limits={'n_gen':(1,5),'depth':(4.49,7.05),
     return gen_conf
 
 
+def gen_conf_to_array(gen_conf):
+    """Converts a list of generator dictionaries into an array of shape
+    (n_gen, 5), with the columns ordered as in GEN_CONF_PARAMETERS. Arrays in
+    this format can be stacked to calculate many lead fields at once.
+    """
+    gen_array = array([[gen[parameter] for parameter in GEN_CONF_PARAMETERS]
+                       for gen in gen_conf], dtype=float)
+    return gen_array.reshape((len(gen_conf), len(GEN_CONF_PARAMETERS)))
+
+
+def array_to_gen_conf(gen_array):
+    """The inverse of gen_conf_to_array(), magnitudes are set to 0."""
+    gen_conf = []
+    for gen_parameters in gen_array:
+        gen_conf.append(dict(zip(GEN_CONF_PARAMETERS,
+                                 [float(p) for p in gen_parameters])))
+        gen_conf[-1]['magnitude'] = 0
+    return gen_conf
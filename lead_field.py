@@ -7,16 +7,51 @@ below to indicate which part of the code does which calculation.
 
 from __future__ import division
 
-import sys
+from collections import OrderedDict
 
 from numpy import arange, array, ones, identity, dot, zeros, sin, cos, pi,\
-                  sqrt, sum, arccos, transpose, newaxis, tensordot
-from numpy.linalg import norm
-from scipy.spatial.distance import cdist
+                  sqrt, sum, arccos, transpose, newaxis, tensordot, empty,\
+                  asarray, around, arcsin
+from numpy import linspace, ceil, prod, floor, minimum, mod, swapaxes, mean,\
+                  save, savez, load, broadcast, multiply, subtract, divide,\
+                  exp, log, concatenate, expand_dims
+from numpy.linalg import norm, lstsq
+from scipy import optimize
+from numpy.random import RandomState
+from itertools import product
+from multiprocessing.pool import ThreadPool
+from os.path import exists
+from threading import local
 
-sys.path.insert(0, 'old/scalingproject')
-sys.path.insert(0, 'old/src')
-from topographicmap import read_electrode_locations
+from generator_configuration import GEN_CONF_PARAMETERS, gen_conf_to_array
+from montage import get_montage, read_only, Channel_Index
+
+
+# Dipole locations and orientations covered by Lead_Field_Grid by default, the
+# same as the limits of ERP_Variability_Model
+GRID_LIMITS = {'depth': (4.49,7.05), 'theta': (0,pi/2), 'phi': (0,2*pi),
+               'orientation': (0,pi/2), 'orientation_phi': (0,2*pi)}
+# Head models implemented by calculate_field_vector()
+MODELS = ('brody_1973', 'berg_scherg', 'infinite', 'frank_1952')
+# Shells of multi-shell head models, from the innermost to the outermost shell,
+# given as (radius, conductivity) pairs with radii as fractions of the radius
+# of the head and conductivities in S/m. Three shells (brain, skull, scalp)
+# after Rush and Driscoll (1969), four shells (brain, CSF, skull, scalp) as
+# commonly used with the Berg and Scherg approximation.
+THREE_SHELLS = ((0.87, 0.33), (0.92, 0.0042), (1.0, 0.33))
+FOUR_SHELLS = ((0.835, 0.33), (0.847, 1.0), (0.929, 0.0042), (1.0, 0.33))
+# Magnitudes and eccentricities of Berg dipoles already fitted by
+# fit_berg_scherg(), for each set of shells
+BERG_SCHERG_PARAMETERS = {}
+# Number of values per electrode and dipole combination in the work arrays of
+# calculate_field_vector_brody_1973()
+BRODY_1973_WORK_SIZE = 16
+# There are no mastoid electrodes in the montage, so, as in ScalingExperiment,
+# the closest electrodes stand in for the left and right mastoids
+MASTOIDS = ('T7', 'T8')
+# Entries of the validation report of Lead_Field_Grid saved along with the grid
+GRID_REPORT = ('number of dipoles', 'max absolute error', 'max relative error',
+               'rms relative error')
 
 
 def calculate_lead_field(gen_conf):
@@ -28,122 +63,1194 @@ def calculate_lead_field(gen_conf):
     radius, xyz_el = initialize_electrode_locations()
     return calculate_lead_field_given_electrodes(gen_conf, radius, xyz_el)
 
-def initialize_electrode_locations():
-    """Reads in electrode locations and transforms them to xyz coordinates, so
-    that this isn't unnecessarily repeated in the main lead_field calculation
-    function if not strictly necessary.
-    """
-    # Setting the radius of the head to 11.5 cm
-    radius = 11.5
-
-    # Reading in electrode locations from external file electrodeLocations.elp
-    [el, el_x, el_y, el_thetas, el_phis] = read_electrode_locations()
-    
-    # How many electrodes do we have?
-    n_el = len(el)
-    
-    # Coordinates of the electrodes (in the frame of reference associated with
-    # the center of the head)
-    xyz_el = zeros((n_el,3))
-    for i_el in range(n_el):
-        # Calculating the coordinates of the electrode in the Cartesian coordinates associated with the head
-        # The X axis points towards the right ear, while the Y axis points towards the front
-        el_theta = el_thetas[i_el]
-        el_phi = el_phis[i_el]
-        xyz_el[i_el,0] = radius * sin(el_theta) * cos(el_phi);
-        xyz_el[i_el,1] = radius * sin(el_theta) * sin(el_phi);
-        xyz_el[i_el,2] = radius * cos(el_theta);
-
-    return radius, xyz_el
-
-def calculate_lead_field_given_electrodes(gen_conf, radius, xyz_el):
-    """Actual calculation of lead field."""
+def initialize_electrode_locations(file_name=None):
+    """Returns the radius of the head and the xyz coordinates of the
+    electrodes (in the frame of reference associated with the center of the
+    head), so that this isn't unnecessarily repeated in the main lead_field
+    calculation function if not strictly necessary.
+
+    The electrode locations are read from the montage registry, see
+    montage.get_montage(), so xyz_el is shared and read-only.
+    """
+    montage = get_montage(file_name)
+    return montage.radius, montage.xyz
+
+def calculate_lead_field_given_electrodes(gen_conf, radius, xyz_el,
+                                         model='brody_1973', shells=None):
+    """Actual calculation of lead field for a single generator configuration
+    given as a list of generator dictionaries. The calculation itself is done
+    by calculate_lead_field_batch(), with a batch of one configuration.
+    """
+    gen_array = gen_conf_to_array(gen_conf)
+    return calculate_lead_field_batch(gen_array[newaxis], radius, xyz_el,
+                                      model, shells)[0]
+
+def calculate_lead_field_batch(gen_arrays, radius, xyz_el, model='brody_1973',
+                               shells=None):
+    """Calculates the lead fields of a whole stack of generator configurations
+    in one vectorized pass. gen_arrays has shape (n_configs, n_gen, 5), with the
+    parameters of each generator ordered as in GEN_CONF_PARAMETERS (see
+    gen_conf_to_array()), and the returned lead fields have shape
+    (n_configs, n_el, n_gen). See calculate_field_vector() for the available
+    head models.
+
+    The orientations are rotated without the matrix product of the original
+    calculation of one configuration at a time, so the lead fields are not
+    bitwise equal to those of the original, but agree with them to within
+    1e-15 relative to the largest value of the lead field.
+    """
+    gen_arrays = asarray(gen_arrays, dtype=float)
+    xyz_dipole, xyz_orientation = calculate_dipoles(gen_arrays, radius)
+    field_vector = calculate_field_vector(xyz_dipole, radius, xyz_el, model,
+                                          shells)
+    return sum(field_vector * xyz_orientation[...,newaxis,:,:], -1)
+
+def calculate_lead_field_subjects(gen_arrays, radii, xyz_el,
+                                  model='brody_1973', shells=None,
+                                  max_memory=None, n_threads=1):
+    """Calculates the lead fields of subjects with different head radii and
+    electrode locations in one batched call. radii has shape (n_sub,) and
+    xyz_el, the electrodes on the heads of these radii, has shape
+    (n_sub, n_el, 3). gen_arrays has shape (n_gen, 5), the same generators
+    for all subjects, or (n_sub, n_gen, 5), with depths in cm. The lead fields
+    have shape (n_sub, n_el, n_gen).
+
+    All head models scale with the size of the head: scaling all lengths by s
+    scales the lead field by 1 / s**2. The heads of all subjects are
+    therefore scaled to the unit sphere and calculated together, as one stack
+    of configurations, with calculate_lead_field_batch() or, if max_memory is
+    given, calculate_lead_field_blocked().
+    """
+    radii = asarray(radii, dtype=float)
+    scaled_gen_arrays = asarray(gen_arrays, dtype=float) *\
+                        ones((len(radii), 1, 1))
+    scaled_gen_arrays[...,0] /= radii[:,newaxis]
+    scaled_xyz_el = asarray(xyz_el, dtype=float) / radii[:,newaxis,newaxis]
+    if max_memory is not None:
+        lead_fields = calculate_lead_field_blocked(scaled_gen_arrays, 1.0,
+                                    scaled_xyz_el, max_memory, n_threads,
+                                    model, shells)
+    else:
+        lead_fields = calculate_lead_field_batch(scaled_gen_arrays, 1.0,
+                                                 scaled_xyz_el, model, shells)
+    return lead_fields / radii[:,newaxis,newaxis]**2
+
+def project_field_vector(field_vector, gen_arrays, radius):
+    """Projects field vectors of shape (..., n_el, n_gen, 3), calculated for the
+    locations of the generators only, on the orientations of the generators in
+    gen_arrays, which gives the lead field. This is cheap compared to the field
+    vector itself, so it can be repeated when only orientations change.
+    """
+    gen_arrays = asarray(gen_arrays, dtype=float)
+    xyz_orientation = calculate_dipoles(gen_arrays, radius)[1]
+    return sum(field_vector * xyz_orientation[...,newaxis,:,:], -1)
+
+def calculate_lead_field_and_jacobian_given_electrodes(gen_conf, radius,
+                                                       xyz_el,
+                                                       model='brody_1973',
+                                                       shells=None):
+    """Lead field of a single generator configuration together with its
+    jacobian, see calculate_lead_field_and_jacobian_batch().
+    """
+    gen_array = gen_conf_to_array(gen_conf)
+    lead_field, jacobian = calculate_lead_field_and_jacobian_batch(
+                        gen_array[newaxis], radius, xyz_el, model, shells)
+    return lead_field[0], jacobian[0]
+
+def calculate_lead_field_and_jacobian_batch(gen_arrays, radius, xyz_el,
+                                            model='brody_1973', shells=None):
+    """Calculates the lead fields of a stack of generator configurations
+    together with their closed-form derivatives with respect to the parameters
+    of each generator. The lead fields have shape (n_configs, n_el, n_gen) and
+    the jacobians have shape (n_configs, n_el, n_gen, 5), where the last axis
+    is ordered as in GEN_CONF_PARAMETERS. Each generator only influences its
+    own column of the lead field, so these are all the non-zero derivatives.
+    """
+    gen_arrays = asarray(gen_arrays, dtype=float)
+    xyz_dipole, xyz_orientation, d_xyz_dipole, d_xyz_orientation = \
+            calculate_dipoles(gen_arrays, radius, derivatives=True)
+    field_vector, gradient = calculate_field_vector(xyz_dipole, radius, xyz_el,
+                                            model, shells, xyz_orientation)
+    lead_field = sum(field_vector * xyz_orientation[...,newaxis,:,:], -1)
+
+    # Chain rule: each parameter moves the dipole, which changes the lead field
+    # through the gradient, and rotates the orientation, which changes the
+    # lead field through the field vector.
+    jacobian = sum(gradient[...,newaxis,:] *\
+                   d_xyz_dipole[...,newaxis,:,:,:], -1)
+    jacobian += sum(field_vector[...,newaxis,:] *\
+                    d_xyz_orientation[...,newaxis,:,:,:], -1)
+
+    return lead_field, jacobian
+
+def calculate_dipoles(gen_arrays, radius, derivatives=False):
+    """Coordinates of each dipole in the frame of reference associated with the
+    head and the orientation of each dipole rotated from the frame of reference
+    associated with the dipole to one with axes parallel to the head frame of
+    reference. Both are returned as arrays of shape (..., n_gen, 3).
+
+    If derivatives is True, the derivatives of both with respect to the
+    parameters of the generators are returned as well, as arrays of shape
+    (..., n_gen, 5, 3) ordered as in GEN_CONF_PARAMETERS.
+    """
+    # Calculating the coordinates of the dipoles in the Cartesian coordinates
+    # associated with the head
+    dipole_radius = radius - gen_arrays[...,0]
+    cos_dipole_theta = cos(gen_arrays[...,1])
+    sin_dipole_theta = sin(gen_arrays[...,1])
+    cos_dipole_phi = cos(gen_arrays[...,2])
+    sin_dipole_phi = sin(gen_arrays[...,2])
+    xyz_dipole = empty(gen_arrays.shape[:-1] + (3,))
+    xyz_dipole[...,0] = dipole_radius * sin_dipole_theta * cos_dipole_phi
+    xyz_dipole[...,1] = dipole_radius * sin_dipole_theta * sin_dipole_phi
+    xyz_dipole[...,2] = dipole_radius * cos_dipole_theta
+
+    # The orientation vectors in the dipole frame of reference
+    cos_orientation_theta = cos(gen_arrays[...,3])
+    sin_orientation_theta = sin(gen_arrays[...,3])
+    cos_orientation_phi = cos(gen_arrays[...,4])
+    sin_orientation_phi = sin(gen_arrays[...,4])
+    x_rotated = sin_orientation_theta * cos_orientation_phi
+    y_rotated = sin_orientation_theta * sin_orientation_phi
+    z_rotated = cos_orientation_theta
+
+    # Rotating the orientations to the translated dipole coordinates, written
+    # out row by row of the rotation matrix:
+    #     [ sin(phi), cos(theta) cos(phi), sin(theta) cos(phi)]
+    #     [-cos(phi), cos(theta) sin(phi), sin(theta) sin(phi)]
+    #     [        0,         -sin(theta),          cos(theta)]
+    def rotate(x, y, z):
+        xyz = empty(gen_arrays.shape[:-1] + (3,))
+        xyz[...,0] = sin_dipole_phi * x +\
+                cos_dipole_theta * cos_dipole_phi * y +\
+                sin_dipole_theta * cos_dipole_phi * z
+        xyz[...,1] = -cos_dipole_phi * x +\
+                cos_dipole_theta * sin_dipole_phi * y +\
+                sin_dipole_theta * sin_dipole_phi * z
+        xyz[...,2] = -sin_dipole_theta * y +\
+                cos_dipole_theta * z
+        return xyz
+
+    xyz_orientation = rotate(x_rotated, y_rotated, z_rotated)
+
+    if not derivatives:
+        return xyz_dipole, xyz_orientation
+
+    d_xyz_dipole = zeros(gen_arrays.shape[:-1] + (5,3))
+    d_xyz_orientation = zeros(gen_arrays.shape[:-1] + (5,3))
+
+    # Depth
+    d_xyz_dipole[...,0,:] = -xyz_dipole / dipole_radius[...,newaxis]
+
+    # Theta, moves the dipole and rotates its frame of reference
+    d_xyz_dipole[...,1,0] = dipole_radius * cos_dipole_theta * cos_dipole_phi
+    d_xyz_dipole[...,1,1] = dipole_radius * cos_dipole_theta * sin_dipole_phi
+    d_xyz_dipole[...,1,2] = -dipole_radius * sin_dipole_theta
+    d_xyz_orientation[...,1,0] = -sin_dipole_theta * cos_dipole_phi *\
+            y_rotated + cos_dipole_theta * cos_dipole_phi * z_rotated
+    d_xyz_orientation[...,1,1] = -sin_dipole_theta * sin_dipole_phi *\
+            y_rotated + cos_dipole_theta * sin_dipole_phi * z_rotated
+    d_xyz_orientation[...,1,2] = -cos_dipole_theta * y_rotated -\
+            sin_dipole_theta * z_rotated
+
+    # Phi, moves the dipole and rotates its frame of reference
+    d_xyz_dipole[...,2,0] = -dipole_radius * sin_dipole_theta * sin_dipole_phi
+    d_xyz_dipole[...,2,1] = dipole_radius * sin_dipole_theta * cos_dipole_phi
+    d_xyz_orientation[...,2,0] = cos_dipole_phi * x_rotated -\
+            cos_dipole_theta * sin_dipole_phi * y_rotated -\
+            sin_dipole_theta * sin_dipole_phi * z_rotated
+    d_xyz_orientation[...,2,1] = sin_dipole_phi * x_rotated +\
+            cos_dipole_theta * cos_dipole_phi * y_rotated +\
+            sin_dipole_theta * cos_dipole_phi * z_rotated
+
+    # Orientation and orientation_phi only rotate the dipole
+    d_xyz_orientation[...,3,:] = rotate(
+            cos_orientation_theta * cos_orientation_phi,
+            cos_orientation_theta * sin_orientation_phi,
+            -sin_orientation_theta)
+    d_xyz_orientation[...,4,:] = rotate(-y_rotated, x_rotated,
+                                        zeros(z_rotated.shape))
+
+    return xyz_dipole, xyz_orientation, d_xyz_dipole, d_xyz_orientation
+
+def calculate_lead_field_blocked(gen_arrays, radius, xyz_el,
+                                 max_memory=2**28, n_threads=1,
+                                 model='brody_1973', shells=None):
+    """Calculates the same lead fields as calculate_lead_field_batch(), but in
+    tiles of generators small enough for the temporary arrays of each tile to
+    fit in max_memory bytes. The temporary arrays are allocated once for each
+    of the n_threads threads processing the tiles and reused for every tile,
+    which makes large montages and dense source spaces possible. The other
+    head models allocate their temporary arrays for each tile.
+    """
+    gen_arrays = asarray(gen_arrays, dtype=float)
+    xyz_dipole, xyz_orientation = calculate_dipoles(gen_arrays, radius)
+    shape = broadcast(xyz_el[...,:,newaxis,:],
+                      xyz_dipole[...,newaxis,:,:]).shape[:-1]
+    n_gen = shape[-1]
+    lead_field = empty(shape)
+
+    # Bytes needed by the work arrays for each generator
+    memory_per_gen = BRODY_1973_WORK_SIZE * 8 * prod(shape[:-1])
+    if model == 'berg_scherg':
+        memory_per_gen *= len(fit_berg_scherg(shells)[0])
+    tile = int(max(1, min(n_gen, max_memory // (n_threads*memory_per_gen))))
+    tiles = [(start, min(start + tile, n_gen))
+             for start in range(0, n_gen, tile)]
+    thread_work = local()
+
+    def calculate_tile(tile_range):
+        start, stop = tile_range
+        if model != 'brody_1973':
+            field_vector = calculate_field_vector(xyz_dipole[...,start:stop,:],
+                                                  radius, xyz_el, model, shells)
+            sum(field_vector * xyz_orientation[...,newaxis,start:stop,:], -1,
+                out=lead_field[...,start:stop])
+            return
+        if not hasattr(thread_work, 'work'):
+            thread_work.work = allocate_brody_1973_work(shape[:-1] + (tile,))
+        # Views of the work arrays for the (possibly smaller) last tile
+        work = dict((key, value[...,:stop - start,:]) if value.ndim ==
+                    len(shape) + 1 else (key, value[...,:stop - start])
+                    for key, value in thread_work.work.items())
+        field_vector = calculate_field_vector_brody_1973(
+                xyz_dipole[...,start:stop,:], radius, xyz_el, work=work)
+        multiply(field_vector, xyz_orientation[...,newaxis,start:stop,:],
+                 out=work['scratch vector'])
+        sum(work['scratch vector'], -1, out=lead_field[...,start:stop])
+
+    if n_threads > 1 and len(tiles) > 1:
+        pool = ThreadPool(n_threads)
+        try:
+            pool.map(calculate_tile, tiles)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for tile_range in tiles:
+            calculate_tile(tile_range)
+
+    return lead_field
+
+def calculate_field_vector(xyz_dipole, radius, xyz_el, model='brody_1973',
+                           shells=None, xyz_orientation=None, work=None):
+    """Field vectors, of shape (..., n_el, n_gen, 3), of one of the available
+    head models:
+
+    * 'brody_1973', a homogeneous conducting sphere, see
+      calculate_field_vector_brody_1973()
+    * 'berg_scherg', the Berg and Scherg approximation of a sphere consisting
+      of concentric shells, see calculate_field_vector_berg_scherg()
+    * 'infinite', an infinite homogeneous conductor, see
+      calculate_field_vector_infinite()
+    * 'frank_1952', a homogeneous conducting sphere as in Frank 1952, see
+      calculate_field_vector_frank_1952()
+
+    If xyz_orientation is given, the gradient of the lead field with respect to
+    the dipole location is returned as well, which is not available for
+    'frank_1952'.
+    """
+    if model == 'brody_1973':
+        return calculate_field_vector_brody_1973(xyz_dipole, radius, xyz_el,
+                                                 xyz_orientation, work)
+    elif model == 'berg_scherg':
+        return calculate_field_vector_berg_scherg(xyz_dipole, radius, xyz_el,
+                                                  shells, xyz_orientation)
+    elif model == 'infinite':
+        return calculate_field_vector_infinite(xyz_dipole, radius, xyz_el,
+                                               xyz_orientation)
+    elif model == 'frank_1952' and xyz_orientation is None:
+        return calculate_field_vector_frank_1952(xyz_dipole, radius, xyz_el)
+    else:
+        raise ValueError
+
+def allocate_brody_1973_work(shape):
+    """Work arrays used by calculate_field_vector_brody_1973() for an
+    (..., n_el, n_gen) shape of electrode and dipole combinations.
+    """
+    work = {}
+    for key in ['r', 'numerator', 'field vector', 'scratch vector']:
+        work[key] = empty(tuple(shape) + (3,))
+    for key in ['distance', 'r_cos_phi', 'denominator', 'scratch']:
+        work[key] = empty(tuple(shape))
+    return work
+
+def calculate_field_vector_brody_1973(xyz_dipole, radius, xyz_el,
+                                      xyz_orientation=None, work=None):
+    """The field vector of Brody 1973 for every combination of electrode and
+    dipole location, of shape (..., n_el, n_gen, 3). Its dot product with the
+    orientation of a dipole gives the lead field.
+
+    If xyz_orientation is given, the gradient of the lead field with respect to
+    the location of the dipole (with its orientation held fixed) is returned
+    as well, also of shape (..., n_el, n_gen, 3).
+
+    All temporary arrays, including the returned field vector, are taken from
+    work, as allocated by allocate_brody_1973_work(), so that repeated
+    calculations can reuse them. They are allocated here if work is None.
+    """
     # Assuming ideal conductivity
     sigma = 1.0
-    
-    # How many generators and electrodes do we have?
-    n_gen = len(gen_conf)
-    n_el = xyz_el.shape[0]
-
-    # The number of electrodes and generators defines the size of the lead field matrix
-    lead_field_brody_1973 = zeros((n_el,n_gen))
-
-    # Coordinates of each dipole in the frame of reference associated with the
-    # head and the orienation of the dipole in the frame of reference
-    # associated with the dipole, with axes parallel to the head frame of
-    # reference.
-    xyz_dipole = zeros((n_gen,3))
-    xyz_orientation = zeros((n_gen,3))
-    for i_gen in range(n_gen):
-        # Calculating the coordinates of the dipole in the Cartesian coordinates associated with the head
-        dipole_radius = radius - gen_conf[i_gen]['depth']
-        dipole_theta = gen_conf[i_gen]['theta']
-        dipole_phi = gen_conf[i_gen]['phi']
-        cos_dipole_theta = cos(dipole_theta)
-        sin_dipole_theta = sin(dipole_theta)
-        cos_dipole_phi = cos(dipole_phi)
-        sin_dipole_phi = sin(dipole_phi)
-        xyz_dipole[i_gen,0] = dipole_radius * sin_dipole_theta * cos_dipole_phi
-        xyz_dipole[i_gen,1] = dipole_radius * sin_dipole_theta * sin_dipole_phi
-        xyz_dipole[i_gen,2] = dipole_radius * cos_dipole_theta
-            
-        # The Orientation vector
-        orientation_theta = gen_conf[i_gen]['orientation']
-        orientation_phi = gen_conf[i_gen]['orientation_phi']
-        xyz_orientation_rotated = zeros(3);
-        xyz_orientation_rotated[0] = sin(orientation_theta) * cos(orientation_phi);
-        xyz_orientation_rotated[1] = sin(orientation_theta) * sin(orientation_phi);
-        xyz_orientation_rotated[2] = cos(orientation_theta);
-        
-        # Rotation matrix for translating the coordinates in the dipole frame of reference to the
-        # coordinates associated with the dipole parallel to the head coordinates.
-        rotation_matrix = zeros((3,3));
-        dipole_theta = gen_conf[i_gen]['theta']
-        dipole_phi = gen_conf[i_gen]['phi']
-        # Row 1
-        rotation_matrix[0,0] = sin_dipole_phi
-        rotation_matrix[0,1] = cos_dipole_theta * cos_dipole_phi
-        rotation_matrix[0,2] = sin_dipole_theta * cos_dipole_phi
-        # Row 2
-        rotation_matrix[1,0] = -cos_dipole_phi
-        rotation_matrix[1,1] = cos_dipole_theta * sin_dipole_phi
-        rotation_matrix[1,2] = sin_dipole_theta * sin_dipole_phi
-        # Row 3
-        rotation_matrix[2,0] = 0
-        rotation_matrix[2,1] = -sin_dipole_theta
-        rotation_matrix[2,2] = cos_dipole_theta
-            
-        # Rotating orientation to translated dipole coordinates
-        xyz_orientation[i_gen,:] = dot(rotation_matrix,xyz_orientation_rotated)
-
-    distance = cdist(xyz_el, xyz_dipole)
-    r_cos_phi = dot(xyz_el, transpose(xyz_dipole)) / radius
-
-    # Coordinate arrays broadcast to shape of (n_el,n_gen,3) in order to
-    # vectorize all further calculations
-    xyz_el_b = xyz_el[:,newaxis,:] + zeros((n_el,n_gen,3))
-    xyz_dipole_b = xyz_dipole[newaxis,:,:] + zeros((n_el,n_gen,3))
-
-    field_vector = xyz_el_b - xyz_dipole_b
-    field_vector = 2*field_vector / (distance**2)[:,:,newaxis]
-    field_vector += (1/(radius**2)) * \
-            ((xyz_el_b * r_cos_phi[:,:,newaxis] - radius * xyz_dipole_b) /\
-             (distance - r_cos_phi + radius)[:,:,newaxis] + xyz_el_b)
-    field_vector /=  4 * pi * sigma * distance[:,:,newaxis]
-    
-    lead_field_brody_1973 = sum(field_vector*xyz_orientation[newaxis,:,:],2)
-    
-    return lead_field_brody_1973
+
+    # Coordinate arrays broadcast against each other to shape
+    # (..., n_el, n_gen, 3) in order to vectorize all further calculations
+    xyz_el_b = xyz_el[...,:,newaxis,:]
+    xyz_dipole_b = xyz_dipole[...,newaxis,:,:]
+    if work is None:
+        work = allocate_brody_1973_work(
+                    broadcast(xyz_el_b, xyz_dipole_b).shape[:-1])
+    r = work['r']
+    numerator = work['numerator']
+    field_vector = work['field vector']
+    scratch_vector = work['scratch vector']
+    distance = work['distance']
+    r_cos_phi = work['r_cos_phi']
+    denominator = work['denominator']
+    scratch = work['scratch']
+
+    subtract(xyz_el_b, xyz_dipole_b, out=r)
+    multiply(r, r, out=scratch_vector)
+    sum(scratch_vector, -1, out=distance)
+    sqrt(distance, out=distance)
+    multiply(xyz_el_b, xyz_dipole_b, out=scratch_vector)
+    sum(scratch_vector, -1, out=r_cos_phi)
+    r_cos_phi /= radius
+    multiply(xyz_el_b, r_cos_phi[...,newaxis], out=numerator)
+    numerator -= radius * xyz_dipole_b
+    subtract(distance, r_cos_phi, out=denominator)
+    denominator += radius
+
+    multiply(r, 2, out=field_vector)
+    multiply(distance, distance, out=scratch)
+    field_vector /= scratch[...,newaxis]
+    divide(numerator, denominator[...,newaxis], out=scratch_vector)
+    scratch_vector += xyz_el_b
+    scratch_vector *= 1/(radius**2)
+    field_vector += scratch_vector
+    multiply(4 * pi * sigma, distance, out=scratch)
+    field_vector /= scratch[...,newaxis]
+
+    if xyz_orientation is None:
+        return field_vector
+
+    # Differentiating the field vector with respect to the dipole location and
+    # projecting it on the orientation, with r = xyz_el - xyz_dipole:
+    #     d(r)/d(xyz_dipole) = -I
+    #     d(distance)/d(xyz_dipole) = -r / distance
+    #     d(r_cos_phi)/d(xyz_dipole) = xyz_el / radius
+    o = xyz_orientation[...,newaxis,:,:]
+    o_r = sum(o * r, -1)[...,newaxis]
+    o_el = sum(o * xyz_el_b, -1)[...,newaxis]
+    o_numerator = sum(o * numerator, -1)[...,newaxis]
+    lead_field = sum(o * field_vector, -1)[...,newaxis]
+    distance = distance[...,newaxis]
+    denominator = denominator[...,newaxis]
+    d_denominator = -r / distance - xyz_el_b / radius
+
+    gradient = -2*o / distance**2 + 4*o_r*r / distance**4
+    gradient += (1/(radius**2)) * \
+            ((o_el*xyz_el_b / radius - radius*o) / denominator -\
+             o_numerator * d_denominator / denominator**2)
+    gradient /= 4 * pi * sigma * distance
+    gradient += lead_field * r / distance**2
+
+    return field_vector, gradient
+
+
+def calculate_field_vector_infinite(xyz_dipole, radius, xyz_el,
+                                    xyz_orientation=None):
+    """Field vectors of a dipole in an infinite homogeneous conductor, i.e.
+    ignoring the boundary of the head, of shape (..., n_el, n_gen, 3). The
+    radius is only used for the common signature of the head models.
+
+    If xyz_orientation is given, the gradient of the lead field with respect to
+    the location of the dipole is returned as well.
+    """
+    # Assuming ideal conductivity
+    sigma = 1.0
+
+    r = xyz_el[...,:,newaxis,:] - xyz_dipole[...,newaxis,:,:]
+    distance = sqrt(sum(r**2, -1))[...,newaxis]
+    field_vector = r / distance**3 / 4 / pi / sigma
+
+    if xyz_orientation is None:
+        return field_vector
+
+    # With r = xyz_el - xyz_dipole, d(r)/d(xyz_dipole) = -I
+    o = xyz_orientation[...,newaxis,:,:]
+    o_r = sum(o * r, -1)[...,newaxis]
+    gradient = (3*o_r*r / distance**2 - o) / distance**3 / 4 / pi / sigma
+
+    return field_vector, gradient
+
+def calculate_field_vector_frank_1952(xyz_dipole, radius, xyz_el):
+    """Field vectors of Frank 1952 for a dipole in a homogeneous conducting
+    sphere, of shape (..., n_el, n_gen, 3). This is the same physical model as
+    Brody 1973, but expressed through the angle theta between the dipole
+    location and the electrode, with the potential split in the part due to
+    the radial component of the dipole and the part due to its tangential
+    component in the direction of the electrode.
+
+    The tangential direction is calculated as a vector, rather than through
+    the azimuth of the electrode around the dipole (as in the arccos of
+    HeadModelDipoleSphere), so that no angle needs to be inverted.
+    """
+    # Assuming ideal conductivity
+    sigma = 1.0
+
+    xyz_el_b = xyz_el[...,:,newaxis,:]
+    xyz_dipole_b = xyz_dipole[...,newaxis,:,:]
+    b = sqrt(sum(xyz_dipole_b**2, -1))
+    f = b / radius
+    radial = xyz_dipole_b / b[...,newaxis]
+    cos_theta = sum(radial * xyz_el_b, -1) / radius
+    sin_theta_squared = 1 - cos_theta**2
+    denominator = (1 + f**2 - 2*f*cos_theta)**(3/2)
+
+    radial_part = (1 - f**2) / denominator - 1
+    tangential_part = (3*f - 3*f**2*cos_theta + f**3 - cos_theta) /\
+                      denominator + cos_theta
+    # The tangential direction towards the electrode times sin(theta), which
+    # vanishes together with sin(theta) for an electrode right above the dipole
+    tangent = xyz_el_b / radius - cos_theta[...,newaxis] * radial
+    sin_theta_squared[sin_theta_squared <= 0] = 1
+
+    field_vector = radial_part[...,newaxis] * radial +\
+                   (tangential_part / sin_theta_squared)[...,newaxis] * tangent
+    field_vector /= (4 * pi * sigma * radius * b)[...,newaxis]
+    return field_vector
+
+def calculate_field_vector_berg_scherg(xyz_dipole, radius, xyz_el,
+                                       shells=None, xyz_orientation=None):
+    """Field vectors of a sphere made of concentric shells of different
+    conductivity (e.g. brain, CSF, skull and scalp), with the electrodes on the
+    outer surface and the dipoles within the innermost shell.
+
+    Following Berg and Scherg (1994), the potential of each dipole is
+    approximated by the sum of the potentials of a few dipoles in a homogeneous
+    sphere with the conductivity of the outer shell, with the same orientation,
+    located at fractions (eccentricities) of the distance of the dipole from
+    the center of the head and scaled by magnitudes. These are fitted once for
+    each set of shells by fit_berg_scherg(), and then each dipole only costs a
+    few evaluations of the homogeneous Brody 1973 field vector.
+
+    shells is a sequence of (radius, conductivity) pairs from the innermost to
+    the outermost shell, with radii given as fractions of the radius of the
+    head, FOUR_SHELLS by default. If xyz_orientation is given, the gradient of
+    the lead field with respect to the dipole location is returned as well.
+    """
+    if shells is None:
+        shells = FOUR_SHELLS
+    magnitudes, eccentricities = fit_berg_scherg(shells)
+    sigma = shells[-1][1]
+    n_berg = len(magnitudes)
+    shape = xyz_dipole.shape
+
+    # The Berg dipoles of all generators, stacked along the generator axis
+    xyz_berg = (eccentricities[:,newaxis,newaxis] *
+                xyz_dipole[...,newaxis,:,:]).reshape(shape[:-2] + (-1,3))
+    berg_shape = (n_berg,) + shape[-2:]
+    if xyz_orientation is None:
+        field_vector = calculate_field_vector_brody_1973(xyz_berg, radius,
+                                                         xyz_el)
+    else:
+        orientation_berg = (ones((n_berg,1,1)) *
+                            xyz_orientation[...,newaxis,:,:]).reshape(
+                                                        shape[:-2] + (-1,3))
+        field_vector, gradient = calculate_field_vector_brody_1973(xyz_berg,
+                                            radius, xyz_el, orientation_berg)
+        # The location of each Berg dipole moves with the eccentricity times
+        # the movement of the dipole
+        gradient = gradient.reshape(gradient.shape[:-2] + berg_shape)
+        gradient = sum((magnitudes * eccentricities)[:,newaxis,newaxis] *
+                       gradient, -3) / sigma
+
+    # The Brody 1973 calculation assumes a conductivity of 1
+    field_vector = field_vector.reshape(field_vector.shape[:-2] + berg_shape)
+    field_vector = sum(magnitudes[:,newaxis,newaxis] * field_vector, -3) / sigma
+
+    if xyz_orientation is None:
+        return field_vector
+    return field_vector, gradient
+
+def calculate_multishell_coefficients(shells, n_terms=100):
+    """The coefficients f_n, for n = 1, ..., n_terms, by which each term of the
+    series expansion of the potential of a dipole in a homogeneous sphere is
+    multiplied to give the potential of the dipole in a sphere consisting of
+    shells, with the conductivity of the outer shell taking the place of the
+    conductivity of the homogeneous sphere (Zhang 1995, equations 1I-2I). For
+    a homogeneous sphere all f_n are 1.
+    """
+    radii = array([shell[0] for shell in shells], dtype=float)
+    sigmas = array([shell[1] for shell in shells], dtype=float)
+    coefficients = empty(n_terms)
+    for n in range(1, n_terms + 1):
+        m = identity(2)
+        for k in range(len(shells) - 1):
+            s = sigmas[k] / sigmas[k+1]
+            m = dot(m, array([[n + (n+1)*s,
+                               (n+1)*(s-1)*(radii[-1]/radii[k])**(2*n+1)],
+                              [n*(s-1)*(radii[k]/radii[-1])**(2*n+1),
+                               (n+1) + n*s]]) / (2*n+1))
+        coefficients[n-1] = n / (n*m[1,1] + (n+1)*m[1,0])
+    return coefficients
+
+def fit_berg_scherg(shells=None, n_dipoles=3, n_terms=100):
+    """Magnitudes and eccentricities of the Berg dipoles approximating the
+    shells, fitted such that the sum over Berg dipoles of
+    magnitude * eccentricity**(n-1) matches the coefficients f_n of
+    calculate_multishell_coefficients(), exactly for n = 1 and in the weighted
+    least squares sense of Zhang (1995, equation 5I) for n > 1. The results are
+    cached, so the fit is done only once for each set of shells.
+    """
+    if shells is None:
+        shells = FOUR_SHELLS
+    key = (tuple(tuple(float(p) for p in shell) for shell in shells),
+           n_dipoles, n_terms)
+    if key in BERG_SCHERG_PARAMETERS:
+        return BERG_SCHERG_PARAMETERS[key]
+
+    f = calculate_multishell_coefficients(shells, n_terms)
+    n = arange(2, n_terms + 1)
+    weights = (2*n + 1) / n
+
+    def linear_fit(eccentricities):
+        # With the eccentricities fixed the magnitudes (other than the first,
+        # which follows from the n = 1 constraint) are a linear fit
+        first = eccentricities[0]**(n-1)
+        design = (eccentricities[1:,newaxis]**(n-1) - first).T *\
+                 weights[:,newaxis]
+        target = (f[1:] - f[0]*first) * weights
+        magnitudes = lstsq(design, target, rcond=-1)[0]
+        return magnitudes, sum((dot(design, magnitudes) - target)**2)
+
+    # Eccentricities between 0 and 1 through a logistic transformation
+    logistic = lambda x: 1 / (1 + exp(-x))
+    start = linspace(0.5, 0.9, n_dipoles)
+    x = optimize.fmin(lambda x: linear_fit(logistic(x))[1],
+                      log(start / (1 - start)), xtol=1e-10, ftol=1e-14,
+                      maxiter=10000, maxfun=20000, disp=False)
+    eccentricities = logistic(x)
+    magnitudes = linear_fit(eccentricities)[0]
+    magnitudes = concatenate([[f[0] - sum(magnitudes)], magnitudes])
+
+    BERG_SCHERG_PARAMETERS[key] = (magnitudes, eccentricities)
+    return magnitudes, eccentricities
+
+
+def calculate_reference_weights(electrodes, reference):
+    """Weights w of the electrodes making up a reference. Data v calculated
+    against an ideal reference at infinity, as the lead field is, is
+    re-referenced by v - sum(w * v), i.e. by the projection P = I - 1 w^T. The
+    reference is one of:
+
+    * 'none', for which None is returned
+    * 'average', the average reference
+    * 'left mastoid'
+    * 'linked mastoids', the average of the left and right mastoids
+    * the name of an electrode, or a list of names of electrodes whose average
+      is the reference
+
+    electrodes is the list of names of the electrodes of the montage.
+    """
+    if reference == 'none':
+        return None
+    names = [electrode.strip() for electrode in electrodes]
+    if reference == 'average':
+        return ones(len(names)) / len(names)
+    if reference == 'left mastoid':
+        reference = [MASTOIDS[0]]
+    elif reference == 'linked mastoids':
+        reference = list(MASTOIDS)
+    elif isinstance(reference, str):
+        reference = [reference]
+    weights = zeros(len(names))
+    for name in reference:
+        if name not in names:
+            raise ValueError('Unknown reference electrode ' + name)
+        weights[names.index(name)] += 1 / len(reference)
+    return weights
+
+def rereference(values, weights, axis=0):
+    """Re-references values, e.g. lead fields or data, along their electrode
+    axis with the weights of calculate_reference_weights(). The cost is that
+    of one weighted sum over the electrodes.
+    """
+    if weights is None:
+        return values
+    reference = tensordot(weights, values, (0, axis))
+    return values - expand_dims(reference, axis)
+
+def rereference_covariance(cov, weights):
+    """P cov P^T for the reference projection P of the weights, see
+    calculate_reference_weights(), e.g. to re-reference electrode noise.
+    """
+    return rereference(rereference(cov, weights, -1), weights, -2)
 
 
 class Lead_Field:
     """The Lead_Field class should be used when calculating the lead field
     multiple times, it's performance is better than calculate_lead_field()
     because it reads in the electrode locations only once, on initialization.
+    The electrodes are those of montage, an .elp file in the montage registry
+    (by default montage.DEFAULT_MONTAGE), see montage.get_montage(), or only
+    the subset of them given by channels, see montage.Channel_Index.
+
+    Each column of the lead field depends only on the five parameters of its
+    own generator, so the columns can optionally be kept in a bounded least
+    recently used cache (cache_size is the maximum number of columns kept,
+    0 disables the cache). By default the cache is keyed on the exact
+    parameters of each dipole. If cache_quantization is given (a single step
+    or one step per parameter in GEN_CONF_PARAMETERS), parameters are rounded
+    to multiples of it and the columns are calculated for the rounded dipoles,
+    so that nearby dipoles share one column.
+
+    The head model is chosen with model, see calculate_field_vector(), e.g.
+    Lead_Field(model='berg_scherg', shells=THREE_SHELLS).
+
+    All lead fields and field vectors are calculated against the given
+    reference, see calculate_reference_weights(), so that the re-referencing
+    is done once for each lead field rather than for all data simulated from
+    it. rereference_covariance() applies the same reference to covariances.
     """
-    def __init__(self):
-        self.radius, self.xyz_el = initialize_electrode_locations()
-        
+    def __init__(self, cache_size=0, cache_quantization=None,
+                 method='direct', limits=None, grid_tolerance=1e-2,
+                 grid_file=None, max_memory=None, n_threads=1,
+                 model='brody_1973', shells=None, reference='none',
+                 montage=None, channels=None):
+        self.montage = get_montage(montage)
+        self.radius = self.montage.radius
+        # Only the channels of the montage in channels, a subset of its
+        # Channel_Index, e.g. 'EEG', or a list of names, are calculated
+        index = self.montage.channels
+        if channels is None:
+            self.channels = index
+            self.xyz_el = self.montage.xyz
+        elif isinstance(channels, str):
+            self.channels = Channel_Index(index.subset_names(channels))
+            self.xyz_el = index.select(self.montage.xyz, channels)
+        else:
+            self.channels = Channel_Index(channels)
+            self.xyz_el = read_only(self.montage.xyz.take(
+                            [index.index(name) for name in channels], 0))
+
+        self.reference = reference
+        self.reference_weights = None
+        if reference != 'none':
+            self.reference_weights = calculate_reference_weights(
+                                            self.channels.names, reference)
+
+        if model not in MODELS:
+            raise ValueError
+        self.model = model
+        if model == 'berg_scherg':
+            if shells is None:
+                shells = FOUR_SHELLS
+            # Fitting the Berg parameters once, on initialization
+            self.berg_scherg_parameters = fit_berg_scherg(shells)
+        self.shells = shells
+
+        # If max_memory is given, direct calculations are done in tiles of
+        # generators with bounded memory, see calculate_lead_field_blocked()
+        self.max_memory = max_memory
+        self.n_threads = n_threads
+
+        self.cache_size = cache_size
+        if cache_quantization is not None:
+            cache_quantization = asarray(cache_quantization, dtype=float) *\
+                                 ones(len(GEN_CONF_PARAMETERS))
+        self.cache_quantization = cache_quantization
+        self.clear_cache()
+
+        # With method='grid' or method='table' the lead field is interpolated
+        # from a precomputed Lead_Field_Grid or Lead_Field_Table instead of
+        # being calculated directly
+        if method not in ['direct', 'grid', 'table']:
+            raise ValueError
+        self.method = method
+        if method == 'grid':
+            self.grid = Lead_Field_Grid(self.radius, self.xyz_el, limits,
+                                        grid_tolerance, filename=grid_file,
+                                        model=model, shells=shells)
+        elif method == 'table':
+            self.grid = Lead_Field_Table(self.radius, self.xyz_el, limits,
+                                         grid_tolerance, model=model,
+                                         shells=shells)
+
     def calculate(self, gen_conf):
-        return calculate_lead_field_given_electrodes(gen_conf, self.radius,\
-                                                     self.xyz_el)
+        if self.cache_size > 0:
+            return self.calculate_cached(gen_conf_to_array(gen_conf))
+        return self.calculate_batch(gen_conf_to_array(gen_conf)[newaxis])[0]
+
+    def calculate_cached(self, gen_array):
+        """Assembles the lead field of a single generator configuration, given
+        as an array of shape (n_gen, 5), from the column cache. All the columns
+        missing from the cache are calculated together in one batch.
+        """
+        if self.cache_quantization is not None:
+            gen_array = self.cache_quantization *\
+                        around(gen_array / self.cache_quantization)
+        keys = [tuple(gen_parameters) for gen_parameters in gen_array]
+
+        columns = {}
+        missing = []
+        for key in keys:
+            if key in columns:
+                continue
+            if key in self.cache:
+                # Moving the column to the most recently used end of the cache
+                columns[key] = self.cache.pop(key)
+                self.cache[key] = columns[key]
+                self.cache_hits += 1
+            elif key not in missing:
+                missing.append(key)
+                self.cache_misses += 1
+
+        if len(missing) > 0:
+            new_columns = self.calculate_batch(array(missing)[newaxis])
+            for i, key in enumerate(missing):
+                columns[key] = new_columns[0,:,i].copy()
+                self.cache[key] = columns[key]
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+                    self.cache_evictions += 1
+
+        lead_field = empty((self.xyz_el.shape[0], len(keys)))
+        for i, key in enumerate(keys):
+            lead_field[:,i] = columns[key]
+        return lead_field
+
+    def update_columns(self, lead_field, gen_conf, changed):
+        """Recalculates in place only the columns of lead_field, previously
+        calculated for a generator configuration with the same number of
+        generators, of the generators of gen_conf whose indices are in changed.
+        Moving a few generators then costs O(n_el) per generator rather than
+        recalculating all columns. Returns lead_field.
+        """
+        changed = list(changed)
+        if len(changed) > 0:
+            lead_field[:,changed] = self.calculate([gen_conf[gen]
+                                                    for gen in changed])
+        return lead_field
+
+    def cache_info(self):
+        """Statistics of the lead field column cache."""
+        return {'hits': self.cache_hits, 'misses': self.cache_misses,
+                'evictions': self.cache_evictions, 'size': len(self.cache),
+                'max size': self.cache_size}
+
+    def clear_cache(self):
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+
+    def calculate_vector(self, gen_conf):
+        """Field vectors of shape (n_el, n_gen, 3), which depend only on the
+        locations of the generators, not on their orientations. The lead field
+        is obtained from them with project().
+        """
+        gen_array = gen_conf_to_array(gen_conf)
+        if self.method in ['grid', 'table']:
+            field_vector = self.grid.calculate_vector(gen_array)
+        else:
+            xyz_dipole = calculate_dipoles(gen_array, self.radius)[0]
+            field_vector = calculate_field_vector(xyz_dipole, self.radius,
+                                                  self.xyz_el, self.model,
+                                                  self.shells)
+        return rereference(field_vector, self.reference_weights, -3)
+
+    def project(self, field_vector, gen_conf):
+        """Lead field from field vectors calculated by calculate_vector(), given
+        the orientations of the generators in gen_conf.
+        """
+        return project_field_vector(field_vector, gen_conf_to_array(gen_conf),
+                                    self.radius)
+
+    def calculate_batch(self, gen_arrays):
+        """Lead fields of a stack of generator configurations, see
+        calculate_lead_field_batch(). gen_arrays has shape (n_configs, n_gen, 5)
+        and the result has shape (n_configs, n_el, n_gen).
+        """
+        if self.method in ['grid', 'table']:
+            lead_fields = self.grid.calculate(gen_arrays)
+        elif self.max_memory is not None:
+            lead_fields = calculate_lead_field_blocked(gen_arrays, self.radius,
+                                                self.xyz_el, self.max_memory,
+                                                self.n_threads, self.model,
+                                                self.shells)
+        else:
+            lead_fields = calculate_lead_field_batch(gen_arrays, self.radius,
+                                                     self.xyz_el, self.model,
+                                                     self.shells)
+        return rereference(lead_fields, self.reference_weights, -2)
+
+    def calculate_subjects(self, gen_conf, radii, xyz_el=None):
+        """Lead fields of several subjects with individual head radii, an
+        array of shape (n_sub, n_el, n_gen), see
+        calculate_lead_field_subjects(). xyz_el, of shape (n_sub, n_el, 3),
+        are the electrodes of each subject, by default those of the montage
+        scaled to the radius of each head. gen_conf is a single generator
+        configuration or an array of shape (n_sub, n_gen, 5) with one for each
+        subject. The lead fields are always calculated directly.
+        """
+        radii = asarray(radii, dtype=float)
+        if xyz_el is None:
+            xyz_el = self.xyz_el / self.radius * radii[:,newaxis,newaxis]
+        if isinstance(gen_conf, list):
+            gen_conf = gen_conf_to_array(gen_conf)
+        lead_fields = calculate_lead_field_subjects(gen_conf, radii, xyz_el,
+                                                    self.model, self.shells,
+                                                    self.max_memory,
+                                                    self.n_threads)
+        return rereference(lead_fields, self.reference_weights, -2)
+
+    def calculate_with_jacobian(self, gen_conf):
+        """Lead field together with its derivatives with respect to the
+        parameters of each generator, an array of shape (n_el, n_gen, 5)
+        ordered as in GEN_CONF_PARAMETERS. Both are always calculated directly,
+        whichever method was chosen on initialization. The jacobian is not
+        available for the 'frank_1952' model.
+        """
+        if self.model == 'frank_1952':
+            raise ValueError('The jacobian of the lead field is not ' +
+                             'available for the frank_1952 model')
+        lead_field, jacobian = \
+                calculate_lead_field_and_jacobian_given_electrodes(gen_conf,
+                                                 self.radius, self.xyz_el,
+                                                 self.model, self.shells)
+        return (rereference(lead_field, self.reference_weights, -2),
+                rereference(jacobian, self.reference_weights, -3))
+
+    def rereference_covariance(self, cov):
+        """Applies the reference of the lead field to a covariance matrix of
+        the electrodes, e.g. to that of electrode noise.
+        """
+        return rereference_covariance(cov, self.reference_weights)
+
+
+class Lead_Field_Grid:
+    """The three Cartesian components of the field vector at every electrode,
+    precomputed on a regular (depth, theta, phi) grid of dipole locations. The
+    lead field of any dipole within the grid is then obtained by trilinear
+    interpolation of the field vectors and projection on the orientation of
+    the dipole, skipping the Brody 1973 calculation altogether.
+
+    The grid covers the depth and theta ranges in limits (by default those of
+    ERP_Variability_Model) and always the full circle of phi. Starting from
+    shape, the grid is refined until the largest interpolation error found by
+    validate(), relative to the largest value in each exact lead field column,
+    is below tolerance, as long as the grid stays below max_size bytes.
+
+    If filename is given, the grid is saved there as a .npy file, with its
+    metadata and validation report in an .npz file alongside, and later
+    Lead_Field_Grid objects with the same electrodes and limits load it
+    memory-mapped instead of recalculating it.
+    """
+    def __init__(self, radius, xyz_el, limits=None, tolerance=1e-2,
+                 shape=(16,32,64), filename=None, max_size=2**30,
+                 n_validation=500, model='brody_1973', shells=None):
+        if limits is None:
+            limits = GRID_LIMITS
+        self.radius = radius
+        self.xyz_el = xyz_el
+        self.model = model
+        self.shells = shells
+        self.limits = dict((key, tuple(float(l) for l in limits[key]))
+                           for key in GRID_LIMITS)
+        self.tolerance = tolerance
+        self.n_validation = n_validation
+
+        if filename is not None and self.load(filename):
+            return
+
+        while True:
+            self.build(shape)
+            self.validation_report = self.validate(n_validation)
+            if self.validation_report['passed']:
+                break
+            # Linear interpolation errors decrease with the square of the grid
+            # spacing
+            factor = 1.1 * sqrt(self.validation_report['max relative error']
+                                / tolerance)
+            shape = tuple(int(ceil(n * factor)) for n in shape)
+            if self.size(shape) > max_size:
+                raise ValueError('A lead field grid with tolerance ' +
+                                 str(tolerance) + ' would exceed ' +
+                                 str(max_size) + ' bytes')
+
+        if filename is not None:
+            self.save(filename)
+
+    def size(self, shape):
+        """Bytes taken by a grid of the given shape."""
+        return prod(shape) * self.xyz_el.shape[0] * 3 * 8
+
+    def build(self, shape):
+        n_depth, n_theta, n_phi = shape
+        self.shape = tuple(shape)
+        self.depth = linspace(self.limits['depth'][0], self.limits['depth'][1],
+                              n_depth)
+        self.theta = linspace(self.limits['theta'][0], self.limits['theta'][1],
+                              n_theta)
+        self.phi = arange(n_phi) * 2*pi / n_phi
+
+        # Calculated one depth at a time to bound the memory of the temporary
+        # arrays
+        self.grid = empty(tuple(shape) + (self.xyz_el.shape[0], 3))
+        gen_array = zeros((n_theta, n_phi, 5))
+        gen_array[:,:,1] = self.theta[:,newaxis]
+        gen_array[:,:,2] = self.phi[newaxis,:]
+        for i_depth in range(n_depth):
+            gen_array[:,:,0] = self.depth[i_depth]
+            xyz_dipole = calculate_dipoles(gen_array.reshape((-1,5)),
+                                           self.radius)[0]
+            field_vector = calculate_field_vector(xyz_dipole, self.radius,
+                                                  self.xyz_el, self.model,
+                                                  self.shells)
+            self.grid[i_depth] = field_vector.transpose((1,0,2)).reshape(
+                                (n_theta, n_phi, self.xyz_el.shape[0], 3))
+
+    def save(self, filename):
+        save(filename, self.grid)
+        report = self.validation_report
+        savez(self.metadata_filename(filename), radius=self.radius,
+              xyz_el=self.xyz_el, model=self.model, shells=self.shells_array(),
+              depth=self.depth, theta=self.theta,
+              phi=self.phi, limits=[self.limits[key] for key in GRID_LIMITS],
+              report=[report[key] for key in GRID_REPORT])
+
+    def load(self, filename):
+        """Memory-maps a previously saved grid if it matches the electrodes,
+        limits and tolerance of this object, returns whether it did.
+        """
+        if not (exists(filename) and
+                exists(self.metadata_filename(filename))):
+            return False
+        metadata = load(self.metadata_filename(filename))
+        report = dict(zip(GRID_REPORT, metadata['report']))
+        if metadata['radius'] != self.radius or\
+           metadata['xyz_el'].shape != self.xyz_el.shape or\
+           (metadata['xyz_el'] != self.xyz_el).any() or\
+           metadata['model'] != self.model or\
+           metadata['shells'].shape != self.shells_array().shape or\
+           (metadata['shells'] != self.shells_array()).any() or\
+           (metadata['limits'] !=
+            array([self.limits[key] for key in GRID_LIMITS])).any() or\
+           report['max relative error'] > self.tolerance:
+            return False
+        self.depth = metadata['depth']
+        self.theta = metadata['theta']
+        self.phi = metadata['phi']
+        self.grid = load(filename, mmap_mode='r')
+        self.shape = self.grid.shape[:3]
+        report['number of dipoles'] = int(report['number of dipoles'])
+        report['grid shape'] = self.grid.shape[:3]
+        report['grid size'] = self.grid.nbytes
+        report['tolerance'] = self.tolerance
+        report['passed'] = True
+        self.validation_report = report
+        return True
+
+    def shells_array(self):
+        if self.shells is None:
+            return zeros((0,2))
+        return array(self.shells, dtype=float)
+
+    def metadata_filename(self, filename):
+        if filename.endswith('.npy'):
+            filename = filename[:-4]
+        return filename + '_metadata.npz'
+
+    def calculate(self, gen_arrays):
+        """Interpolated lead fields of generator configurations given as an
+        array of shape (..., n_gen, 5), the result has shape (..., n_el, n_gen).
+        """
+        gen_arrays = asarray(gen_arrays, dtype=float)
+        return project_field_vector(self.calculate_vector(gen_arrays),
+                                    gen_arrays, self.radius)
+
+    def calculate_vector(self, gen_arrays):
+        """Interpolated field vectors of shape (..., n_el, n_gen, 3)."""
+        gen_arrays = asarray(gen_arrays, dtype=float)
+        indices = []
+        weights = []
+        for i_axis, axis in enumerate([self.depth, self.theta]):
+            values = gen_arrays[...,i_axis]
+            if (values < axis[0]).any() or (values > axis[-1]).any():
+                raise ValueError(GEN_CONF_PARAMETERS[i_axis] + ' outside ' +
+                                 'of the lead field grid')
+            position = (values - axis[0]) / (axis[1] - axis[0])
+            index = minimum(floor(position).astype(int), len(axis) - 2)
+            indices.append((index, index + 1))
+            weights.append(position - index)
+        # Phi is periodic
+        position = mod(gen_arrays[...,2], 2*pi) / (self.phi[1] - self.phi[0])
+        index = floor(position).astype(int)
+        weights.append(position - index)
+        indices.append((index % len(self.phi), (index + 1) % len(self.phi)))
+
+        field_vector = 0
+        for corner in product((0,1), repeat=3):
+            weight = 1
+            for i_axis in range(3):
+                if corner[i_axis] == 0:
+                    weight = weight * (1 - weights[i_axis])
+                else:
+                    weight = weight * weights[i_axis]
+            field_vector = field_vector + weight[...,newaxis,newaxis] *\
+                    self.grid[indices[0][corner[0]], indices[1][corner[1]],
+                              indices[2][corner[2]]]
+
+        return swapaxes(field_vector, -2, -3)
+
+    def validate(self, n_dipoles=500, seed=0):
+        """Compares interpolated lead fields of random dipoles within the limits
+        against the exact calculation. The errors of each lead field column are
+        relative to the largest absolute value of that column.
+        """
+        random_state = RandomState(seed)
+        gen_array = empty((n_dipoles, 5))
+        for i, parameter in enumerate(GEN_CONF_PARAMETERS):
+            gen_array[:,i] = random_state.uniform(self.limits[parameter][0],
+                                                  self.limits[parameter][1],
+                                                  n_dipoles)
+        exact = calculate_lead_field_batch(gen_array[newaxis], self.radius,
+                                           self.xyz_el, self.model,
+                                           self.shells)[0]
+        error = abs(self.calculate(gen_array) - exact)
+        relative_error = error.max(0) / abs(exact).max(0)
+        return {'grid shape': self.shape,
+                'grid size': self.size(self.shape),
+                'number of dipoles': n_dipoles,
+                'max absolute error': error.max(),
+                'max relative error': relative_error.max(),
+                'rms relative error': sqrt(mean(relative_error**2)),
+                'tolerance': self.tolerance,
+                'passed': relative_error.max() <= self.tolerance}
+
+
+class Lead_Field_Table(Lead_Field_Grid):
+    """In a spherical head the field vector of a dipole depends only on the
+    depth of the dipole and on the angle between the dipole and the electrode
+    as seen from the center of the head, when split in a radial component and
+    a tangential one in the direction of the electrode. Both are precomputed
+    on a regular table over depth and sin(angle/2), independent of the
+    montage, and the lead field of any dipole is then obtained by bilinear
+    interpolation and a few dot products with the orientation of the dipole.
+
+    With the unit vectors r_dipole and r_el pointing at the dipole and the
+    electrode, and cos_angle = r_dipole . r_el, the field vector is
+        radial * r_dipole + tangential * (r_el - cos_angle * r_dipole)
+    where the tabulated tangential component is divided by sin(angle), so
+    that no normalization is needed on lookup.
+
+    The table covers the depth range in limits and all angles. It is refined
+    in the same way as Lead_Field_Grid, but being two dimensional it is much
+    smaller, so it is neither saved nor loaded.
+    """
+    def __init__(self, radius, xyz_el, limits=None, tolerance=1e-2,
+                 shape=(16,64), max_size=2**28, n_validation=500,
+                 model='brody_1973', shells=None):
+        Lead_Field_Grid.__init__(self, radius, xyz_el, limits, tolerance,
+                                 shape, None, max_size, n_validation, model,
+                                 shells)
+
+    def size(self, shape):
+        return prod(shape) * 4 * 8
+
+    def build(self, shape):
+        n_depth, n_angle = shape
+        self.shape = tuple(shape)
+        self.depth = linspace(self.limits['depth'][0], self.limits['depth'][1],
+                              n_depth)
+        # sin(angle/2) is half the distance between the unit vectors, which
+        # keeps the table dense where the field changes quickly (small angles)
+        # and is calculated from cos(angle) without loss of precision
+        self.half_sine = linspace(0, 1, n_angle)
+        # The tangential component divided by sin(angle) is taken slightly
+        # away from 0 and pi, where it is its own limit within rounding
+        angle = (2 * arcsin(self.half_sine)).clip(1e-4, pi - 1e-4)
+
+        # Dipoles on the z axis and electrodes in the xz plane, so that the
+        # radial component is along z and the tangential one along x
+        xyz_dipole = zeros((n_depth, 1, 3))
+        xyz_dipole[:,0,2] = self.radius - self.depth
+        xyz_el = zeros((n_angle, 3))
+        xyz_el[:,0] = self.radius * sin(angle)
+        xyz_el[:,2] = self.radius * cos(angle)
+        field_vector = calculate_field_vector(xyz_dipole, self.radius, xyz_el,
+                                              self.model, self.shells)[:,:,0]
+        table = empty((n_depth, n_angle, 2))
+        table[:,:,0] = field_vector[:,:,2] - field_vector[:,:,0] * \
+                                             cos(angle) / sin(angle)
+        table[:,:,1] = field_vector[:,:,0] / sin(angle)
+
+        # Values and differences to the next angle, so that each lookup along
+        # the angle gathers from contiguous rows
+        self.table = empty((4, n_depth, n_angle - 1))
+        self.table[:2] = table[:,:-1].transpose((2,0,1))
+        self.table[2:] = (table[:,1:] - table[:,:-1]).transpose((2,0,1))
+
+    def calculate(self, gen_arrays):
+        """Interpolated lead fields of generator configurations given as an
+        array of shape (..., n_gen, 5), the result has shape (..., n_el, n_gen).
+        """
+        gen_arrays = asarray(gen_arrays, dtype=float)
+        xyz_dipole, xyz_orientation = calculate_dipoles(gen_arrays,
+                                                        self.radius)
+        radial = xyz_dipole / (self.radius - gen_arrays[...,0])[...,newaxis]
+        cos_angle = self.project_on_electrodes(radial)
+        o_radial = sum(xyz_orientation * radial, -1)[...,newaxis,:]
+        o_el = self.project_on_electrodes(xyz_orientation)
+        radial, tangential = self.interpolate(gen_arrays[...,0], cos_angle)
+        return radial * o_radial + tangential * o_el
+
+    def calculate_vector(self, gen_arrays):
+        """Interpolated field vectors of shape (..., n_el, n_gen, 3)."""
+        gen_arrays = asarray(gen_arrays, dtype=float)
+        xyz_dipole = calculate_dipoles(gen_arrays, self.radius)[0]
+        radial = xyz_dipole / (self.radius - gen_arrays[...,0])[...,newaxis]
+        cos_angle = self.project_on_electrodes(radial)
+        radial_part, tangential_part = self.interpolate(gen_arrays[...,0],
+                                                        cos_angle)
+        return radial_part[...,newaxis] * radial[...,newaxis,:,:] +\
+               tangential_part[...,newaxis] * \
+               self.xyz_el[:,newaxis,:] / self.radius
+
+    def project_on_electrodes(self, vectors):
+        """Dot products of vectors of shape (..., n_gen, 3) with the unit
+        vectors pointing at the electrodes, of shape (..., n_el, n_gen).
+        """
+        shape = vectors.shape[:-1]
+        products = dot(vectors.reshape((-1,3)), self.xyz_el.T / self.radius)
+        return swapaxes(products.reshape(shape + (-1,)), -1, -2)
+
+    def interpolate(self, depth, cos_angle):
+        """Bilinear interpolation in the table, for dipoles at depth, of shape
+        (..., n_gen), and the cosines of the angles between dipoles and
+        electrodes, of shape (..., n_el, n_gen). Returns the coefficients of
+        the unit vectors pointing at the dipole and at the electrode, in which
+        the radial component already includes the cos(angle) part of the
+        tangential direction.
+        """
+        if (depth < self.depth[0]).any() or (depth > self.depth[-1]).any():
+            raise ValueError('depth outside of the lead field table')
+        n_angle = self.table.shape[2]
+
+        # Interpolating in depth once for each generator
+        position = (depth - self.depth[0]) / (self.depth[1] - self.depth[0])
+        index = minimum(floor(position).astype(int), len(self.depth) - 2)
+        weight = (position - index)[...,newaxis]
+        rows = (1 - weight) * self.table[:,index] +\
+               weight * self.table[:,index + 1]
+        rows = rows.reshape((4,-1))
+
+        # and in sin(angle/2) for each electrode and generator
+        position = sqrt((1 - cos_angle.clip(-1, 1)) / 2) * n_angle
+        index = minimum(floor(position).astype(int), n_angle - 1)
+        weight = position - index
+        index += n_angle * arange(prod(depth.shape)).reshape(depth.shape)[
+                                                            ...,newaxis,:]
+        return (rows[0].take(index) + weight * rows[2].take(index),
+                rows[1].take(index) + weight * rows[3].take(index))
@@ -0,0 +1,377 @@
+"""
+Registry of electrode montages.
+
+Electrode locations are read from .elp files, which list the electrode names
+along with their spherical coordinates (in degrees, with negative theta
+denoting the left hemisphere). Each file is parsed only once per process and
+the resulting coordinates are kept in a binary sidecar file (the .elp file
+name with .npz appended) next to it, so that later processes don't need to
+parse the text file at all. The sidecar is rebuilt whenever the .elp file is
+modified.
+
+All arrays handed out by the registry are shared between their users and
+therefore read-only, copy them if they need to be modified.
+
+Besides .elp files, the registry generates synthetic montages of any density,
+see standard_montage() and geodesic_montage(), which are requested by name,
+e.g. get_montage('10-5') or get_montage('geodesic_6').
+"""
+
+from __future__ import division
+
+import os
+import threading
+
+from numpy import array, asarray, sin, cos, pi, savez, load, stack, sqrt,\
+                  arccos, arctan2, cross, dot, around, clip, mod, zeros,\
+                  flatnonzero
+from numpy.linalg import norm
+
+
+# Electrode files are looked up relative to this directory, not to the current
+# working directory
+MONTAGE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MONTAGE = 'electrodeLocations.elp'
+# Radius of the head in cm, used for the Cartesian electrode coordinates
+HEAD_RADIUS = 11.5
+SIDECAR_SUFFIX = '.npz'
+# Electrode systems generated by standard_montage(), with the steps between
+# rows and between columns in units of 5% of the reference curves
+STANDARD_SYSTEMS = {'10-20': 4, '10-10': 2, '10-5': 1}
+# Rows of the 10-5 system from the nasion to the inion, in steps of 5% along
+# the sagittal curve. Rows 2 (Fp) and 18 (O) lie on the 10% circumference, the
+# equator of the spherical head, and the temporal rows are renamed near the
+# circumference, e.g. C7 is T7 and FCC7h is FTT7h.
+STANDARD_ROWS = ('N', 'NFp', 'Fp', 'AFp', 'AF', 'AFF', 'F', 'FFC', 'FC', 'FCC',
+                 'C', 'CCP', 'CP', 'CPP', 'P', 'PPO', 'PO', 'POO', 'O', 'OI',
+                 'I')
+TEMPORAL_ROWS = {'FFC': 'FFT', 'FC': 'FT', 'FCC': 'FTT', 'C': 'T',
+                 'CCP': 'TTP', 'CP': 'TP', 'CPP': 'TPP'}
+# Subsets of channels precomputed by every Channel_Index, given as the channels
+# excluded from them (if present)
+CHANNEL_SUBSETS = {'EEG': ('M1', 'M2', 'HEO', 'VEO', 'CB1', 'CB2')}
+
+MONTAGES = {}
+MONTAGES_LOCK = threading.Lock()
+
+
+class Montage():
+    """Electrode names and locations of a montage.
+
+    x, y are the coordinates used for topographic maps, theta, phi the
+    spherical coordinates of the electrodes (in radians) and xyz their
+    Cartesian coordinates on a head of radius HEAD_RADIUS, with the X axis
+    pointing towards the right ear and the Y axis pointing towards the front.
+    labels are the names as written in the electrode file, e.g. padded with
+    spaces, and the names without padding by default.
+    """
+    def __init__(self, names, x, y, theta, phi, xyz, file_name=None,
+                 labels=None):
+        self.names = tuple(str(name) for name in names)
+        if labels is None:
+            labels = self.names
+        self.labels = tuple(str(label) for label in labels)
+        self.n_el = len(self.names)
+        self.file_name = file_name
+        self.x = read_only(x)
+        self.y = read_only(y)
+        self.theta = read_only(theta)
+        self.phi = read_only(phi)
+        self.xyz = read_only(xyz)
+        self.radius = HEAD_RADIUS
+        self.channels = Channel_Index(self.names)
+
+    def index(self, name):
+        """Returns the index of the electrode with the given name."""
+        return self.channels.index(name)
+
+
+class Channel_Index():
+    """Positions of channels by name, with precomputed subsets of channels.
+
+    Each subset is stored as a mask and as the indices of its channels, see
+    add_subset(). select() then gives the channels of a subset of any array
+    with an electrode axis, e.g. lead fields or data, as a view if the subset
+    is a contiguous range of channels and as a single copy otherwise. The
+    subsets of CHANNEL_SUBSETS, e.g. 'EEG', and 'all' always exist.
+    """
+    def __init__(self, names, subsets=CHANNEL_SUBSETS):
+        self.names = tuple(name.strip() for name in names)
+        self.positions = dict((name, i) for i, name in enumerate(self.names))
+        if len(self.positions) != len(self.names):
+            raise ValueError('Duplicate channel names')
+        self.masks = {}
+        self.indices = {}
+        self.slices = {}
+        self.add_subset('all')
+        for subset, excluded in subsets.items():
+            self.add_subset(subset, exclude=[name for name in excluded
+                                             if name in self.positions])
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, name):
+        """Position of the channel with the given name."""
+        try:
+            return self.positions[name.strip()]
+        except KeyError:
+            raise ValueError('Unknown channel ' + name)
+
+    def add_subset(self, subset, include=None, exclude=()):
+        """Precomputes the subset of the channels named in include (all
+        channels by default) without those named in exclude, keeping the
+        order of the channels. Returns the indices of its channels.
+        """
+        mask = zeros(len(self.names), dtype=bool)
+        if include is None:
+            mask[:] = True
+        else:
+            mask[[self.index(name) for name in include]] = True
+        mask[[self.index(name) for name in exclude]] = False
+        indices = flatnonzero(mask)
+        self.masks[subset] = read_only(mask, bool)
+        self.indices[subset] = read_only(indices, int)
+        if len(indices) == 0 or indices[-1] - indices[0] == len(indices) - 1:
+            self.slices[subset] = slice(indices[0] if len(indices) else 0,
+                                        indices[-1] + 1 if len(indices) else 0)
+        else:
+            self.slices[subset] = None
+        return self.indices[subset]
+
+    def subset_names(self, subset):
+        """Names of the channels of a subset."""
+        return [self.names[i] for i in self.indices[subset]]
+
+    def select(self, values, subset, axis=0):
+        """The channels of a subset along the given electrode axis of values,
+        a view if the subset is contiguous and a copy otherwise."""
+        if self.slices[subset] is not None:
+            index = [slice(None)] * values.ndim
+            index[axis] = self.slices[subset]
+            return values[tuple(index)]
+        return values.take(self.indices[subset], axis)
+
+
+def read_only(values, dtype=float):
+    values = array(values, dtype=dtype)
+    values.flags.writeable = False
+    return values
+
+
+def montage_path(file_name=None):
+    """Returns the absolute path of an electrode file, with relative paths
+    taken relative to MONTAGE_DIRECTORY."""
+    if file_name is None:
+        file_name = DEFAULT_MONTAGE
+    return os.path.abspath(os.path.join(MONTAGE_DIRECTORY, file_name))
+
+def get_montage(montage=None):
+    """Returns the (shared) Montage of the given name, which is one of
+
+    * the name of an .elp file, by default DEFAULT_MONTAGE
+    * one of the STANDARD_SYSTEMS, e.g. '10-5', see standard_montage()
+    * 'geodesic_<frequency>', e.g. 'geodesic_6', see geodesic_montage()
+
+    A Montage is returned as it is.
+    """
+    if isinstance(montage, Montage):
+        return montage
+    if montage in STANDARD_SYSTEMS:
+        key = montage
+        create = lambda: standard_montage(montage)
+    elif montage is not None and montage.startswith('geodesic_'):
+        key = montage
+        create = lambda: geodesic_montage(int(montage[len('geodesic_'):]))
+    else:
+        key = montage_path(montage)
+        create = lambda: load_montage(key)
+    with MONTAGES_LOCK:
+        if key not in MONTAGES:
+            MONTAGES[key] = create()
+        return MONTAGES[key]
+
+def load_montage(path):
+    """Reads a Montage from the sidecar of an .elp file if it is up to date,
+    otherwise parses the .elp file and (re)writes the sidecar."""
+    stat = os.stat(path)
+    sidecar = path + SIDECAR_SUFFIX
+    if os.path.exists(sidecar):
+        try:
+            data = load(sidecar)
+            if data['elp_mtime'] == stat.st_mtime and \
+               data['elp_size'] == stat.st_size:
+                return Montage(data['names'], data['x'], data['y'],
+                               data['theta'], data['phi'], data['xyz'],
+                               path, data['labels'])
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+
+    montage = parse_elp(path)
+    try:
+        # Writing to a temporary file first, so that concurrent processes
+        # never see a partly written sidecar
+        temporary = sidecar + '.' + str(os.getpid()) + '.tmp'
+        with open(temporary, 'wb') as f:
+            savez(f, names=array(montage.names),
+                  labels=array(montage.labels), x=montage.x, y=montage.y,
+                  theta=montage.theta, phi=montage.phi, xyz=montage.xyz,
+                  elp_mtime=stat.st_mtime, elp_size=stat.st_size)
+        os.rename(temporary, sidecar)
+    except (IOError, OSError):
+        # The sidecar is only an optimization, e.g. the directory might not be
+        # writable
+        pass
+    return montage
+
+def parse_elp(path):
+    """Parses an .elp file into a Montage."""
+    labels = []
+    theta = []
+    phi = []
+    with open(path) as f:
+        # Omit first row with number of electrodes
+        for line in f.readlines()[1:]:
+            row = line.split('\t')
+            if len(row) < 4:
+                continue
+            labels.append(row[1])
+            theta.append(float(row[2]))
+            phi.append(float(row[3]))
+    theta = asarray(theta)
+    phi = asarray(phi)
+
+    # Coordinates for the topographic maps, with theta normalized to 1
+    theta = theta / theta.max()
+    x = theta * cos(phi / 180 * pi)
+    y = theta * sin(phi / 180 * pi)
+
+    # Transforming into spherical coordinates of the head
+    phi = phi / 180 * pi
+    phi[theta < 0] += pi
+    theta = abs(theta) * pi / 2
+
+    xyz = stack((HEAD_RADIUS * sin(theta) * cos(phi),
+                 HEAD_RADIUS * sin(theta) * sin(phi),
+                 HEAD_RADIUS * cos(theta)), -1)
+    return Montage([label.strip() for label in labels], x, y, theta, phi, xyz,
+                   path, labels)
+
+def montage_from_directions(names, directions, name=None):
+    """Creates a Montage from the unit vectors pointing at the electrodes, with
+    the same topographic map coordinates as read from .elp files."""
+    directions = asarray(directions)
+    theta = arccos(clip(directions[:,2], -1, 1))
+    phi = mod(arctan2(directions[:,1], directions[:,0]), 2 * pi)
+    x = theta / (pi / 2) * cos(phi)
+    y = theta / (pi / 2) * sin(phi)
+    return Montage(names, x, y, theta, phi, HEAD_RADIUS * directions, name)
+
+def standard_montage(system='10-5'):
+    """Creates the electrodes of a standard system (Oostenveld and Praamstra,
+    2001), one of STANDARD_SYSTEMS, on and above the 10% circumference of a
+    spherical head.
+
+    The head is idealized so that the 10% circumference is the equator, Cz is
+    the vertex and each row of electrodes is the circle through its two ends on
+    the circumference and its midline electrode, divided in equal steps. The
+    10-20 system has 21 electrodes, the 10-10 system 69 and the 10-5 system
+    261.
+    """
+    if system not in STANDARD_SYSTEMS:
+        raise ValueError('Unknown electrode system ' + str(system))
+    step = STANDARD_SYSTEMS[system]
+    names = []
+    directions = []
+    for row in range(2, 19, step):
+        prefix = STANDARD_ROWS[row]
+        # Polar angle of the midline electrode, in steps of 5% of the 180
+        # degrees between Fpz and Oz, and the azimuth of the ends of the row on
+        # the circumference, in steps of 5% of its 360 degrees
+        theta = (10 - row) * pi / 16
+        azimuth = row * pi / 20
+        midline = array([0, sin(theta), cos(theta)])
+        end = array([-sin(azimuth), cos(azimuth), 0])
+        if row in (2, 18):
+            # Fp and O rows lie on the circumference, e.g. Fp1, Fpz, Fp2
+            names += [prefix + '1', prefix + 'z', prefix + '2']
+            directions += [end, midline, end * [-1, 1, 1]]
+            continue
+        for column in range(-8, 9, step):
+            name = prefix
+            if abs(column) >= 7 and prefix in TEMPORAL_ROWS:
+                name = TEMPORAL_ROWS[prefix]
+            if column == 0:
+                name += 'z'
+            elif column < 0:
+                # Odd numbers on the left, with h halfway between electrodes
+                name += str(-column - 1) if column % 2 == 0 else \
+                        str(-column) + 'h'
+            else:
+                name += str(column) if column % 2 == 0 else \
+                        str(column + 1) + 'h'
+            names.append(name)
+            directions.append(arc_point(end, midline, abs(column) / 8) *
+                              [1 if column <= 0 else -1, 1, 1])
+    return montage_from_directions(names, directions, system)
+
+def arc_point(end, midline, fraction):
+    """The point at the given fraction of the way from midline to end along
+    the circle on the unit sphere through end, midline and the mirror image of
+    end in the sagittal plane."""
+    normal = cross(end - midline, end * [-1, 1, 1] - midline)
+    normal /= norm(normal)
+    center = dot(normal, midline) * normal
+    u = midline - center
+    v = end - center
+    radius = norm(u)
+    angle = arccos(clip(dot(u, v) / radius**2, -1, 1))
+    w = v - dot(v, u) / radius**2 * u
+    w *= radius / norm(w)
+    return center + cos(fraction * angle) * u + sin(fraction * angle) * w
+
+def geodesic_montage(frequency=6):
+    """Creates a montage sampling the upper hemisphere of the head evenly,
+    with the vertices of an icosahedron with a vertex at Cz whose faces are
+    subdivided frequency times along each edge. The full sphere has
+    10 frequency**2 + 2 vertices, of which frequency 5 gives 126 electrodes on
+    and above the equator, frequency 7 gives 246 and frequency 8 gives 341.
+    """
+    if frequency < 1:
+        raise ValueError
+    # Icosahedron with vertices at the poles and two rings of five vertices,
+    # the front of the head (the Y axis) being a vertex of the upper ring
+    ring = 1 / sqrt(5)
+    vertices = [array([0, 0, 1])]
+    for i in range(5):
+        for z, offset in ((ring, 0), (-ring, pi / 5)):
+            azimuth = pi / 2 + 2 * pi * i / 5 + offset
+            vertices.append(array([2 * ring * cos(azimuth),
+                                   2 * ring * sin(azimuth), z]))
+    vertices.append(array([0, 0, -1]))
+    upper = lambda i: 1 + 2 * (i % 5)
+    lower = lambda i: 2 + 2 * (i % 5)
+    faces = []
+    for i in range(5):
+        faces += [(0, upper(i), upper(i + 1)),
+                  (upper(i), upper(i + 1), lower(i)),
+                  (lower(i), upper(i + 1), lower(i + 1)),
+                  (11, lower(i), lower(i + 1))]
+
+    directions = {}
+    for a, b, c in faces:
+        for i in range(frequency + 1):
+            for j in range(frequency + 1 - i):
+                point = (i * vertices[a] + j * vertices[b] +
+                         (frequency - i - j) * vertices[c])
+                point = point / norm(point)
+                if point[2] > -1e-9:
+                    directions[tuple(around(point, 9))] = point
+    # Ordered from the vertex down, and around the head from the front
+    directions = sorted(directions.values(),
+                        key=lambda p: (around(-p[2], 6),
+                                       around(mod(arctan2(p[0], p[1]),
+                                                  2 * pi), 6)))
+    names = ['E' + str(i + 1) for i in range(len(directions))]
+    return montage_from_directions(names, directions,
+                                   'geodesic_' + str(frequency))
@@ -2,8 +2,10 @@
 # 15/01/2011
 from __future__ import division
 
+import os
+import sys
 from copy import deepcopy
-from numpy import mean, ones, array
+from numpy import mean, ones, array, newaxis, dot
 from matplotlib import pyplot
 from numpy.random import normal, uniform
 from scaling import perform_scaling, test_scaling, create_scaled_data_structure
@@ -12,6 +14,17 @@ from simulation import random_generator_configuration, \
         scale_generator_configuration, gen_simulation
 from topographicmap import plot_simulated_topographies
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+from lead_field import calculate_reference_weights
+
+
+# References of ScalingExperiment and the corresponding references of
+# calculate_reference_weights()
+REFERENCES = {'left_mastoid': 'left mastoid',
+              'average_mastoid': 'linked mastoids',
+              'average': 'average'}
+
 
 class ScalingExperiment:
     def __init__(self, experiment, debug=False, collect=False,
@@ -208,34 +221,15 @@ class ScalingExperiment:
 
 
     def rereference(self, simulated_data_1, simulated_data_2, electrodes):
-        left_mastoid = electrodes.index('      T7')
-        right_mastoid = electrodes.index('      T8')
-        if self.reference == 'left_mastoid':
-            for subject in range(self.number_of_subjects):
-                subject_mastoid_1 = simulated_data_1[subject][left_mastoid]
-                subject_mastoid_2 = simulated_data_2[subject][left_mastoid]
-                simulated_data_1[subject] -= subject_mastoid_1
-                simulated_data_2[subject] -= subject_mastoid_2
-        elif self.reference == 'average_mastoid':
-            for subject in range(self.number_of_subjects):
-                subject_mastoids_1 =\
-                        0.5*simulated_data_1[subject][left_mastoid] +\
-                        0.5*simulated_data_1[subject][right_mastoid]
-                subject_mastoids_2 =\
-                        0.5*simulated_data_2[subject][left_mastoid] +\
-                        0.5*simulated_data_2[subject][right_mastoid]
-                for electrode in range(len(electrodes)):
-                    simulated_data_1[subject][electrode] -=\
-                            subject_mastoids_1
-                    simulated_data_2[subject][electrode] -=\
-                            subject_mastoids_2
-        elif self.reference == 'average':
-            for subject in range(self.number_of_subjects):
-                subject_mean_1 = mean(simulated_data_1[subject])
-                subject_mean_2 = mean(simulated_data_2[subject])
-                for electrode in range(len(electrodes)):
-                    simulated_data_1[subject][electrode] -= subject_mean_1
-                    simulated_data_2[subject][electrode] -= subject_mean_2
+        if self.reference not in REFERENCES:
+            return [simulated_data_1, simulated_data_2]
+        # The mastoids are looked up by name, whether or not the names are
+        # padded as in the .elp file
+        weights = calculate_reference_weights(electrodes,
+                                              REFERENCES[self.reference])
+        # All subjects and electrodes at once
+        simulated_data_1 -= dot(simulated_data_1, weights)[:,newaxis]
+        simulated_data_2 -= dot(simulated_data_2, weights)[:,newaxis]
         return [simulated_data_1, simulated_data_2]
 
 
@@ -5,56 +5,34 @@ This module contains functions to read electrode locations from pre-prepared
 text files and to plot a topographic map of scalp activity.
 
 """
-import csv
+import os
+import sys
 from numpy import cos, sin, abs, pi, array, append, copy, linspace, sqrt, mean
 from numpy.random import uniform
 from numpy.ma import masked_array
 from matplotlib.mlab import griddata
 from matplotlib import pyplot
 
-def read_electrode_locations():
-    """Reads electrode locations from a previously prepared text file."""
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+from montage import get_montage
+
+def read_electrode_locations(file_name=None):
+    """Reads electrode locations from a previously prepared text file.
+
+    The file is parsed only once per process, see montage.get_montage(). The
+    names are returned as written in the file, i.e. padded with spaces, and
+    the coordinates as lists (theta as an array), copies that the caller may
+    modify.
+    """
     # TODO: This should really be reimplemented more cleanly, i.e. a
     # documentation of exactly where are the supposed 10-20 electrode locations
     # coming from, how they were calculated, etc. Perhaps an automated script
     # for the calculation of the electrode location file should also be
     # provided.
-    reader = csv.reader(open('electrodeLocations.elp', 'rb'),
-                        dialect='excel-tab')
-
-    electrodes = []
-    electrode_theta = []
-    electrode_phi = []
-    electrode_x = []
-    electrode_y = []
-
-    for row in reader:
-        # Omit first row with number of electrodes
-        if reader.line_num != 1:
-            electrodes.append(row[1])
-            electrode_theta.append(float(row[2]))
-            electrode_phi.append(float(row[3]))
-
-    max_theta = max(electrode_theta)
-    electrode_theta = array(electrode_theta)
-    electrode_theta = electrode_theta / max_theta
-    
-    for i in range(len(electrodes)):
-        electrode_x.append(electrode_theta[i] *\
-                           cos(electrode_phi[i] / 180 * pi))
-        electrode_y.append(electrode_theta[i] *\
-                           sin(electrode_phi[i] / 180 * pi))
-
-    # Transforming into electrode locations for PyBrainSim
-    for i in range(len(electrode_theta)):
-        if electrode_theta[i] < 0:
-            electrode_phi[i] = electrode_phi[i] / 180 * pi + pi
-        else:
-            electrode_phi[i] = electrode_phi[i] / 180 * pi
-    electrode_theta = abs(electrode_theta) * pi / 2
-
-    return [electrodes, electrode_x, electrode_y,
-            electrode_theta, electrode_phi]
+    montage = get_montage(file_name)
+    return [list(montage.labels), list(montage.x), list(montage.y),
+            montage.theta.copy(), list(montage.phi)]
 
 
 def plot_topographic_map(values, scale=0, plot_legend=True, ax=None):
@@ -0,0 +1,90 @@
+"""
+Sample means and covariances accumulated over chunks of data.
+
+Trial-level or full EEG data is often too large to hold in memory at once.
+Sample_Moments keeps only the count, mean and scatter matrix (the sum of outer
+products of deviations from the mean) of what was added so far. Each chunk is
+centered on its own mean and merged with the formulas of Chan, Golub and
+LeVeque (1979), a chunked form of Welford's algorithm that avoids the
+cancellation of summing squares of uncentered data. Accumulators of separate
+parts of the data, e.g. from different processes, can be merged the same way.
+"""
+
+from __future__ import division
+
+from numpy import asarray, atleast_2d, dot, outer, mean
+
+
+class Sample_Moments():
+    """Running count, mean and scatter matrix of samples of n variables, e.g.
+    electrodes. add() takes arrays of shape (n_samples, n) or single samples
+    of shape (n,), the data of subjects as in read_brittanys_data().
+    covariance() is then the same as numpy.cov(data.T) of all the data.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.scatter = None
+
+    def add(self, samples):
+        """Adds the samples, of shape (n_samples, n) or (n,), and returns the
+        accumulator."""
+        samples = atleast_2d(asarray(samples, dtype=float))
+        chunk = Sample_Moments()
+        chunk.count = samples.shape[0]
+        if chunk.count == 0:
+            return self
+        chunk.mean = mean(samples, 0)
+        deviations = samples - chunk.mean
+        chunk.scatter = dot(deviations.T, deviations)
+        return self.merge(chunk)
+
+    def add_chunks(self, chunks):
+        """Adds every array of an iterable of arrays, e.g. a generator reading
+        one subject or one block of trials at a time, and returns the
+        accumulator."""
+        for samples in chunks:
+            self.add(samples)
+        return self
+
+    def merge(self, other):
+        """Adds the samples accumulated in other and returns the accumulator.
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count = other.count
+            self.mean = other.mean.copy()
+            self.scatter = other.scatter.copy()
+            return self
+        if other.mean.shape != self.mean.shape:
+            raise ValueError('Samples must have the same number of variables')
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.scatter = self.scatter + other.scatter +\
+                       outer(delta, delta) * (self.count * other.count / count)
+        self.count = count
+        return self
+
+    def covariance(self, ddof=1):
+        """Sample covariance matrix, normalized by count - ddof."""
+        if self.count <= ddof:
+            raise ValueError('Not enough samples')
+        return self.scatter / (self.count - ddof)
+
+    def variance(self, ddof=1):
+        if self.count <= ddof:
+            raise ValueError('Not enough samples')
+        return self.scatter.diagonal() / (self.count - ddof)
+
+
+def mean_and_covariance(data):
+    """The mean_data and cov_data used by fit_variability_model(), from an
+    array of shape (n_samples, n) or an iterable of such arrays, which is read
+    one array at a time."""
+    if hasattr(data, 'shape'):
+        moments = Sample_Moments().add(data)
+    else:
+        moments = Sample_Moments().add_chunks(data)
+    return moments.mean, moments.covariance()
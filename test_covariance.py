@@ -0,0 +1,80 @@
+from nose.tools import assert_raises
+from numpy import dot, diag, trace, random, cov
+from numpy.linalg import solve, slogdet, inv
+from numpy.testing import assert_allclose
+
+from covariance import Low_Rank_Covariance
+from lead_field import calculate_reference_weights, rereference_covariance
+
+
+def random_covariance(n_el=20, n_gen=3, reference_weights=None):
+    factor = random.randn(n_el, n_gen)
+    root = random.randn(n_gen, n_gen)
+    diagonal = random.uniform(0.5, 2, n_el)
+    return Low_Rank_Covariance(factor, dot(root, root.T), diagonal,
+                               reference_weights)
+
+
+def test_low_rank_covariance_same_as_dense():
+    random.seed(1)
+    covariance = random_covariance()
+    dense = dot(dot(covariance.factor, covariance.core), covariance.factor.T) +\
+            diag(covariance.diagonal)
+    assert_allclose(covariance.dense(), dense, rtol=1e-12)
+    x = random.randn(20, 4)
+    other = random.randn(20, 20)
+    assert_allclose(covariance.dot(x), dot(dense, x), rtol=1e-12)
+    assert_allclose(covariance.dot(x[:,0]), dot(dense, x[:,0]), rtol=1e-12)
+    assert_allclose(covariance.solve(x), solve(dense, x), rtol=1e-10)
+    assert_allclose(covariance.solve(x[:,0]), solve(dense, x[:,0]),
+                    rtol=1e-10)
+    assert_allclose(covariance.log_determinant(), slogdet(dense)[1],
+                    rtol=1e-12)
+    assert_allclose(covariance.trace_dot(other), trace(dot(dense, other)),
+                    rtol=1e-12)
+    assert_allclose(covariance.trace_solve(other),
+                    trace(solve(dense, other)), rtol=1e-10)
+
+
+def test_low_rank_covariance_reference():
+    random.seed(2)
+    weights = calculate_reference_weights([str(i) for i in range(20)],
+                                          'average')
+    covariance = random_covariance(reference_weights=weights)
+    covariance.factor -= covariance.factor.mean(0)
+    dense = dot(dot(covariance.factor, covariance.core), covariance.factor.T) +\
+            rereference_covariance(diag(covariance.diagonal), weights)
+    assert_allclose(covariance.dense(), dense, rtol=1e-12, atol=1e-12)
+    x = random.randn(20, 3)
+    other = random.randn(20, 20)
+    assert_allclose(covariance.dot(x), dot(dense, x), rtol=1e-12, atol=1e-12)
+    assert_allclose(covariance.trace_dot(other), trace(dot(dense, other)),
+                    rtol=1e-12)
+    assert_raises(ValueError, covariance.solve, x)
+    assert_raises(ValueError, covariance.log_determinant)
+
+
+def test_low_rank_covariance_sample():
+    random.seed(3)
+    covariance = random_covariance(n_el=5, n_gen=2)
+    mean = random.randn(5)
+    samples = covariance.sample(200000, mean)
+    assert samples.shape == (200000, 5)
+    assert_allclose(samples.mean(0), mean, atol=0.05)
+    assert_allclose(cov(samples.T), covariance.dense(), atol=0.1)
+
+
+
+def test_low_rank_covariance_sample_semi_definite_core():
+    random.seed(5)
+    covariance = random_covariance(n_el=5, n_gen=2)
+    covariance.core[:] = [[1, 1], [1, 1]]
+    samples = covariance.sample(200000)
+    assert_allclose(cov(samples.T), covariance.dense(), atol=0.1)
+
+
+def test_low_rank_covariance_inverse_diagonal():
+    random.seed(6)
+    covariance = random_covariance()
+    assert_allclose(covariance.inverse_diagonal(),
+                    diag(inv(covariance.dense())), rtol=1e-10)
@@ -3,8 +3,11 @@
 # the same calculations by hand
 
 from nose.tools import assert_raises
+from numpy import dot, diag, random, cov
+from numpy.testing import assert_array_equal, assert_allclose
 
 from erp_variability_model import ERP_Variability_Model
+from lead_field import Lead_Field
 
 
 def test_erp_variability_model_correct_initialization():
@@ -69,3 +72,184 @@ def test_erp_variability_model_recalculate_model_manual():
     erp_model.calculate_cov()
     assert_up_to_date(erp_model, True, True, True, True)
 
+
+
+def test_erp_variability_model_field_vector_kept_for_orientation_changes():
+    erp_model = ERP_Variability_Model(n_sub=16, n_gen=3)
+    erp_model.set_random_locations_orientations()
+    erp_model.calculate_lead_field()
+    field_vector = erp_model.field_vector
+    
+    erp_model.gen_conf[1]['orientation'] += 0.1
+    erp_model.gen_conf[2]['orientation_phi'] += 0.1
+    erp_model.calculate_lead_field()
+    assert erp_model.field_vector is field_vector
+    assert_array_equal(erp_model.lead_field,
+                       erp_model.lf.calculate(erp_model.gen_conf))
+
+    erp_model.gen_conf[0]['depth'] += 0.1
+    erp_model.calculate_lead_field()
+    assert_array_equal(erp_model.field_vector,
+                       erp_model.lf.calculate_vector(erp_model.gen_conf))
+    assert_array_equal(erp_model.lead_field,
+                       erp_model.lf.calculate(erp_model.gen_conf))
+
+
+def test_erp_variability_model_only_changed_columns_updated():
+    for lf in [None, Lead_Field(cache_size=10)]:
+        erp_model = ERP_Variability_Model(n_sub=16, n_gen=4, lf=lf)
+        erp_model.set_random_locations_orientations()
+        erp_model.set_random_magnitudes()
+        lead_field = erp_model.calculate_lead_field()
+        previous_lead_field = lead_field.copy()
+        assert erp_model.changed_generators() == []
+
+        gen_conf = [dict(gen) for gen in erp_model.gen_conf]
+        erp_model.set_random_locations_orientations([1, 3])
+        assert erp_model.changed_generators() == [1, 3]
+        assert erp_model.gen_conf[0] == gen_conf[0]
+        assert erp_model.gen_conf[3]['magnitude'] == gen_conf[3]['magnitude']
+        erp_model.calculate_lead_field()
+        # The previous lead field is left as it was
+        assert_array_equal(lead_field, previous_lead_field)
+        assert_array_equal(erp_model.lead_field[:,[0, 2]],
+                           previous_lead_field[:,[0, 2]])
+        assert_array_equal(erp_model.lead_field,
+                           erp_model.lf.calculate(erp_model.gen_conf))
+
+
+def test_erp_variability_model_covariance_after_moving_generator():
+    random.seed(9)
+    erp_model = ERP_Variability_Model(n_sub=16, n_gen=3,
+                                      variability_electrodes='constant',
+                                      variability_generators='individual',
+                                      variability_connections='individual')
+    erp_model.set_random()
+    erp_model.recalculate_model()
+    covariance = erp_model.covariance
+    b = random.normal(size=erp_model.n_el)
+    solved = covariance.solve(b)
+    factor = covariance.factor.copy()
+
+    erp_model.set_random_locations_orientations([1])
+    erp_model.simulate()
+    # The previous covariance is unchanged
+    assert_array_equal(covariance.factor, factor)
+    assert_array_equal(covariance.solve(b), solved)
+
+    fresh_model = ERP_Variability_Model(n_sub=16, n_gen=3,
+                                        variability_electrodes='constant',
+                                        variability_generators='individual',
+                                        variability_connections='individual')
+    fresh_model.set_gen_conf([dict(gen) for gen in erp_model.gen_conf])
+    fresh_model.sigma_e = erp_model.sigma_e
+    fresh_model.sigma_g = erp_model.sigma_g
+    fresh_model.sigma_c = erp_model.sigma_c
+    fresh_model.recalculate_model()
+    assert_allclose(erp_model.covariance.solve(b),
+                    fresh_model.covariance.solve(b))
+    random.seed(10)
+    samples = erp_model.covariance.sample(5)
+    random.seed(10)
+    assert_allclose(samples, fresh_model.covariance.sample(5))
+
+
+def test_erp_variability_model_recalculate_model_from_scratch():
+    erp_model = ERP_Variability_Model(n_sub=16, n_gen=3)
+    erp_model.set_random()
+    erp_model.recalculate_model()
+    recalculations = dict(erp_model.up_to_date.recalculations)
+    # Spoiling the lead field, which only a full recalculation repairs
+    erp_model.lead_field = erp_model.lead_field * 2
+    erp_model.recalculate_model()
+    assert_array_equal(erp_model.lead_field,
+                       erp_model.lf.calculate(erp_model.gen_conf))
+    for result in recalculations:
+        assert erp_model.up_to_date.recalculations[result] ==\
+               recalculations[result] + 1
+
+
+def test_erp_variability_model_reference():
+    erp_model = ERP_Variability_Model(n_sub=16, n_gen=3,
+                                      variability_electrodes='constant',
+                                      variability_generators='individual',
+                                      lf=Lead_Field(reference='average'))
+    erp_model.set_random()
+    erp_model.calculate_mean()
+    erp_model.calculate_cov()
+    # Average referenced data sum to 0 over the electrodes
+    assert abs(erp_model.mean.sum()) <= 1e-10 * abs(erp_model.mean).max()
+    assert abs(erp_model.cov.sum(0)).max() <= 1e-10 * abs(erp_model.cov).max()
+
+
+def test_erp_variability_model_montage():
+    erp_model = ERP_Variability_Model(n_sub=16, n_gen=5,
+                                      variability_electrodes='individual',
+                                      montage='geodesic_5')
+    assert erp_model.n_el == 126
+    erp_model.set_random_locations_orientations()
+    erp_model.set_random_magnitudes()
+    erp_model.set_random_variability()
+    erp_model.recalculate_model()
+    assert erp_model.lead_field.shape == (126, 5)
+    assert erp_model.cov.shape == (126, 126)
+
+
+def test_erp_variability_model_individual_electrode_variance():
+    random.seed(4)
+    erp_model = ERP_Variability_Model(n_sub=16, n_gen=3,
+                                      variability_electrodes='individual',
+                                      variability_generators='individual')
+    erp_model.set_random()
+    erp_model.recalculate_model()
+    lead_field = erp_model.lead_field
+    assert_allclose(erp_model.cov,
+                    dot(dot(lead_field, erp_model.cov_gen), lead_field.T) +
+                    diag(erp_model.sigma_e), rtol=1e-12)
+
+
+def test_erp_variability_model_simulate_factor_kept():
+    random.seed(6)
+    erp_model = ERP_Variability_Model(n_sub=1000, n_gen=3,
+                                      variability_electrodes='constant',
+                                      variability_generators='individual',
+                                      variability_connections='individual')
+    erp_model.set_random()
+    data = erp_model.simulate()
+    assert data.shape == (1000, 60)
+    sampling_factor = erp_model.covariance.sampling_factor
+    erp_model.simulate()
+    assert erp_model.covariance.sampling_factor is sampling_factor
+    erp_model.set_random_variability_generators()
+    erp_model.simulate()
+    assert erp_model.covariance.sampling_factor is not sampling_factor
+
+
+def test_erp_variability_model_simulate_many():
+    erp_model = ERP_Variability_Model(n_sub=8, n_gen=3,
+                                      variability_electrodes='constant',
+                                      variability_generators='individual')
+    random.seed(7)
+    erp_model.set_random()
+    random.seed(8)
+    data = erp_model.simulate_many(10, chunk=4)
+    assert data.shape == (10, 8, 60)
+    random.seed(8)
+    means, covs = erp_model.simulate_many(10, chunk=4, summary=True)
+    assert_allclose(means, data.mean(1), rtol=1e-12)
+    for i in range(10):
+        assert_allclose(covs[i], cov(data[i].T), rtol=1e-10, atol=1e-12)
+
+    random.seed(8)
+    add = lambda value, chunk: chunk[0].sum(0) + (0 if value is None else value)
+    count = lambda value, chunk: len(chunk[0]) + (0 if value is None else value)
+    results = erp_model.simulate_many(10, chunk=4, summary=True,
+                                      reducers={'sum': add, 'count': count})
+    assert results['count'] == 10
+    assert_allclose(results['sum'], means.sum(0), rtol=1e-12)
+
+    # A single subject has no sample covariance, but can still be simulated
+    erp_model.n_sub = 1
+    assert_raises(ValueError, erp_model.simulate_chunks, 10, summary=True)
+    assert_raises(ValueError, erp_model.simulate_many, 10, summary=True)
+    assert erp_model.simulate_many(10, chunk=4).shape == (10, 1, 60)
@@ -1,8 +1,30 @@
-from numpy import pi, zeros, random
-from numpy.linalg import norm
+import os
+import sys
+from subprocess import check_output
+
+from nose.tools import assert_raises
+from numpy import pi, zeros, random, array, dot, diag, sqrt
+from numpy.linalg import norm, cholesky, eigvalsh
+from numpy.testing import assert_allclose, assert_array_equal
 
 from erp_variability_model_fit import ERP_Variability_Model_Fit, error_cov, \
-                                      fit_variability_model
+                                      error_mean, error_mean_and_cov, \
+                                      error_likelihood, fit_variability_model
+from lead_field import Lead_Field
+
+
+# Seconds allowed for importing the fitting module in a fresh interpreter, which
+# is what every worker process pays before doing any work
+IMPORT_TIME_BUDGET = 1.0
+
+def measure_import(module):
+    """Time taken to import module in a fresh interpreter, and whether it
+    imported matplotlib."""
+    code = ('import sys, time; start = time.time(); import ' + module +
+            '; print(repr((time.time() - start, "matplotlib" in sys.modules)))')
+    output = check_output([sys.executable, '-c', code],
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+    return eval(output.strip().splitlines()[-1])
 
 
 def test_erp_variability_model_fit_initialization():
@@ -117,3 +139,203 @@ def test_fit_variability_model():
                           erp_model_1.cov, max_fun_eval=100000)
     erp_model_1.print_model()
     erp_model_2.print_model()
+
+
+def test_error_likelihood_gradient():
+    parameter_list = ['locations and orientations', 'amplitudes',
+                      'generator variance', 'generator covariance',
+                      'electrode variance']
+    for variability, connections, parameterization in (
+                                ('constant', 'individual', 'variance'),
+                                ('individual', 'individual', 'variance'),
+                                ('individual', 'individual', 'log-cholesky'),
+                                ('individual', 'none', 'log-cholesky')):
+        erp_model = ERP_Variability_Model_Fit(n_sub=20, n_gen=2,
+                              variability_electrodes=variability,
+                              variability_generators=variability,
+                              variability_connections=connections,
+                              generator_parameterization=parameterization)
+        erp_model.set_gen_conf([{'depth': 6, 'theta': pi/8, 'phi': pi/4,
+                                 'orientation': pi/3, 'orientation_phi': pi/5,
+                                 'magnitude': 2},
+                                {'depth': 7, 'theta': 3*pi/8, 'phi': 3*pi/4,
+                                 'orientation': pi/4, 'orientation_phi': 3*pi/4,
+                                 'magnitude': -1}])
+        if parameterization == 'log-cholesky':
+            erp_model.set_gen_cholesky(cholesky([[2, 0.5], [0.5, 3]]))
+        else:
+            erp_model.sigma_g = 2 if variability == 'constant' else [2, 3]
+            erp_model.sigma_c = array([[0, 0.5], [0.5, 0]])
+        erp_model.sigma_e = 1 if variability == 'constant' else \
+                            random.uniform(0.5, 1.5, erp_model.n_el)
+        data = erp_model.simulate()
+        parameters = array(erp_model.get_parameters(parameter_list))
+
+        error, gradient = error_likelihood(data, erp_model, parameter_list,
+                                           parameters, gradient=True)
+        assert error == error_likelihood(data, erp_model, parameter_list,
+                                         parameters)
+        step = 1e-6
+        numerical = zeros(len(parameters))
+        for i in range(len(parameters)):
+            shift = zeros(len(parameters))
+            shift[i] = step
+            numerical[i] = (error_likelihood(data, erp_model, parameter_list,
+                                             parameters + shift) -
+                            error_likelihood(data, erp_model, parameter_list,
+                                             parameters - shift)) / (2 * step)
+        assert_allclose(gradient, numerical, rtol=1e-4, atol=1e-4)
+
+
+def test_error_likelihood_gradient_other_lead_fields():
+    # The gradient of everything but the locations and orientations is exact
+    # for lead fields calculated in any way
+    parameter_list = ['amplitudes', 'generator variance',
+                      'generator covariance', 'electrode variance']
+    for lf in (Lead_Field(method='table', grid_tolerance=1e-3),
+               Lead_Field(cache_size=10, cache_quantization=0.01),
+               Lead_Field(model='frank_1952')):
+        random.seed(5)
+        erp_model = ERP_Variability_Model_Fit(n_sub=20, n_gen=2,
+                              variability_electrodes='constant',
+                              variability_generators='individual',
+                              variability_connections='individual', lf=lf)
+        erp_model.set_random()
+        data = erp_model.simulate()
+        parameters = array(erp_model.get_parameters(parameter_list))
+        error, gradient = error_likelihood(data, erp_model, parameter_list,
+                                           parameters, gradient=True)
+        step = 1e-6
+        numerical = zeros(len(parameters))
+        for i in range(len(parameters)):
+            shift = zeros(len(parameters))
+            shift[i] = step
+            numerical[i] = (error_likelihood(data, erp_model, parameter_list,
+                                             parameters + shift) -
+                            error_likelihood(data, erp_model, parameter_list,
+                                             parameters - shift)) / (2 * step)
+        assert_allclose(gradient, numerical, rtol=1e-4, atol=1e-4)
+        # The jacobian of the lead field would not be that of this lead field
+        assert_raises(ValueError, error_likelihood, data, erp_model,
+                      ['locations and orientations'],
+                      erp_model.get_parameters(['locations and orientations']),
+                      gradient=True)
+        assert_raises(ValueError, fit_variability_model, erp_model,
+                      ['locations and orientations'], 'likelihood', data)
+
+
+def test_generator_cholesky_parameterization():
+    erp_model = ERP_Variability_Model_Fit(n_sub=16, n_gen=4,
+                          variability_electrodes='constant',
+                          variability_generators='individual',
+                          variability_connections='individual',
+                          generator_parameterization='log-cholesky')
+    erp_model.set_random()
+    parameter_list = ['generator variance', 'generator covariance']
+    parameters = erp_model.get_parameters(parameter_list)
+    assert len(parameters) == 4 + 6
+    assert erp_model.get_bounds(parameter_list) == [(None, None)] * 10
+    erp_model.set_parameters(parameter_list, parameters)
+    assert_allclose(erp_model.get_parameters(parameter_list), parameters)
+    # Positive definite whatever the parameters
+    for i in range(20):
+        erp_model.set_parameters(parameter_list, random.normal(0, 3, 10))
+        assert eigvalsh(erp_model.calculate_cov_gen()).min() > 0
+    # The factor is used for sampling
+    erp_model.calculate_cov()
+    assert_allclose(erp_model.covariance.calculate_sampling_factor(),
+                    dot(erp_model.lead_field, erp_model.gen_cholesky))
+    assert_raises(ValueError, ERP_Variability_Model_Fit, n_sub=16, n_gen=4,
+                  variability_generators='constant',
+                  generator_parameterization='log-cholesky')
+    # Its logarithm is a parameter, so the diagonal must be positive
+    assert_raises(ValueError, erp_model.set_gen_cholesky,
+                  diag([1., 0, 1, 1]))
+    # Without connections only the variances of the factor are used
+    erp_model = ERP_Variability_Model_Fit(n_sub=16, n_gen=4,
+                          variability_electrodes='constant',
+                          variability_generators='individual',
+                          variability_connections='none',
+                          generator_parameterization='log-cholesky')
+    erp_model.set_random()
+    erp_model.set_gen_cholesky(cholesky([[2, 1, 0, 0], [1, 3, 0.5, 0],
+                                         [0, 0.5, 2, 0], [0, 0, 0, 1]]))
+    assert_allclose(erp_model.gen_cholesky, diag(sqrt(erp_model.sigma_g)))
+    assert_array_equal(erp_model.sigma_c, zeros((4, 4)))
+    erp_model.calculate_cov()
+    sampling_factor = erp_model.covariance.calculate_sampling_factor()
+    assert_allclose(dot(sampling_factor, sampling_factor.T),
+                    dot(erp_model.lead_field * erp_model.sigma_g,
+                        erp_model.lead_field.T))
+
+
+def test_erp_variability_model_fit_import_time():
+    # The best of a few imports, to be robust against a busy machine
+    measurements = [measure_import('erp_variability_model_fit')
+                    for i in range(3)]
+    assert not any(matplotlib for time, matplotlib in measurements)
+    assert min(time for time, matplotlib in measurements) < IMPORT_TIME_BUDGET
+
+
+def test_erp_variability_model_fit_only_dependents_recalculated():
+    erp_model = ERP_Variability_Model_Fit(n_sub=16, n_gen=3,
+                        variability_electrodes='constant',
+                        variability_generators='individual',
+                        variability_connections='individual')
+    erp_model.set_random_locations_orientations()
+    erp_model.set_random_magnitudes()
+    erp_model.set_random_variability()
+    erp_model.recalculate_model()
+    recalculations = erp_model.up_to_date.recalculations
+    assert recalculations == {'lead field': 1, 'mean': 1,
+                              'covariance generators': 1, 'covariance': 1}
+
+    parameter_list = ['amplitudes']
+    error_mean(erp_model.mean, erp_model, parameter_list,
+               erp_model.get_parameters(parameter_list))
+    assert recalculations['lead field'] == 1
+    assert recalculations['mean'] == 2
+    assert erp_model.up_to_date['covariance']
+
+    parameter_list = ['generator variance', 'electrode variance']
+    error_cov(erp_model.cov, erp_model, parameter_list,
+              erp_model.get_parameters(parameter_list))
+    assert recalculations == {'lead field': 1, 'mean': 2,
+                              'covariance generators': 2, 'covariance': 2}
+    assert erp_model.up_to_date['mean']
+
+    parameter_list = ['locations and orientations']
+    erp_model.set_parameters(parameter_list,
+                             erp_model.get_parameters(parameter_list))
+    assert not erp_model.up_to_date['mean']
+    assert not erp_model.up_to_date['covariance']
+    assert erp_model.up_to_date['covariance generators']
+
+    # Repeated evaluations only recalculate what depends on the parameters
+    erp_model.recalculate_model()
+    mean_data = erp_model.mean
+    cov_data = erp_model.cov
+    for parameter_list, error, expected in (
+        (['amplitudes'], lambda parameters:
+                error_cov(cov_data, erp_model, ['amplitudes'], parameters),
+         {}),
+        (['generator variance'], lambda parameters:
+                error_cov(cov_data, erp_model, ['generator variance'],
+                          parameters),
+         {'covariance generators': 5, 'covariance': 5}),
+        (['amplitudes'], lambda parameters:
+                error_mean_and_cov(mean_data, cov_data, erp_model,
+                                   ['amplitudes'], parameters),
+         {'mean': 5}),
+        (['generator variance'], lambda parameters:
+                error_mean_and_cov(mean_data, cov_data, erp_model,
+                                   ['generator variance'], parameters),
+         {'covariance generators': 5, 'covariance': 5})):
+        erp_model.recalculate_model()
+        before = dict(recalculations)
+        parameters = erp_model.get_parameters(parameter_list)
+        for i in range(5):
+            error(parameters)
+        assert dict((result, recalculations[result] - before[result])
+                    for result in recalculations
+                    if recalculations[result] != before[result]) == expected
@@ -0,0 +1,97 @@
+from nose.tools import assert_raises
+from numpy import random, cov, zeros, sqrt, newaxis
+from numpy.testing import assert_allclose
+
+from erp_variability_model import ERP_Variability_Model
+from erp_variability_model_temporal import ERP_Variability_Model_Temporal
+
+
+def random_temporal_model(n_sub=16, n_times=30, windows=((0, 10), (10, 30))):
+    erp_model = ERP_Variability_Model_Temporal(n_sub=n_sub, n_gen=3,
+                                n_times=n_times, windows=windows,
+                                variability_electrodes='constant',
+                                variability_generators='individual',
+                                variability_connections='individual')
+    erp_model.set_random()
+    return erp_model
+
+
+def test_erp_variability_model_temporal_windows():
+    for windows in ([(0, 10), (12, 30)], [(0, 10)], [(0, 20), (20, 20),
+                                                      (20, 30)]):
+        assert_raises(ValueError, ERP_Variability_Model_Temporal, n_sub=16,
+                      n_gen=3, n_times=30, windows=windows)
+    erp_model = random_temporal_model()
+    assert len(erp_model.sigma_g) == len(erp_model.sigma_c) == 2
+    assert_raises(ValueError, erp_model.set_waveforms, zeros((3, 29)))
+
+
+def test_erp_variability_model_temporal_same_as_spatial():
+    # Each sample is the spatial model with the waveforms as amplitudes
+    erp_model = random_temporal_model()
+    erp_model.recalculate_model()
+    assert erp_model.data.shape == (16, erp_model.n_el, 30)
+    spatial_model = ERP_Variability_Model(n_sub=16, n_gen=3,
+                                variability_electrodes='constant',
+                                variability_generators='individual',
+                                variability_connections='individual',
+                                lf=erp_model.lf)
+    spatial_model.set_gen_conf([dict(gen) for gen in erp_model.gen_conf])
+    spatial_model.sigma_e = erp_model.sigma_e
+    for window, (start, stop) in enumerate(erp_model.windows):
+        spatial_model.sigma_g = erp_model.sigma_g[window]
+        spatial_model.sigma_c = erp_model.sigma_c[window]
+        spatial_model.up_to_date.invalidate('generator variance')
+        spatial_model.calculate_cov()
+        assert_allclose(erp_model.cov[window], spatial_model.cov)
+        for time in range(start, stop):
+            for gen in range(3):
+                spatial_model.gen_conf[gen]['magnitude'] = \
+                        erp_model.waveforms[gen,time]
+            spatial_model.up_to_date.invalidate('amplitudes')
+            assert_allclose(erp_model.mean[:,time],
+                            spatial_model.calculate_mean())
+
+
+def test_erp_variability_model_temporal_simulate():
+    random.seed(0)
+    erp_model = random_temporal_model(n_sub=2000, n_times=4,
+                                      windows=[(0, 1), (1, 4)])
+    data = erp_model.simulate()
+    for window, (start, stop) in enumerate(erp_model.windows):
+        standard_error = sqrt(erp_model.cov[window].diagonal() / 2000)
+        assert (abs(data.mean(0) - erp_model.mean)[:,start:stop] <
+                5 * standard_error[:,newaxis]).all()
+        samples = (data - erp_model.mean)[:,:,start:stop]
+        samples = samples.transpose((0,2,1)).reshape((-1, erp_model.n_el))
+        assert_allclose(cov(samples.T), erp_model.cov[window],
+                        atol=0.1 * abs(erp_model.cov[window]).max())
+
+
+def test_erp_variability_model_temporal_simulate_many():
+    erp_model = random_temporal_model(n_sub=4)
+    data = erp_model.simulate_many(5, chunk=2)
+    assert data.shape == (5, 4, erp_model.n_el, 30)
+    # A dataset on its own is drawn as in simulate()
+    random.seed(1)
+    data = next(erp_model.simulate_chunks(1))
+    random.seed(1)
+    assert_allclose(data[0], erp_model.simulate())
+    results = erp_model.simulate_many(5, chunk=2, reducers={'count':
+                            lambda value, chunk: len(chunk) + (value or 0)})
+    assert results['count'] == 5
+    assert_raises(ValueError, erp_model.simulate_chunks, 5, summary=True)
+    assert_raises(ValueError, erp_model.simulate_many, 5, summary=True)
+
+
+def test_erp_variability_model_temporal_solve_waveforms():
+    erp_model = random_temporal_model()
+    waveforms = erp_model.waveforms
+    mean = erp_model.calculate_mean()
+    erp_model.set_waveforms(zeros(waveforms.shape))
+    assert not erp_model.up_to_date['mean']
+    assert erp_model.up_to_date['lead field']
+    assert_allclose(erp_model.solve_waveforms(mean), waveforms,
+                    atol=1e-8 * abs(waveforms).max())
+    assert_allclose(erp_model.solve_waveforms(mean, weighted=True), waveforms,
+                    atol=1e-8 * abs(waveforms).max())
@@ -1,7 +1,13 @@
 from lead_field import calculate_lead_field
-from generator_configuration import random_generator_placement
+from generator_configuration import random_generator_placement, \
+                                    gen_conf_to_array, array_to_gen_conf
 
 
 def test_random_generator_placement_good_for_lead_field_calculation():
     gen_conf = random_generator_placement()
     calculate_lead_field(gen_conf)
+
+
+def test_gen_conf_to_array_and_back():
+    gen_conf = random_generator_placement()
+    assert gen_conf == array_to_gen_conf(gen_conf_to_array(gen_conf))
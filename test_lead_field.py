@@ -1,14 +1,29 @@
 import pickle
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
 
 from nose import with_setup
-from numpy import array_equal
-from numpy.testing import assert_array_equal, assert_array_almost_equal
+from nose.tools import assert_raises
+from numpy import array, array_equal, pi, random, memmap, zeros, sin, cos,\
+                  dot, transpose, newaxis
+from scipy.spatial.distance import cdist
+from numpy.testing import assert_array_equal, assert_array_almost_equal, \
+                          assert_allclose
 
-from lead_field import calculate_lead_field, Lead_Field
+from lead_field import calculate_lead_field, Lead_Field, BRODY_1973_WORK_SIZE,\
+                       FOUR_SHELLS, calculate_multishell_coefficients,\
+                       fit_berg_scherg, calculate_reference_weights,\
+                       rereference, calculate_lead_field_given_electrodes
+from generator_configuration import random_generator_placement, \
+                                    gen_conf_to_array, array_to_gen_conf
 
 
 old_code = None
 
+limits = {'n_gen': (3,3), 'depth': (0.5,11), 'theta': (0,pi), 'phi': (0,2*pi),
+          'orientation': (0,pi), 'orientation_phi': (0,2*pi)}
+
 def setup_func():
     global old_code
     with open('test_lead_field_same_output_as_old_code.data', 'r') as f:
@@ -55,3 +70,291 @@ def test_lead_field_class_same_output_as_function():
         lead_field_function = calculate_lead_field(old_code[i]['gen_conf'])
         assert_array_equal(lead_field_class, lead_field_function)
     
+
+def calculate_lead_field_per_generator(gen_conf, radius, xyz_el):
+    """The original calculation of the lead field, with a rotation matrix for
+    each generator, kept for comparison."""
+    sigma = 1.0
+    n_gen = len(gen_conf)
+    n_el = xyz_el.shape[0]
+    xyz_dipole = zeros((n_gen,3))
+    xyz_orientation = zeros((n_gen,3))
+    for i_gen in range(n_gen):
+        dipole_radius = radius - gen_conf[i_gen]['depth']
+        cos_dipole_theta = cos(gen_conf[i_gen]['theta'])
+        sin_dipole_theta = sin(gen_conf[i_gen]['theta'])
+        cos_dipole_phi = cos(gen_conf[i_gen]['phi'])
+        sin_dipole_phi = sin(gen_conf[i_gen]['phi'])
+        xyz_dipole[i_gen,0] = dipole_radius * sin_dipole_theta * cos_dipole_phi
+        xyz_dipole[i_gen,1] = dipole_radius * sin_dipole_theta * sin_dipole_phi
+        xyz_dipole[i_gen,2] = dipole_radius * cos_dipole_theta
+
+        orientation_theta = gen_conf[i_gen]['orientation']
+        orientation_phi = gen_conf[i_gen]['orientation_phi']
+        xyz_orientation_rotated = zeros(3)
+        xyz_orientation_rotated[0] = sin(orientation_theta) * \
+                                     cos(orientation_phi)
+        xyz_orientation_rotated[1] = sin(orientation_theta) * \
+                                     sin(orientation_phi)
+        xyz_orientation_rotated[2] = cos(orientation_theta)
+        rotation_matrix = array([[sin_dipole_phi,
+                                  cos_dipole_theta * cos_dipole_phi,
+                                  sin_dipole_theta * cos_dipole_phi],
+                                 [-cos_dipole_phi,
+                                  cos_dipole_theta * sin_dipole_phi,
+                                  sin_dipole_theta * sin_dipole_phi],
+                                 [0, -sin_dipole_theta, cos_dipole_theta]])
+        xyz_orientation[i_gen,:] = dot(rotation_matrix,
+                                       xyz_orientation_rotated)
+
+    distance = cdist(xyz_el, xyz_dipole)
+    r_cos_phi = dot(xyz_el, transpose(xyz_dipole)) / radius
+    xyz_el_b = xyz_el[:,newaxis,:] + zeros((n_el,n_gen,3))
+    xyz_dipole_b = xyz_dipole[newaxis,:,:] + zeros((n_el,n_gen,3))
+    field_vector = xyz_el_b - xyz_dipole_b
+    field_vector = 2*field_vector / (distance**2)[:,:,newaxis]
+    field_vector += (1/(radius**2)) * \
+            ((xyz_el_b * r_cos_phi[:,:,newaxis] - radius * xyz_dipole_b) /\
+             (distance - r_cos_phi + radius)[:,:,newaxis] + xyz_el_b)
+    field_vector /= 4 * pi * sigma * distance[:,:,newaxis]
+    return (field_vector * xyz_orientation[newaxis,:,:]).sum(2)
+
+
+def test_lead_field_batch_same_output_as_per_generator_code():
+    # Agreeing to rounding of the orientations, which is amplified where the
+    # components of the lead field cancel
+    lf = Lead_Field()
+    random.seed(0)
+    gen_confs = [random_generator_placement(limits) for i in range(10)]
+    lead_fields = lf.calculate_batch([gen_conf_to_array(gen_conf)
+                                      for gen_conf in gen_confs])
+    for i in range(len(gen_confs)):
+        lead_field = calculate_lead_field_per_generator(gen_confs[i],
+                                                        lf.radius, lf.xyz_el)
+        assert_allclose(lead_fields[i], lead_field, rtol=1e-15,
+                        atol=1e-15 * abs(lead_field).max())
+
+
+def test_lead_field_batch_same_output_as_single_configurations():
+    lf = Lead_Field()
+    random.seed(0)
+    gen_confs = [random_generator_placement(limits) for i in range(10)]
+    lead_fields = lf.calculate_batch([gen_conf_to_array(gen_conf)
+                                      for gen_conf in gen_confs])
+    assert lead_fields.shape == (10, lf.xyz_el.shape[0], 3)
+    for i in range(len(gen_confs)):
+        assert_array_equal(lead_fields[i], lf.calculate(gen_confs[i]))
+
+
+def test_lead_field_jacobian_same_as_finite_differences():
+    yield check_jacobian_same_as_finite_differences, Lead_Field()
+    yield check_jacobian_same_as_finite_differences, Lead_Field(
+                                                        model='berg_scherg')
+    yield check_jacobian_same_as_finite_differences, Lead_Field(
+                                                        model='infinite')
+
+def check_jacobian_same_as_finite_differences(lf):
+    random.seed(1)
+    gen_array = gen_conf_to_array(random_generator_placement(limits))
+    lead_field, jacobian = lf.calculate_with_jacobian(
+                                        array_to_gen_conf(gen_array))
+    assert_array_equal(lead_field, lf.calculate_batch([gen_array])[0])
+    assert jacobian.shape == lead_field.shape + (5,)
+    step = 1e-6
+    for parameter in range(5):
+        plus = gen_array.copy()
+        plus[:,parameter] += step
+        minus = gen_array.copy()
+        minus[:,parameter] -= step
+        finite_difference = (lf.calculate_batch([plus])[0] -
+                             lf.calculate_batch([minus])[0]) / (2*step)
+        assert_allclose(jacobian[:,:,parameter], finite_difference,
+                        rtol=0, atol=1e-7*abs(finite_difference).max())
+
+
+def test_lead_field_cache():
+    lf = Lead_Field()
+    lf_cached = Lead_Field(cache_size=4)
+    random.seed(2)
+    gen_conf = random_generator_placement(limits)
+    assert_array_equal(lf_cached.calculate(gen_conf), lf.calculate(gen_conf))
+    assert lf_cached.cache_info()['misses'] == 3
+    # Moving one of the generators only needs one new column
+    gen_conf[1] = random_generator_placement(limits)[0]
+    assert_array_equal(lf_cached.calculate(gen_conf), lf.calculate(gen_conf))
+    info = lf_cached.cache_info()
+    assert (info['hits'], info['misses'], info['evictions'], info['size']) ==\
+           (2, 4, 0, 4)
+    gen_conf[2] = random_generator_placement(limits)[0]
+    lf_cached.calculate(gen_conf)
+    info = lf_cached.cache_info()
+    assert (info['hits'], info['misses'], info['evictions'], info['size']) ==\
+           (4, 5, 1, 4)
+
+
+def test_lead_field_cache_quantization():
+    lf_cached = Lead_Field(cache_size=10, cache_quantization=0.01)
+    gen_conf = [{'depth': 6, 'theta': 0.5, 'phi': 1, 'orientation': 0.2,
+                 'orientation_phi': 0.3}]
+    lead_field = lf_cached.calculate(gen_conf)
+    gen_conf[0]['depth'] = 6.001
+    assert_array_equal(lf_cached.calculate(gen_conf), lead_field)
+    assert lf_cached.cache_info()['hits'] == 1
+
+
+def test_lead_field_grid():
+    lf = Lead_Field()
+    directory = mkdtemp()
+    try:
+        grid_file = join(directory, 'grid.npy')
+        lf_grid = Lead_Field(method='grid', grid_tolerance=0.05,
+                             grid_file=grid_file)
+        report = lf_grid.grid.validation_report
+        assert report['passed']
+        assert report['max relative error'] <= 0.05
+        random.seed(3)
+        gen_conf = random_generator_placement()
+        exact = lf.calculate(gen_conf)
+        assert abs(lf_grid.calculate(gen_conf) - exact).max() <=\
+               0.05 * abs(exact).max()
+
+        # The saved grid is memory-mapped instead of being calculated again
+        lf_loaded = Lead_Field(method='grid', grid_tolerance=0.05,
+                               grid_file=grid_file)
+        assert isinstance(lf_loaded.grid.grid, memmap)
+        assert_array_equal(lf_loaded.calculate(gen_conf),
+                           lf_grid.calculate(gen_conf))
+    finally:
+        rmtree(directory)
+
+
+def test_lead_field_table():
+    lf = Lead_Field()
+    lf_table = Lead_Field(method='table', grid_tolerance=1e-3)
+    report = lf_table.grid.validation_report
+    assert report['passed']
+    assert report['grid size'] < 2**20
+    random.seed(8)
+    gen_conf = random_generator_placement()
+    exact = lf.calculate(gen_conf)
+    assert_allclose(lf_table.calculate(gen_conf), exact, rtol=0,
+                    atol=1e-3*abs(exact).max())
+    assert_allclose(lf_table.project(lf_table.calculate_vector(gen_conf),
+                                     gen_conf),
+                    lf_table.calculate(gen_conf), rtol=1e-12, atol=0)
+
+
+def test_lead_field_vector_projection_same_as_lead_field():
+    lf = Lead_Field()
+    random.seed(4)
+    gen_conf = random_generator_placement(limits)
+    field_vector = lf.calculate_vector(gen_conf)
+    assert field_vector.shape == (lf.xyz_el.shape[0], 3, 3)
+    assert_array_equal(lf.project(field_vector, gen_conf),
+                       lf.calculate(gen_conf))
+
+
+def test_lead_field_blocked_same_output_as_direct():
+    lf = Lead_Field()
+    random.seed(5)
+    gen_arrays = [gen_conf_to_array(random_generator_placement(limits))
+                  for i in range(4)]
+    lead_fields = lf.calculate_batch(gen_arrays)
+    # Small enough for two generators of all four configurations in each tile
+    max_memory = 2 * 4 * lf.xyz_el.shape[0] * BRODY_1973_WORK_SIZE * 8
+    for n_threads in [1, 3]:
+        lf_blocked = Lead_Field(max_memory=max_memory, n_threads=n_threads)
+        assert_array_equal(lf_blocked.calculate_batch(gen_arrays), lead_fields)
+        assert_array_equal(lf_blocked.calculate(array_to_gen_conf(
+                                    gen_arrays[0])), lead_fields[0])
+
+
+def test_lead_field_berg_scherg():
+    random.seed(6)
+    gen_arrays = [gen_conf_to_array(random_generator_placement(limits))
+                  for i in range(4)]
+    lead_fields = Lead_Field().calculate_batch(gen_arrays)
+    # Shells of equal conductivity make up a homogeneous sphere
+    shells = ((0.8, 0.5), (0.9, 0.5), (1.0, 0.5))
+    assert_allclose(calculate_multishell_coefficients(shells), 1)
+    lf = Lead_Field(model='berg_scherg', shells=shells)
+    assert_allclose(0.5 * lf.calculate_batch(gen_arrays), lead_fields,
+                    rtol=0, atol=1e-12*abs(lead_fields).max())
+    # The series coefficients of the shells are approximated by the Berg
+    # dipoles, with the first one matched exactly
+    f = calculate_multishell_coefficients(FOUR_SHELLS)
+    magnitudes, eccentricities = fit_berg_scherg(FOUR_SHELLS)
+    approximation = [(magnitudes * eccentricities**n).sum()
+                     for n in range(len(f))]
+    assert_allclose(approximation[0], f[0])
+    assert_allclose(approximation, f, rtol=0, atol=1e-2*f[0])
+    lf = Lead_Field(model='berg_scherg')
+    lead_field = lf.calculate_batch(gen_arrays[:1])[0]
+    assert_array_equal(lf.calculate(array_to_gen_conf(gen_arrays[0])),
+                       lead_field)
+
+
+def test_lead_field_frank_1952_same_as_brody_1973():
+    random.seed(7)
+    gen_arrays = [gen_conf_to_array(random_generator_placement(limits))
+                  for i in range(4)]
+    lead_fields = Lead_Field().calculate_batch(gen_arrays)
+    lf = Lead_Field(model='frank_1952')
+    assert_allclose(lf.calculate_batch(gen_arrays), lead_fields, rtol=0,
+                    atol=1e-12*abs(lead_fields).max())
+
+
+def test_lead_field_reference():
+    random.seed(9)
+    gen_conf = random_generator_placement(limits)
+    lead_field = Lead_Field().calculate(gen_conf)
+    electrodes = ['Fz', ' T7', 'Cz', 'T8']
+    assert calculate_reference_weights(electrodes, 'none') is None
+    assert_array_equal(calculate_reference_weights(electrodes, 'average'),
+                       [0.25, 0.25, 0.25, 0.25])
+    assert_array_equal(calculate_reference_weights(electrodes,
+                                                   'linked mastoids'),
+                       [0, 0.5, 0, 0.5])
+    assert_array_equal(calculate_reference_weights(electrodes, 'Cz'),
+                       [0, 0, 1, 0])
+    assert_raises(ValueError, calculate_reference_weights, electrodes, 'Pz')
+
+    lf = Lead_Field(reference='average')
+    assert_allclose(lf.calculate(gen_conf),
+                    lead_field - lead_field.mean(0), rtol=1e-12, atol=0)
+    assert_allclose(lf.project(lf.calculate_vector(gen_conf), gen_conf),
+                    lf.calculate(gen_conf), rtol=1e-12, atol=0)
+    lf = Lead_Field(reference='left mastoid')
+    referenced = lf.calculate(gen_conf)
+    assert_array_equal(referenced[lf.reference_weights == 1], 0)
+    assert_allclose(referenced,
+                    rereference(lead_field, lf.reference_weights),
+                    rtol=0, atol=0)
+
+
+def test_lead_field_subjects():
+    random.seed(11)
+    gen_conf = random_generator_placement()
+    radii = array([10.5, 11.5, 12.3])
+    for model in ['brody_1973', 'berg_scherg']:
+        lf = Lead_Field(model=model)
+        lead_fields = lf.calculate_subjects(gen_conf, radii)
+        assert lead_fields.shape == (3, 60, len(gen_conf))
+        for i, radius in enumerate(radii):
+            lead_field = calculate_lead_field_given_electrodes(gen_conf,
+                            radius, lf.xyz_el / lf.radius * radius, model,
+                            lf.shells)
+            assert_allclose(lead_fields[i], lead_field, rtol=1e-12, atol=0)
+        assert_allclose(lead_fields[1], lf.calculate(gen_conf), rtol=1e-12,
+                        atol=0)
+
+    # Individual electrodes and generators for each subject
+    lf = Lead_Field(max_memory=2**16)
+    xyz_el = array([lf.xyz_el / lf.radius * radius for radius in radii])
+    gen_arrays = array([gen_conf_to_array(gen_conf)] * 3)
+    gen_arrays[2,:,0] += 0.5
+    lead_fields = lf.calculate_subjects(gen_arrays, radii, xyz_el)
+    assert_allclose(lead_fields[2],
+                    calculate_lead_field_given_electrodes(
+                            array_to_gen_conf(gen_arrays[2]), radii[2],
+                            xyz_el[2]), rtol=1e-12, atol=0)
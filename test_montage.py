@@ -0,0 +1,189 @@
+import csv
+import os
+import sys
+from os.path import join
+from shutil import copy, rmtree
+from tempfile import mkdtemp
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_raises
+from numpy import allclose, sqrt, sum, arange, may_share_memory, array, cos,\
+                  sin, pi
+from numpy import random
+from numpy.testing import assert_array_equal
+
+from montage import get_montage, parse_elp, montage_path, MONTAGES,\
+                    standard_montage, Channel_Index, SIDECAR_SUFFIX, HEAD_RADIUS,\
+                    MONTAGE_DIRECTORY
+from lead_field import Lead_Field
+from generator_configuration import random_generator_placement
+
+sys.path.insert(0, join(MONTAGE_DIRECTORY, 'old', 'scalingproject'))
+from topographicmap import read_electrode_locations
+
+
+def read_electrode_locations_csv():
+    """The original csv reader of topographicmap.read_electrode_locations()"""
+    reader = csv.reader(open(join(MONTAGE_DIRECTORY, 'electrodeLocations.elp'),
+                             'rb'), dialect='excel-tab')
+    electrodes = []
+    electrode_theta = []
+    electrode_phi = []
+    for row in reader:
+        if reader.line_num != 1:
+            electrodes.append(row[1])
+            electrode_theta.append(float(row[2]))
+            electrode_phi.append(float(row[3]))
+    electrode_theta = array(electrode_theta) / max(electrode_theta)
+    electrode_x = [electrode_theta[i] * cos(electrode_phi[i] / 180 * pi)
+                   for i in range(len(electrodes))]
+    electrode_y = [electrode_theta[i] * sin(electrode_phi[i] / 180 * pi)
+                   for i in range(len(electrodes))]
+    for i in range(len(electrode_theta)):
+        if electrode_theta[i] < 0:
+            electrode_phi[i] = electrode_phi[i] / 180 * pi + pi
+        else:
+            electrode_phi[i] = electrode_phi[i] / 180 * pi
+    electrode_theta = abs(electrode_theta) * pi / 2
+    return [electrodes, electrode_x, electrode_y, electrode_theta,
+            electrode_phi]
+
+
+def test_montage_shared_and_read_only():
+    montage = get_montage()
+    assert montage is get_montage('electrodeLocations.elp')
+    assert montage.n_el == 60
+    assert montage.xyz.shape == (60, 3)
+    assert allclose(sqrt(sum(montage.xyz**2, -1)), HEAD_RADIUS)
+    def write():
+        montage.xyz[0,0] = 0
+    assert_raises(ValueError, write)
+
+
+def test_read_electrode_locations_unchanged():
+    locations = read_electrode_locations()
+    expected = read_electrode_locations_csv()
+    assert locations[0] == expected[0]
+    assert locations[0][23] == '      T7'
+    for values, expected_values in zip(locations[1:], expected[1:]):
+        assert type(values) == type(expected_values)
+        assert_array_equal(values, expected_values)
+    # The values are the caller's to modify
+    locations[1][0] = 0
+    locations[3][0] = 0
+    assert read_electrode_locations()[1][0] == expected[1][0]
+    assert read_electrode_locations()[3][0] == expected[3][0]
+
+
+def test_scaling_experiment_rereference():
+    try:
+        from ScalingExperiment import ScalingExperiment
+    except ImportError:
+        # Needs the dependencies of the old scaling project, e.g. rpy2
+        raise SkipTest
+    # Only the reference matters for rereference()
+    parameters = dict((name, None) for name in
+                      ['experiment_1_magnitude_multiplier',
+                       'experiment_2_limits_number', 'limits_number',
+                       'limits_depth', 'limits_orientation', 'limits_magnitude',
+                       'final_magnitude', 'number_of_subjects',
+                       'number_of_simulations', 'hemispheres', 'sites',
+                       'locations'])
+    electrodes = read_electrode_locations()[0]
+    left, right = electrodes.index('      T7'), electrodes.index('      T8')
+    for reference in ('left_mastoid', 'average_mastoid', 'average'):
+        experiment = ScalingExperiment(1, parameters=parameters,
+                                       reference=reference)
+        data_1 = random.normal(size=(4, len(electrodes)))
+        data_2 = random.normal(size=(4, len(electrodes)))
+        expected_1 = data_1 - {'left_mastoid': data_1[:,[left]],
+                        'average_mastoid': (data_1[:,[left]] +
+                                            data_1[:,[right]]) / 2,
+                        'average': data_1.mean(1)[:,None]}[reference]
+        result = experiment.rereference(data_1, data_2, electrodes)
+        assert allclose(result[0], expected_1)
+
+
+def test_montage_independent_of_working_directory():
+    cwd = os.getcwd()
+    directory = mkdtemp()
+    try:
+        os.chdir(directory)
+        assert montage_path() == montage_path(join(cwd, 'electrodeLocations.elp'))
+    finally:
+        os.chdir(cwd)
+        rmtree(directory)
+
+
+def test_montage_sidecar_same_as_elp():
+    directory = mkdtemp()
+    try:
+        file_name = join(directory, 'electrodeLocations.elp')
+        copy('electrodeLocations.elp', file_name)
+        montage = get_montage(file_name)
+        assert os.path.exists(file_name + SIDECAR_SUFFIX)
+        # Reading the sidecar rather than parsing the .elp file
+        del MONTAGES[montage_path(file_name)]
+        from_sidecar = get_montage(file_name)
+        assert from_sidecar is not montage
+        parsed = parse_elp(file_name)
+        assert from_sidecar.names == parsed.names
+        assert from_sidecar.labels == parsed.labels
+        for name in ('x', 'y', 'theta', 'phi', 'xyz'):
+            assert (getattr(from_sidecar, name) == getattr(parsed, name)).all()
+    finally:
+        MONTAGES.pop(montage_path(file_name), None)
+        rmtree(directory)
+
+
+def test_standard_montage():
+    assert get_montage('10-20').n_el == 21
+    assert get_montage('10-10').n_el == 69
+    assert get_montage('10-5').n_el == 261
+    # Close to the electrodes of the 10-10 system in electrodeLocations.elp
+    montage = get_montage()
+    standard = get_montage('10-10')
+    names = [name.upper() for name in standard.names]
+    for i, name in enumerate(montage.names):
+        distance = sqrt(sum((montage.xyz[i] -
+                             standard.xyz[names.index(name)])**2))
+        assert distance < 1
+    assert_raises(ValueError, standard_montage, '10-1')
+
+
+def test_geodesic_montage():
+    for frequency, n_el in ((5, 126), (7, 246), (8, 341)):
+        montage = get_montage('geodesic_' + str(frequency))
+        assert montage.n_el == n_el
+        assert len(set(montage.names)) == n_el
+        assert allclose(sqrt(sum(montage.xyz**2, -1)), HEAD_RADIUS)
+        assert (montage.xyz[:,2] > -1e-9).all()
+
+
+def test_channel_index():
+    channels = Channel_Index(['Fz', 'Cz', 'Pz', 'M1', 'M2', 'HEO', 'Oz'])
+    assert channels.index(' Pz') == 2
+    assert_raises(ValueError, channels.index, 'T7')
+    assert channels.subset_names('EEG') == ['Fz', 'Cz', 'Pz', 'Oz']
+    data = arange(14.).reshape((2, 7))
+    # A single copy for a subset with gaps, a view for a contiguous one
+    selected = channels.select(data, 'EEG', 1)
+    assert_array_equal(selected, data[:,[0, 1, 2, 6]])
+    assert not may_share_memory(selected, data)
+    channels.add_subset('midline', include=['Fz', 'Cz', 'Pz'])
+    selected = channels.select(data, 'midline', -1)
+    assert_array_equal(selected, data[:,:3])
+    assert may_share_memory(selected, data)
+    assert_raises(ValueError, channels.add_subset, 'error', exclude=['T7'])
+    assert_raises(ValueError, Channel_Index, ['Fz', 'Fz'])
+
+
+def test_lead_field_channels():
+    lf = Lead_Field()
+    lf_subset = Lead_Field(channels=['CZ', 'T7', 'T8'], reference='CZ')
+    gen_conf = random_generator_placement()
+    lead_field = lf.calculate(gen_conf)
+    indices = [lf.channels.index(name) for name in ['CZ', 'T7', 'T8']]
+    assert_array_equal(lf_subset.calculate(gen_conf),
+                       lead_field[indices] - lead_field[indices[0]])
+    assert Lead_Field(channels='EEG').xyz_el.base is lf.xyz_el
@@ -0,0 +1,38 @@
+from nose.tools import assert_raises
+from numpy import random, mean, cov, array_split
+from numpy.testing import assert_allclose
+
+from sample_moments import Sample_Moments, mean_and_covariance
+
+
+def test_sample_moments_same_as_numpy():
+    data = random.normal(size=(103, 7))
+    for chunks in ([data], array_split(data, 10), list(data)):
+        moments = Sample_Moments().add_chunks(chunks)
+        assert moments.count == 103
+        assert_allclose(moments.mean, mean(data, 0))
+        assert_allclose(moments.covariance(), cov(data.T))
+        assert_allclose(moments.variance(0), data.var(0))
+    # From a generator, read one chunk at a time
+    mean_data, cov_data = mean_and_covariance(chunk for chunk in
+                                              array_split(data, 4))
+    assert_allclose(cov_data, cov(data.T))
+    assert_raises(ValueError, Sample_Moments().add(data[0]).covariance)
+
+
+def test_sample_moments_merge():
+    data = random.normal(size=(50, 4))
+    first = Sample_Moments().add(data[:20])
+    second = Sample_Moments().add(data[20:])
+    merged = Sample_Moments().merge(first).merge(second)
+    assert first.count == 20
+    assert_allclose(merged.mean, mean(data, 0))
+    assert_allclose(merged.covariance(), cov(data.T))
+    assert_raises(ValueError, merged.merge, Sample_Moments().add(data[:,:3]))
+
+
+def test_sample_moments_large_offset():
+    # Accumulating sums of squares would lose the variance to cancellation
+    data = 1e8 + random.normal(size=(1000, 3))
+    moments = Sample_Moments().add_chunks(array_split(data, 7))
+    assert_allclose(moments.covariance(), cov(data.T), atol=1e-6)
@@ -0,0 +1,330 @@
+"""
+Benchmarks of the lead field calculation, sweeping the number of electrodes,
+the number of generators and the number of generator configurations
+calculated in one batch, for each of the ways of calculating lead fields:
+
+* 'function', calculate_lead_field_given_electrodes() for one configuration
+  after the other
+* 'direct', 'blocked', 'table' and 'grid', Lead_Field.calculate_batch() of a
+  Lead_Field with the corresponding method (or max_memory for 'blocked')
+
+Wall times and peak memory of every combination are written to a JSON file,
+and optionally a CSV file, together with the accuracy of each backend against
+the lead fields of the old code in test_lead_field_same_output_as_old_code.data.
+The benchmark fails if any backend is less accurate than it should be.
+
+Run it from the root of the repository, e.g.
+
+    python util/benchmark_lead_field.py --quick --output benchmark.json
+
+The 60 electrode montage is the one of electrodeLocations.elp, larger ones
+are spread evenly over the upper hemisphere of the head. Peak memory is
+measured with tracemalloc where it is available (Python 3), otherwise in a
+fresh interpreter running this script with --measure-memory, as the increase
+of its peak resident memory during the call. That interpreter sets up the same
+combination first, so the setup is not counted, but the increase is
+underestimated if the setup itself needed more memory than the call.
+"""
+
+from __future__ import division
+
+import os
+import sys
+import csv
+import json
+import time
+import pickle
+import platform
+from argparse import ArgumentParser, SUPPRESS
+from subprocess import check_output
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from numpy import arange, array, sqrt, sin, cos, pi, empty
+from numpy.random import RandomState
+
+from lead_field import Lead_Field, calculate_lead_field_given_electrodes,\
+                       GRID_LIMITS, BRODY_1973_WORK_SIZE
+from montage import get_montage, montage_from_directions
+from generator_configuration import GEN_CONF_PARAMETERS, array_to_gen_conf
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+
+N_ELECTRODES = (60, 128, 256, 512, 1024)
+N_GENERATORS = (1, 10, 100, 1000, 20000)
+BATCH_SIZES = (1, 10, 100)
+BACKENDS = ('function', 'direct', 'blocked', 'table', 'grid')
+QUICK = {'n_el': (60, 128), 'n_gen': (1, 100), 'batch': (1, 10)}
+# Memory given to the 'blocked' backend
+BLOCKED_MEMORY = 2**26
+# The interpolating backends cover the depths of the old code configurations
+BENCHMARK_LIMITS = dict(GRID_LIMITS, depth=(4.0, 7.05))
+# Largest relative error allowed for each backend against the old code
+EXACT_TOLERANCE = 1e-12
+INTERPOLATION_TOLERANCE = 1e-2
+OLD_CODE_FILE = 'test_lead_field_same_output_as_old_code.data'
+# The old code used a montage of 62 electrodes, rows 57 and 61 of its lead
+# fields are electrodes no longer in electrodeLocations.elp
+OLD_CODE_ROWS = list(range(57)) + [58, 59, 60]
+# Entries of each result, in the order of the columns of the CSV file
+RESULT_FIELDS = ('backend', 'n_el', 'n_gen', 'batch', 'best time',
+                 'mean time', 'repeats', 'peak memory', 'memory measure',
+                 'skipped')
+
+
+def hemisphere_montage(n_el):
+    """Montage of n_el electrodes spread evenly over the upper hemisphere,
+    along a spiral of points of equal area (a Fibonacci lattice).
+    """
+    z = (arange(n_el) + 0.5) / n_el
+    phi = arange(n_el) * pi * (3 - sqrt(5))
+    directions = empty((n_el, 3))
+    directions[:,0] = sqrt(1 - z**2) * cos(phi)
+    directions[:,1] = sqrt(1 - z**2) * sin(phi)
+    directions[:,2] = z
+    return montage_from_directions(['E' + str(i + 1) for i in range(n_el)],
+                                   directions, 'hemisphere_' + str(n_el))
+
+
+def benchmark_montage(n_el):
+    """The default montage if it has n_el electrodes, otherwise
+    hemisphere_montage()."""
+    if n_el == get_montage().n_el:
+        return get_montage()
+    return hemisphere_montage(n_el)
+
+
+def random_gen_arrays(n_configs, n_gen, seed=0):
+    """Random generator configurations of shape (n_configs, n_gen, 5) within
+    the default limits of ERP_Variability_Model.
+    """
+    random_state = RandomState(seed)
+    gen_arrays = empty((n_configs, n_gen, len(GEN_CONF_PARAMETERS)))
+    for i, parameter in enumerate(GEN_CONF_PARAMETERS):
+        gen_arrays[...,i] = random_state.uniform(GRID_LIMITS[parameter][0],
+                                                 GRID_LIMITS[parameter][1],
+                                                 (n_configs, n_gen))
+    return gen_arrays
+
+
+def create_lead_field(backend, montage):
+    """The Lead_Field of a backend for the electrodes of montage, or None for
+    the 'function' backend and for a grid with any but the default montage
+    (whose size would grow with the number of electrodes).
+    """
+    if backend == 'function':
+        return None
+    if backend == 'grid' and montage is not get_montage():
+        return None
+    if backend == 'blocked':
+        return Lead_Field(max_memory=BLOCKED_MEMORY, montage=montage)
+    if backend in ['table', 'grid']:
+        return Lead_Field(method=backend, limits=BENCHMARK_LIMITS,
+                          grid_tolerance=INTERPOLATION_TOLERANCE / 2,
+                          montage=montage)
+    return Lead_Field(method=backend, montage=montage)
+
+
+def calculate_function(backend, lf, montage, gen_arrays):
+    """A function without arguments calculating the lead fields of gen_arrays
+    with the backend, all conversions of the inputs already done.
+    """
+    if backend == 'function':
+        gen_confs = [array_to_gen_conf(gen_array) for gen_array in gen_arrays]
+        return lambda: [calculate_lead_field_given_electrodes(gen_conf,
+                                                montage.radius, montage.xyz)
+                        for gen_conf in gen_confs]
+    return lambda: lf.calculate_batch(gen_arrays)
+
+
+def measure(calculate, case, min_time=0.2, max_repeats=10):
+    """Wall times of repeated calls of calculate, until min_time has passed
+    or max_repeats calls were made, and the peak memory of one more call, see
+    measure_peak_memory(). case is the (backend, n_el, n_gen, batch)
+    combination calculated.
+    """
+    times = []
+    while len(times) < max_repeats and sum(times) < min_time:
+        start_time = time.time()
+        calculate()
+        times.append(time.time() - start_time)
+
+    peak_memory, memory_measure = measure_peak_memory(calculate, case)
+    return {'best time': min(times), 'mean time': sum(times) / len(times),
+            'repeats': len(times), 'peak memory': peak_memory,
+            'memory measure': memory_measure}
+
+
+def measure_peak_memory(calculate, case):
+    """Peak memory in bytes allocated during a call of calculate, and how it
+    was measured. Without tracemalloc, the combination case is calculated in
+    a fresh interpreter instead, see measure_resident_memory(), since the peak
+    resident memory of this process or of a fork of it includes everything
+    this process ever allocated.
+    """
+    if tracemalloc is not None:
+        tracemalloc.start()
+        calculate()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak_memory, 'tracemalloc'
+
+    output = check_output([sys.executable, os.path.abspath(__file__),
+                           '--measure-memory'] + [str(value)
+                                                  for value in case])
+    return int(output.strip().splitlines()[-1]), 'ru_maxrss'
+
+
+def measure_resident_memory(backend, n_el, n_gen, batch):
+    """Increase of the peak resident memory of this process in bytes during
+    one calculation of a combination, after setting it up."""
+    montage = benchmark_montage(n_el)
+    calculate = calculate_function(backend, create_lead_field(backend, montage),
+                                   montage, random_gen_arrays(batch, n_gen))
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    calculate()
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start
+    # ru_maxrss is in bytes on OS X and in kilobytes elsewhere
+    if sys.platform != 'darwin':
+        peak_memory *= 1024
+    return peak_memory
+
+
+def skip_reason(backend, n_el, n_gen, batch, max_memory):
+    """Why a combination is not run, or None if it is. The lead fields alone,
+    or the temporary arrays of the backends that are not blocked, would take
+    more than max_memory bytes.
+    """
+    if batch * n_el * n_gen * 8 > max_memory:
+        return 'lead fields larger than ' + str(max_memory) + ' bytes'
+    if backend in ['function', 'direct', 'table']:
+        configs = 1 if backend == 'function' else batch
+        if configs * n_el * n_gen * BRODY_1973_WORK_SIZE * 8 > max_memory:
+            return 'temporary arrays larger than ' + str(max_memory) + ' bytes'
+    return None
+
+
+def check_accuracy(backends=BACKENDS):
+    """Largest relative error of each backend against the lead fields of the
+    old code, relative to the largest value of each lead field. Raises an
+    AssertionError if a backend is less accurate than EXACT_TOLERANCE, or
+    INTERPOLATION_TOLERANCE for 'table' and 'grid'.
+    """
+    with open(OLD_CODE_FILE, 'rb') as f:
+        old_code = pickle.load(f)
+    montage = get_montage()
+    errors = {}
+    for backend in backends:
+        lf = create_lead_field(backend, montage)
+        errors[backend] = 0
+        for reference in old_code:
+            gen_array = array([[gen[parameter]
+                                for parameter in GEN_CONF_PARAMETERS]
+                               for gen in reference['gen_conf']])
+            lead_field = calculate_function(backend, lf, montage,
+                                            gen_array[None])()[0]
+            expected = reference['lead_field'][OLD_CODE_ROWS]
+            error = abs(lead_field - expected).max() / abs(expected).max()
+            errors[backend] = max(errors[backend], error)
+        if backend in ['table', 'grid']:
+            tolerance = INTERPOLATION_TOLERANCE
+        else:
+            tolerance = EXACT_TOLERANCE
+        assert errors[backend] <= tolerance, backend + ' lead fields ' +\
+               'differ from the old code by ' + str(errors[backend])
+    return errors
+
+
+def run_benchmark(backends=BACKENDS, n_electrodes=N_ELECTRODES,
+                  n_generators=N_GENERATORS, batch_sizes=BATCH_SIZES,
+                  max_memory=2**30, min_time=0.2, max_repeats=10, disp=True):
+    """Measures all combinations of backends, numbers of electrodes,
+    generators and batch sizes, returns a list of results with the entries
+    in RESULT_FIELDS.
+    """
+    results = []
+    for n_el in n_electrodes:
+        montage = benchmark_montage(n_el)
+        for backend in backends:
+            lf = create_lead_field(backend, montage)
+            for n_gen in n_generators:
+                for batch in batch_sizes:
+                    result = dict((field, None) for field in RESULT_FIELDS)
+                    result.update({'backend': backend, 'n_el': n_el,
+                                   'n_gen': n_gen, 'batch': batch})
+                    if lf is None and backend != 'function':
+                        result['skipped'] = 'only for the default montage'
+                    else:
+                        result['skipped'] = skip_reason(backend, n_el, n_gen,
+                                                        batch, max_memory)
+                    if result['skipped'] is None:
+                        gen_arrays = random_gen_arrays(batch, n_gen)
+                        result.update(measure(calculate_function(backend, lf,
+                                                        montage, gen_arrays),
+                                              (backend, n_el, n_gen, batch),
+                                              min_time, max_repeats))
+                    results.append(result)
+                    if disp:
+                        print(format_result(result))
+    return results
+
+
+def format_result(result):
+    description = result['backend'] + ', ' + str(result['n_el']) +\
+                  ' electrodes, ' + str(result['n_gen']) + ' generators, ' +\
+                  'batch of ' + str(result['batch']) + ': '
+    if result['skipped'] is not None:
+        return description + 'skipped, ' + result['skipped']
+    return description + '%.3g s, %.3g MB' % (result['best time'],
+                                              result['peak memory'] / 2**20)
+
+
+def save_results(results, accuracy, filename, csv_filename=None):
+    with open(filename, 'w') as f:
+        json.dump({'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'accuracy': accuracy, 'results': results}, f, indent=1)
+    if csv_filename is not None:
+        with open(csv_filename, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(RESULT_FIELDS)
+            for result in results:
+                writer.writerow([result[field] for field in RESULT_FIELDS])
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmarks of the lead field ' +
+                                        'calculation')
+    parser.add_argument('--quick', action='store_true',
+                        help='a small sweep, e.g. to check that it runs')
+    parser.add_argument('--backends', nargs='+', default=BACKENDS,
+                        choices=BACKENDS)
+    parser.add_argument('--max-memory', type=int, default=2**30,
+                        help='skip combinations needing more bytes')
+    parser.add_argument('--output', default='lead_field_benchmark.json')
+    parser.add_argument('--csv', default=None)
+    # Used by measure_peak_memory(), prints the peak memory of one combination
+    parser.add_argument('--measure-memory', nargs=4, default=None,
+                        metavar=('BACKEND', 'N_EL', 'N_GEN', 'BATCH'),
+                        help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure_memory is not None:
+        backend, n_el, n_gen, batch = args.measure_memory
+        print(measure_resident_memory(backend, int(n_el), int(n_gen),
+                                      int(batch)))
+        sys.exit()
+
+    accuracy = check_accuracy(args.backends)
+    for backend in args.backends:
+        print('Accuracy of ' + backend + ': ' + str(accuracy[backend]))
+    if args.quick:
+        results = run_benchmark(args.backends, QUICK['n_el'], QUICK['n_gen'],
+                                QUICK['batch'], args.max_memory)
+    else:
+        results = run_benchmark(args.backends, max_memory=args.max_memory)
+    save_results(results, accuracy, args.output, args.csv)
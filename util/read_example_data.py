@@ -1,31 +1,29 @@
 from string import join
+import os
 import sys
 sys.path.insert(0, 'briskbrain-code/scalingproject')
 sys.path.insert(0, 'briskbrain-code/src')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from numpy import mean, cov, array
+from numpy import mean, array, newaxis
 from scipy.io import loadmat
 
 from data_import import avg_txt_import, SPSS_query
+from montage import Channel_Index
+from sample_moments import mean_and_covariance
 
 
 def rereference_to_average(data):
-    for i in range(data.shape[0]):
-        data[i] = data[i] - mean(data[i])
-    return data
+    return data - mean(data, 1)[:,newaxis]
 
 
 def generate_accepted_electrodes(electrodes, electrodes_to_remove):
     # Remove these electrodes:
     # ['M1', 'M2', 'HEO', 'VEO', 'CB1', 'CB2']
-    accepted_electrodes = range(len(electrodes))
-    for el in electrodes_to_remove:
-        accepted_electrodes.remove(electrodes.index(el))
-    
-    final_electrodes = []
-    for [i, electrode] in zip(range(len(electrodes)), electrodes):
-        if i in accepted_electrodes:
-            final_electrodes.append(electrode)
+    channels = Channel_Index(electrodes)
+    accepted_electrodes = channels.add_subset('accepted',
+                                              exclude=electrodes_to_remove)
+    final_electrodes = channels.subset_names('accepted')
 
     return [accepted_electrodes, final_electrodes]
 
@@ -56,6 +54,7 @@ def read_danieles_data(nonEEG_electrodes=False, average_reference=True,
                 {'unrelated': {}, 'related': {}}
 
     electrodes = None
+    channels = None
 
     for paradigm in ['left parietal', 'P3b', 'N400']:
         if paradigm == 'left parietal':
@@ -97,23 +96,25 @@ def read_danieles_data(nonEEG_electrodes=False, average_reference=True,
             elif electrodes != electrode_names:
                 print('WARNING: Different electrodes!')
 
-            if nonEEG_electrodes is True:
-                accepted_electrodes = range(len(electrodes))
-            else:
-                [accepted_electrodes, final_electrodes] = \
-                        generate_accepted_electrodes(electrodes, \
-                        ['M1', 'M2', 'HEO', 'VEO', 'CB1', 'CB2'])
+            # The channel subset is computed once, for the first subject
+            if channels is None:
+                channels = Channel_Index(electrodes)
+                if nonEEG_electrodes is True:
+                    subset = 'all'
+                else:
+                    subset = 'EEG'
+                final_electrodes = channels.subset_names(subset)
             
             for cond_name in [condition_1,condition_2]:
                 if time_window is True:
-                    signal = mat_file[cond_name[1]][accepted_electrodes,:].T
+                    signal = channels.select(mat_file[cond_name[1]], subset).T
                     if average_reference is True:
                         signal = rereference_to_average(signal)
                     else:
                         print('WARNING: Not rereferencing to average!')
                 else:
                     print('WARNING: Not rereferencing to average!')
-                    signal = mat_file[cond_name[1]][accepted_electrodes,:,:]
+                    signal = channels.select(mat_file[cond_name[1]], subset)
                 
                 ERPs[paradigm]['within subject'][subject][cond_name[0]] = signal
                 if time_window is True:
@@ -158,15 +159,14 @@ def read_brittanys_data():
     data = ERP_area['new']['300-500']
     
     electrodes = electrodes_read_area[2]
-    [accepted_electrodes, final_electrodes] = \
-            generate_accepted_electrodes(electrodes, \
-            ['CB1', 'CB2'])
+    channels = Channel_Index(electrodes)
+    channels.add_subset('accepted', exclude=['CB1', 'CB2'])
+    final_electrodes = channels.subset_names('accepted')
     
-    data = data[:,accepted_electrodes]
+    data = channels.select(data, 'accepted', 1)
 
-    rereference_to_average(data)
+    data = rereference_to_average(data)
 
-    mean_data = mean(data,0)
-    cov_data = cov(data.transpose())
+    [mean_data, cov_data] = mean_and_covariance(data)
 
     return [data, mean_data, cov_data, final_electrodes]
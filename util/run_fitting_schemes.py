@@ -12,12 +12,23 @@ from numpy.linalg import norm
 from erp_variability_model_fit import ERP_Variability_Model_Fit,\
                                       fit_variability_model, error_mean,\
                                       error_cov, error_mean_and_cov
+from lead_field import Lead_Field
 
 
 def run_fitting_schemes(model_types, number_of_generators, random_seeds,
-                        schemes, mean_data, cov_data, max_fun_eval=100000):
+                        schemes, mean_data, cov_data, max_fun_eval=100000,
+                        lead_field_cache_size=0):
+    """If lead_field_cache_size is larger than 0, all models share one
+    Lead_Field object which keeps that many lead field columns in its cache, so
+    that dipoles that were already evaluated for another seed, scheme or fit
+    are not calculated again.
+    """
     all_models = def_all_models_dict(schemes, model_types, 
                                      number_of_generators, random_seeds)
+    if lead_field_cache_size > 0:
+        lf = Lead_Field(cache_size=lead_field_cache_size)
+    else:
+        lf = None
 
     overall_start_time = time.time()
     for (model_type, n_gen, seed, scheme) in [(model_type, n_gen, seed, scheme)
@@ -27,7 +38,7 @@ def run_fitting_schemes(model_types, number_of_generators, random_seeds,
                                               for seed in random_seeds]:
         random.seed(seed)
         entry = def_empty_entry_dict()
-        erp_model = ERP_Variability_Model_Fit(n_sub=23, n_gen=n_gen)
+        erp_model = ERP_Variability_Model_Fit(n_sub=23, n_gen=n_gen, lf=lf)
         parameter_list = prepare_variability_parameter_list(erp_model, 
                                                             model_type, n_gen)
         # If parameter_list is None that means the combination of model_type
@@ -104,6 +115,8 @@ def run_fitting_schemes(model_types, number_of_generators, random_seeds,
         
     print('Overall time elapsed: ' + str(round(time.time() -\
                                                overall_start_time,2)))
+    if lf is not None:
+        print('Lead field cache: ' + str(lf.cache_info()))
 
     return all_models
 